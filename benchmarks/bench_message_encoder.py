@@ -0,0 +1,96 @@
+"""
+Reports the prompt size saved by the compact message encoding in message_encoder.py.
+
+Builds a synthetic channel of converted CSV rows with Slack markup and compares, for each
+prompt, the text sent before (Python dict reprs and raw message text) with the encoded
+text. Tokens are estimated at four characters each. Only the standard library and
+message_encoder.py are imported, so it runs without the Lambda dependencies.
+
+Usage: python benchmarks/bench_message_encoder.py [number_of_messages]
+       python -m pytest benchmarks/bench_message_encoder.py
+"""
+import os
+import sys
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_channels_analysis'))
+from message_encoder import clean_text, encode_rows
+
+MARKUP = ['<@U0{}|Jane Doe> ', '<@U0{}> ', '<#C0{}|customer-success> ', '<!here> ',
+          '<https://example.com/docs/{}?utm_source=slack&amp;utm_medium=share|the docs> ', '<https://example.com/p/{}> ']
+
+# The converters write times in IST
+IST = timezone(timedelta(hours=5, minutes=30))
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts, IST).strftime('%Y-%m-%d %H:%M:%S')
+
+def make_rows(message_count, seed=7):
+    """
+    Builds the converted CSV rows of a synthetic channel week, ordered by thread, where about
+    a third of the messages are thread replies and some carry Slack markup. Every value is a
+    string, as when the analysis lambdas read the CSV back.
+    """
+    rng = random.Random(seed)
+    ts = 1717200000.0
+    threads = []
+    for i in range(message_count):
+        ts += rng.uniform(1, 120)
+        text = 'message %d ' % i + 'lorem ipsum ' * rng.randint(1, 30)
+        if rng.random() < 0.4:
+            text = rng.choice(MARKUP).format(rng.randint(100, 999)) + text
+        reply = bool(threads) and rng.random() < 0.35
+        thread = rng.choice(threads[-50:]) if reply else []
+        thread_ts = thread[0]['Thread Id'] if reply else f"{ts:.6f}"
+        thread.append({
+            'Thread Id': f"{ts:.6f}",
+            'Date & Time': format_ts(ts),
+            "User's Name": 'User %d' % rng.randint(1, 200),
+            'Text Message': text,
+            'Thread Date & Time': format_ts(float(thread_ts)),
+            'Message Type': 'Reply' if reply else 'Primary Message',
+            'Total Reactions': str(rng.randint(1, 5) if rng.random() < 0.3 else 0),
+        })
+        if not reply:
+            threads.append(thread)
+    return [row for thread in threads for row in thread]
+
+def tokens(text):
+    return len(text) // 4
+
+def report(label, before, after):
+    print(f"{label:<26} {tokens(before):>10,} {tokens(after):>10,}   {100 * (1 - len(after) / len(before)):5.1f}%")
+
+def test_encode_rows_is_compact_and_complete():
+    rows = make_rows(500)
+    encoded = encode_rows(rows)
+    assert len(encoded) < len(repr(rows))
+    # The format note and the user legend come first, then one line per message
+    lines = encoded.split('\n')[2:]
+    assert len(lines) == len(rows)
+    for line, row in zip(lines, rows):
+        assert line.startswith('  ') == (row['Message Type'] == 'Reply')
+        assert line.endswith(': ' + clean_text(row['Text Message']))
+
+def main():
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rows = make_rows(message_count)
+    threads = [list(thread) for _, thread in groupby(rows, key=itemgetter('Thread Date & Time'))]
+    primary_rows = [row for row in rows if row['Message Type'] == 'Primary Message']
+
+    test_encode_rows_is_compact_and_complete()
+    print(f"Synthetic channel with {len(rows)} rows in {len(threads)} threads")
+    print(f"{'prompt':<26} {'before':>10} {'after':>10}   saved")
+    report('channel report', repr(rows), encode_rows(rows))
+    report('thread summaries',
+           ''.join('\n'.join(row['Text Message'] for row in thread) for thread in threads),
+           ''.join(encode_rows(thread, include_times=False, include_users=False) for thread in threads))
+    report('message classification',
+           ''.join(row['Text Message'] for row in primary_rows),
+           ''.join(clean_text(row['Text Message']) for row in primary_rows))
+
+if __name__ == '__main__':
+    main()
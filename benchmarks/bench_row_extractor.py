@@ -0,0 +1,113 @@
+"""
+Micro-benchmark of the message-to-row conversion used by the JSON to CSV converters.
+
+Compares the original per-field if/elif conversion with strptime-based sorting against
+the compiled extractor in row_extractor.py with numeric ts sorting, on a synthetic channel.
+
+Usage: python benchmarks/bench_row_extractor.py [number_of_messages]
+"""
+import os
+import sys
+import time
+import random
+from datetime import datetime
+from operator import itemgetter
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_slackdump_files_conversion_from-json_to_csv'))
+from row_extractor import SELECTED_FIELDS, compile_row_extractor, iter_keyed_rows
+
+def make_channel(message_count, seed=7):
+    """
+    Builds a synthetic channel week where about a third of the messages are thread replies.
+    """
+    rng = random.Random(seed)
+    ts = 1717200000.0
+    messages = []
+    parents = []
+    for i in range(message_count):
+        ts += rng.uniform(1, 120)
+        message = {
+            'ts': f"{ts:.6f}",
+            'text': 'message %d ' % i + 'lorem ipsum ' * rng.randint(1, 30),
+            'user_profile': {'real_name': 'User %d' % rng.randint(1, 200)},
+        }
+        if parents and rng.random() < 0.35:
+            message['thread_ts'] = rng.choice(parents[-50:])
+            message['parent_user_id'] = 'U%d' % rng.randint(1, 200)
+        else:
+            parents.append(message['ts'])
+        if rng.random() < 0.3:
+            message['reactions'] = [{'name': 'tada', 'count': rng.randint(1, 5)}]
+        messages.append(message)
+    return messages
+
+def legacy_rows(data):
+    selected_fields = SELECTED_FIELDS
+    rows = []
+    for obj in data:
+        selected_data = {}
+        if obj.get('subtype') == 'channel_join':
+            continue
+        for field in selected_fields:
+            if field == 'Date & Time':
+                if 'ts' in obj:
+                    timestamp = float(obj['ts'])
+                    utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
+                    ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
+                    selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
+            elif field == "User's Name":
+                selected_data[field] = obj.get('user_profile', {}).get('real_name')
+            elif field == 'Text Message':
+                selected_data[field] = obj.get('text')
+            elif field == 'Thread Date & Time':
+                if 'thread_ts' in obj:
+                    timestamp = float(obj['thread_ts'])
+                else:
+                    timestamp = float(obj['ts'])
+                utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
+                ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
+                selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
+            elif field == 'Thread Id':
+                selected_data[field] = obj.get('ts')
+            elif field == 'Message Type':
+                if 'parent_user_id' not in obj:
+                    selected_data[field] = 'Primary Message'
+                else:
+                    selected_data[field] = 'Reply'
+            elif field == 'Total Reactions':
+                reactions = obj.get('reactions')
+                selected_data[field] = sum(reaction['count'] for reaction in reactions) if reactions else 0
+            else:
+                selected_data[field] = None
+        rows.append(selected_data)
+
+    rows.sort(key=lambda x: (datetime.strptime(x.get('Thread Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Thread Date & Time') else datetime.min,
+                             datetime.strptime(x.get('Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Date & Time') else datetime.min))
+    return rows
+
+def compiled_rows(data):
+    extract_row = compile_row_extractor(SELECTED_FIELDS)
+    keyed_rows = sorted(iter_keyed_rows(data, extract_row), key=itemgetter(0))
+    return [row for key, row in keyed_rows]
+
+def measure(label, convert, data, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = convert(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<10} {len(rows):>8} rows  {best:8.3f}s  {len(rows) / best:>12,.0f} rows/s")
+    return best
+
+def main():
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_channel(message_count)
+    print(f"Synthetic channel with {message_count} messages")
+    before = measure('before', legacy_rows, data)
+    after = measure('after', compiled_rows, data)
+    print(f"speed-up   {before / after:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import os
+import json
+import heapq
+import pickle
+import codecs
+import tempfile
+
+# Rows kept in memory by external_sort before a sorted run is spilled to a temp file
+EXTERNAL_SORT_MAX_ROWS = int(os.getenv('EXTERNAL_SORT_MAX_ROWS', '50000'))
+
+_WHITESPACE = ' \t\n\r'
+# Characters that may continue a number cut at the end of the buffer
+_NUMBER_CHARS = '0123456789+-.eE'
+
+def iter_json_array(file_obj, chunk_size=64 * 1024):
+    """
+    Yields the items of a top-level JSON array one at a time, reading the file in chunks,
+    so memory is bounded by the largest single item rather than by the file size.
+    Malformed or truncated input raises ValueError, as json.load does.
+    :param file_obj: A text or binary file-like object, such as an open file or an S3 body.
+    :param chunk_size: The number of bytes or characters read at a time.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+    # After an item only a delimiter may follow, and after a comma only another item
+    after_item = False
+    after_comma = False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            eof = True
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=eof)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of JSON array' if started else 'Expected a top-level JSON array')
+            read_more()
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('Expected a top-level JSON array')
+            started = True
+            pos += 1
+            continue
+        if after_item:
+            if buffer[pos] == ',':
+                after_item, after_comma = False, True
+                pos += 1
+                continue
+            if buffer[pos] != ']':
+                raise ValueError("Expected ',' or ']' after a JSON array item")
+        if buffer[pos] == ']':
+            if after_comma:
+                raise ValueError('Trailing comma in JSON array')
+            pos += 1
+            break
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        # A number cut at a chunk boundary, such as "-2.5e" before "10", decodes as a shorter
+        # value, so an item is only accepted once the buffer holds more than it could continue with
+        if not eof and all(c in _NUMBER_CHARS or c in _WHITESPACE for c in buffer[end:]):
+            read_more()
+            continue
+        pos = end
+        after_item, after_comma = True, False
+        yield item
+
+    # Only whitespace may follow the array
+    while True:
+        if buffer[pos:].strip(_WHITESPACE):
+            raise ValueError('Extra data after the JSON array')
+        if eof:
+            return
+        pos = len(buffer)
+        read_more()
+
+def _spill(run):
+    spill_file = tempfile.TemporaryFile()
+    for item in run:
+        pickle.dump(item, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    spill_file.seek(0)
+    return spill_file
+
+def _read_spill(spill_file):
+    while True:
+        try:
+            yield pickle.load(spill_file)
+        except EOFError:
+            return
+
+def external_sort(items, key, max_in_memory=EXTERNAL_SORT_MAX_ROWS):
+    """
+    Sorts items while holding at most max_in_memory of them in memory. Larger inputs are
+    spilled to sorted runs in temp files and merged back lazily; the sort is stable.
+    """
+    run = []
+    spill_files = []
+    for item in items:
+        run.append(item)
+        if len(run) >= max_in_memory:
+            run.sort(key=key)
+            spill_files.append(_spill(run))
+            run = []
+    run.sort(key=key)
+
+    if not spill_files:
+        yield from run
+        return
+    try:
+        yield from heapq.merge(*[_read_spill(f) for f in spill_files], iter(run), key=key)
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+
+def spilled_run(items, key, max_in_memory=EXTERNAL_SORT_MAX_ROWS):
+    """
+    Sorts items with external_sort and writes the whole sorted run to a temp file, so only
+    one item of the run is held in memory while it is read back.
+    :return: An iterator over the sorted items, closing the temp file once exhausted.
+    """
+    spill_file = _spill(external_sort(items, key, max_in_memory))
+    try:
+        yield from _read_spill(spill_file)
+    finally:
+        spill_file.close()
@@ -2,20 +2,49 @@ import subprocess
 import os
 from datetime import datetime, timedelta
 import pytz
-import boto3
 from botocore.exceptions import ClientError
+from s3_uploader import upload_dir_to_s3, download_dir_from_s3, delete_prefix_from_s3, get_s3_client
+from json_stream import iter_json_array, spilled_run
+from row_extractor import SELECTED_FIELDS, compile_row_extractor, iter_keyed_rows
+from parquet_io import CSV_FIELDS, ds, open_dataset, read_rows
+from thread_index import ThreadIndexBuilder, THREAD_INDEX_SUFFIX, load_thread_index
 import json
 import csv
-import anthropic
-
-def get_completion(prompt, model="claude-3-haiku-20240307"):
-
-    api_key = os.environ['CLAUDE_API_KEY']
-    claude_client = anthropic.Client(api_key=api_key)
-
-    response = claude_client.messages.create(
+import heapq
+from operator import itemgetter
+from itertools import groupby
+from llm_gateway import complete, map_concurrently, metrics
+from message_encoder import UserAliases, encode_rows, clean_text
+from response_cache import maybe_evict
+from checkpoint import Checkpoint, Deadline, get_checkpoint_store, reinvoke
+from structured_output import (LLM_STRUCTURED_OUTPUT, correction_prompt, json_tool, parse_reply, parse_stats,
+                               required_keys, string_properties)
+
+# Specify the selected folders to process
+SELECTED_FOLDERS = ['chit-chat', 'chat-highlights', 'welcome-and-introductions', 'job-board', 'leadership',
+                    'career-development', 'customer-experience', 'customer-success', 'knowledge-management',
+                    'u-zendesk', 'support-operations', 'events', 'technology', 'about', 'vent',
+                    'zlocal-remote', 'metrics-data-kpis', 'good-news', 'quality', 'bulletin-board', 'onboarding',
+                    'product-management', 'outsourcing']
+
+# When set (e.g. s3://slackdumpfilesparquet/), the week is read from the converter's Parquet dataset
+PARQUET_SOURCE = os.getenv('PARQUET_SOURCE')
+
+# The CSVs of a run that continues in a new invocation are staged here, so every invocation analyses the same export
+RUN_STAGING_BUCKET = os.getenv('RUN_STAGING_BUCKET', 'slackdumpanalysisstate')
+RUN_STAGING_PREFIX = os.getenv('RUN_STAGING_PREFIX', '_runs/')
+
+def get_completion(prompt, model="claude-3-haiku-20240307", instructions=None, tool=None):
+
+    # The gateway reuses one pooled client per container and retries rate limits and overloads.
+    # The system prompt and the fixed instructions go first and are cached between calls.
+    # With a tool the reply is the JSON of a forced tool call following its schema.
+    output = complete(
+        prompt,
+        prefix=instructions,
         model=model,
         max_tokens=2048,
+        tool=tool,
         system="""You are a Senior product manager having 10 years of experience and working with Atlas\
 - a customer support tool offering a seamless experience for both agents and customers.You overlook Content, Product Growth, Sales and Marketing.\
 
@@ -57,93 +86,86 @@ Atlas provides founders, CX leaders, and managers with the tools necessary to de
 
 Whether you're looking to streamline your support operations, improve customer engagement, or gain deeper insights into your customer service performance,\
 Atlas is equipped to meet those challenges. With Atlas, your support team can be empowered to provide a best-in-class customer experience that fosters\
-loyalty and drives business success.""",
-    messages=[
-        {"role": "user", "content": prompt}
-    ]
-)
+loyalty and drives business success."""
+    )
 
-    output = response.content[0].text.replace('\n', ' ')
+    output = output.replace('\n', ' ')
     return json.dumps({"response": output})
 
-def process_individual_file(input_folder_path, output_folder_path):
-    # Create the output folder if it doesn't exist
-    os.makedirs(output_folder_path, exist_ok=True)
-
-    for file_name in os.listdir(input_folder_path):
-        if file_name.endswith('.csv'):
-            input_file = os.path.join(input_folder_path, file_name)
-            output_file = os.path.join(output_folder_path, file_name)
-
-            with open(input_file, 'r', newline='', encoding='utf-8') as input_file:
-                reader = csv.DictReader(input_file)
-                data = list(reader)
-
-                # Check if data list is empty
-                if data:
-                    # Generate the prompt based on your requirements
-                    prompt = f"""Generate a report covering the period from {data[0]['Date & Time']} to {data[-1]['Date & Time']} in the {file_name} file.\
-Provide an overview of the discussions, questions, and engagements during that time, with the aim of capturing valuable\
-insights to support Atlas's goal of leveraging conversations from the Support-Driven community to engage with its members.\
-The aim of this report is to capture the key discussions, questions, and engagements in the Channel from {data[0]['Date & Time']} to {data[-1]['Date & Time']},\
-aligned with Atlas's goal of leveraging conversations from the Support-Driven community. The report aims to assist in solving important issues, building trust,\
-and raising awareness about Atlas by providing valuable insights and recommendations based on the discussions.\
-
-Context: The report covers the {file_name} data Channel from {data[0]['Date & Time']} to {data[-1]['Date & Time']}, focusing on discussions relevant to Atlas's aim of\
-leveraging conversations from the Support-Driven community. The report aims to provide insights into the discussions and engagement within the community,\
-supporting Atlas's goal of solving important issues, building trust, and raising awareness about the platform. The discussion group comprises founders,\
-product managers, CXOs, and other experts with knowledge and expertise in customer experience, technology, and development.\
-
-Instructions for Responding:\
+def format_thread_engagement(thread_index, data, limit=20):
+    """
+    Lists the exact reply and reaction counts of the most engaging threads from the
+    thread index, so the report does not depend on the model counting rows.
+    """
+    if not thread_index or not thread_index.get('threads'):
+        return ''
+
+    threads = sorted(thread_index['threads'].values(),
+                     key=lambda thread: (thread['reply_count'] + thread['total_reactions'], thread['reply_count']),
+                     reverse=True)[:limit]
+    lines = []
+    for thread in threads:
+        if thread['first_row'] >= len(data):
+            continue
+        first_row = data[thread['first_row']]
+        text = ' '.join((first_row['Text Message'] or '').split())[:100]
+        lines.append(f"{first_row['Thread Date & Time']} | {thread['reply_count']} | {thread['total_reactions']} | "
+                     f"{', '.join(thread['participants'])} | {text}")
+
+    header = ("Exact engagement of the most active threads (Thread Date & Time | Replies | Reactions | Participants | Start of thread). "
+              "Use these numbers for Reactions, Replies and Participants:")
+    return '\n' + header + '\n' + '\n'.join(lines) + '\n'
+
+REPORT_INSTRUCTIONS = """Instructions for Responding:\
 Return the response in JSON format with the following keys:\
-{{
+{
 "Summary": "Summarize the topics discussed during <Start Date> to <End Date>",
 "ReportingPeriod": "From <Start Date> to <End Date>",
 "TopQuestions": [
-{{
+{
 "Question": "Question 1",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies"
-}},
-{{
+},
+{
 "Question": "Question 2",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies"
-}},
-{{
+},
+{
 "Question": "Question 3",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies"
-}},
-{{
+},
+{
 "Question": "Question 4",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies"
-}},
-{{
+},
+{
 "Question": "Question 5",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies"
-}}
+}
 ],
-"MostEngagingDiscussion": {{
+"MostEngagingDiscussion": {
 "Discussion": "Title of the most engaging discussion",
 "Reactions": "Number of reactions",
 "Replies": "Number of replies",
 "Participants": ["Participant 1", "Participant 2"]
-}},
+},
 "ActiveParticipants": [
-{{
+{
 "Name": "Participant Name",
 "Contributions": "Description of contributions",
 "Expertise": "Area of expertise"
-}}
+}
 ],
-{{"EmergingTrends": "Description of any emerging trends or recurring challenges discussed during the specified period that can inform Atlas's strategy.",
+{"EmergingTrends": "Description of any emerging trends or recurring challenges discussed during the specified period that can inform Atlas's strategy.",
 "BlogOpportunities": "Identify any blog article opportunities for Atlas"
 "Recommendations": "Potential solutions or recommendations based on the discussions to support Atlas in achieving its aim of engaging with the Support-Driven community."
-}}
-}}
+}
+}
 
 Do not use coding syntax markers like <```json> around your response.\
 Do not add extra commentary except the JSON response.\
@@ -159,48 +181,245 @@ Objective:
 5. Identify any emerging trends or recurring challenges discussed that can inform Atlas's strategy and support in solving important issues.\
 6. Identify any blog article opportunities for Atlas.\
 7. Provide potential solutions or recommendations based on the discussions to support Atlas in achieving its aim of engaging with the Support-Driven community.\
+"""
+
+# Estimated tokens of channel rows sent in one report prompt; busier channels are summarised in chunks
+REPORT_TOKEN_BUDGET = int(os.getenv('REPORT_TOKEN_BUDGET', '50000'))
+# Most partial reports merged by one prompt
+REPORT_REDUCE_FANIN = int(os.getenv('REPORT_REDUCE_FANIN', '8'))
+
+REPORT_TOOL = json_tool("record_channel_report", "Records the report of the channel.", {
+    "Summary": {"type": "string"},
+    "ReportingPeriod": {"type": "string"},
+    "TopQuestions": {"type": "array", "items": {"type": "object", "properties": string_properties(["Question", "Reactions", "Replies"])}},
+    "MostEngagingDiscussion": {"type": "object", "properties": dict(string_properties(["Discussion", "Reactions", "Replies"]),
+                                                                    Participants={"type": "array", "items": {"type": "string"}})},
+    "ActiveParticipants": {"type": "array",
+                           "items": {"type": "object", "properties": string_properties(["Name", "Contributions", "Expertise"])}},
+    "EmergingTrends": {"type": "string"},
+    "BlogOpportunities": {"type": "string"},
+    "Recommendations": {"type": "string"},
+}) if LLM_STRUCTURED_OUTPUT else None
+
+# Without the tool the other keys may be nested differently, so only these are checked
+REPORT_REQUIRED_KEYS = ["Summary", "ReportingPeriod"]
+
+def build_report_prompt(file_name, data, engagement):
+    # The fixed report instructions are sent ahead of this prompt as a cached prefix;
+    # the rows are sent in the compact encoding of message_encoder
+    return f"""Generate a report covering the period from {data[0]['Date & Time']} to {data[-1]['Date & Time']} in the {file_name} file.\
+Provide an overview of the discussions, questions, and engagements during that time, with the aim of capturing valuable\
+insights to support Atlas's goal of leveraging conversations from the Support-Driven community to engage with its members.\
+The aim of this report is to capture the key discussions, questions, and engagements in the Channel from {data[0]['Date & Time']} to {data[-1]['Date & Time']},\
+aligned with Atlas's goal of leveraging conversations from the Support-Driven community. The report aims to assist in solving important issues, building trust,\
+and raising awareness about Atlas by providing valuable insights and recommendations based on the discussions.\
 
+Context: The report covers the {file_name} data Channel from {data[0]['Date & Time']} to {data[-1]['Date & Time']}, focusing on discussions relevant to Atlas's aim of\
+leveraging conversations from the Support-Driven community. The report aims to provide insights into the discussions and engagement within the community,\
+supporting Atlas's goal of solving important issues, building trust, and raising awareness about the platform. The discussion group comprises founders,\
+product managers, CXOs, and other experts with knowledge and expertise in customer experience, technology, and development.\
+
+{engagement}
 Message:
-<{data}>
+<{encode_rows(data)}>
 """
 
-                    # Get the completion from the ChatGPT API
-                    response = get_completion(prompt)
-                    print(response)
-
-                    try:
-                        # Parse the JSON response
-                        report_data = json.loads(json.loads(response)["response"])
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON: {response}")
-                        continue
-
-                    # Write the report data to a CSV file
-                    fieldnames = list(report_data.keys())
-                    with open(output_file, 'w', newline='', encoding='utf-8') as output_file:
-                        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
-                        writer.writeheader()
-                        writer.writerow(report_data)
+def build_partial_report_prompt(file_name, chunk, part, parts, aliases):
+    return f"""Generate a partial report covering the messages from {chunk[0]['Date & Time']} to {chunk[-1]['Date & Time']} in the {file_name} file.\
+These messages are part {part} of {parts} of the channel's messages for the period, and the partial reports are merged into one report afterwards.\
+Only report what is in these messages, and keep the exact numbers of reactions and replies.\
+
+Message:
+<{encode_rows(chunk, aliases)}>
+"""
+
+def build_merge_report_prompt(file_name, data, partial_reports, engagement):
+    return f"""Merge the partial reports below into a single report covering the period from {data[0]['Date & Time']} to {data[-1]['Date & Time']} in the {file_name} file.\
+Each partial report covers consecutive messages of the channel. Combine their summaries, keep the 5 questions with the most reactions and replies across all parts,\
+pick the single most engaging discussion, and merge the active participants, trends, blog opportunities and recommendations without duplicates.\
+{engagement}
+Partial reports:
+<{json.dumps(partial_reports, ensure_ascii=False)}>
+"""
+
+def estimate_tokens(text):
+    # About four characters per token is close enough to size a chunk
+    return len(text) // 4 + 1
+
+def chunk_rows(data, token_budget):
+    """
+    Splits the rows of a channel into chunks of at most token_budget estimated tokens.
+    Rows are ordered by thread, and chunks are only cut between threads unless a
+    single thread is over the budget.
+    """
+    chunks = []
+    chunk, tokens = [], 0
+
+    def add(rows, cost):
+        nonlocal chunk, tokens
+        if chunk and tokens + cost > token_budget:
+            chunks.append(chunk)
+            chunk, tokens = [], 0
+        chunk.extend(rows)
+        tokens += cost
+
+    for _, thread in groupby(data, key=itemgetter('Thread Date & Time')):
+        thread = list(thread)
+        # The text plus the time, user alias and reactions of the encoded line
+        costs = [estimate_tokens(clean_text(row['Text Message'])) + 8 for row in thread]
+        if sum(costs) <= token_budget:
+            add(thread, sum(costs))
+        else:
+            for row, cost in zip(thread, costs):
+                add([row], cost)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def parse_report(response, reask=None):
+    print(response)
+    # Parse the JSON response, repairing it locally or asking again when it cannot be used
+    report, error = parse_reply(json.loads(response)["response"], required_keys(REPORT_REQUIRED_KEYS), reask)
+    if error is not None:
+        print(f"Error parsing JSON ({error}): {response}")
+    return report
+
+def report_completion(prompt):
+    """
+    :return: The report dict of the prompt, or None when it could not be parsed.
+    """
+    def reask(reply, error):
+        return json.loads(get_completion(correction_prompt(prompt, reply, error), instructions=REPORT_INSTRUCTIONS,
+                                         tool=REPORT_TOOL))["response"]
+    return parse_report(get_completion(prompt, instructions=REPORT_INSTRUCTIONS, tool=REPORT_TOOL), reask)
+
+def merge_reports(file_name, data, partial_reports, engagement=''):
+    return report_completion(build_merge_report_prompt(file_name, data, partial_reports, engagement))
+
+def generate_report(file_name, data, engagement):
+    """
+    Generates the report of a channel file. Rows that fit REPORT_TOKEN_BUDGET go into one
+    prompt; larger channels are split along thread boundaries, the chunks are summarised in
+    parallel and the partial reports are merged, REPORT_REDUCE_FANIN at a time.
+    :return: The report dict, or None when it could not be parsed.
+    """
+    chunks = chunk_rows(data, REPORT_TOKEN_BUDGET)
+    if len(chunks) == 1:
+        return report_completion(build_report_prompt(file_name, data, engagement))
+
+    print(f"Summarising {len(data)} rows of {file_name} in {len(chunks)} chunks")
+    # Users keep the same alias in every chunk
+    aliases = UserAliases()
+    partial_reports = map_concurrently(
+        lambda part: report_completion(build_partial_report_prompt(file_name, chunks[part], part + 1, len(chunks), aliases)),
+        range(len(chunks)))
+    partial_reports = [report for report in partial_reports if report is not None]
+
+    while len(partial_reports) > REPORT_REDUCE_FANIN:
+        groups = [partial_reports[i:i + REPORT_REDUCE_FANIN] for i in range(0, len(partial_reports), REPORT_REDUCE_FANIN)]
+        partial_reports = [report for report in map_concurrently(lambda group: merge_reports(file_name, data, group), groups)
+                           if report is not None]
+
+    if not partial_reports:
+        print(f"No partial report of {file_name} could be parsed")
+        return None
+    # The exact engagement numbers only go into the final merge
+    return merge_reports(file_name, data, partial_reports, engagement)
+
+def process_individual_file(input_folder_path, output_folder_path, deadline=None, checkpoint=None):
+    """
+    Writes the report of every channel file. The report of each file is saved to the
+    checkpoint as soon as it is generated, and files already reported in the checkpoint are
+    not analysed again. When the deadline leaves no time for another file, it stops.
+    :return: Whether every file was reported.
+    """
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_folder_path, exist_ok=True)
+    checkpoint = checkpoint if checkpoint is not None else Checkpoint(None, None)
+    reports = checkpoint.state.setdefault('reports', {})
+    generated = 0
+
+    # Files are taken in the same order by every invocation of a run
+    for file_name in sorted(os.listdir(input_folder_path)):
+        if file_name.endswith('.csv'):
+            input_file = os.path.join(input_folder_path, file_name)
+            output_file = os.path.join(output_folder_path, file_name)
+
+            if file_name in reports:
+                report_data = reports[file_name]
+            else:
+                # Every invocation reports at least one file, so a run always makes progress
+                if deadline is not None and generated and deadline.expired():
+                    print(f"Stopping after {len(reports)} channel files before the deadline")
+                    return False
+                if deadline is not None:
+                    deadline.start_step()
+
+                thread_index = load_thread_index(os.path.splitext(input_file)[0] + THREAD_INDEX_SUFFIX)
+
+                with open(input_file, 'r', newline='', encoding='utf-8') as input_file:
+                    reader = csv.DictReader(input_file)
+                    data = list(reader)
+
+                # Check if data list is empty
+                if data:
+                    engagement = format_thread_engagement(thread_index, data)
+
+                    # Summarise the rows in one prompt, or in chunks that are merged for busy channels
+                    report_data = generate_report(file_name, data, engagement)
                 else:
                     print(f"No data found in {input_file}. Skipping file.")
+                    report_data = None
+
+                reports[file_name] = report_data
+                checkpoint.save()
+                generated += 1
+                if deadline is not None:
+                    deadline.end_step()
+
+            if report_data is None:
+                continue
+
+            # Write the report data to a CSV file
+            fieldnames = list(report_data.keys())
+            with open(output_file, 'w', newline='', encoding='utf-8') as output_file:
+                writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerow(report_data)
+    return True
+
+def iter_file_rows(file_path, extract_row):
+    # Open the JSON file and convert the messages to (sort key, row) pairs one at a time
+    with open(file_path, 'r', encoding='utf-8') as f:
+        yield from iter_keyed_rows(iter_json_array(f), extract_row)
+
+def merge_folder_rows(folder_path, extract_row):
+    """
+    Merges the day files of a channel folder into one stream ordered by (thread_ts, ts).
+    Every day file is sorted as its own run and spilled to a temp file; day files are already
+    in ts order, so each run sort is close to linear. The runs are then k-way merged from disk,
+    which places replies to threads started on earlier days under their parent while holding
+    one row per day file in memory.
+    """
+    runs = []
+    # Iterate over the files within the subfolder
+    for file_name in sorted(os.listdir(folder_path)):
+        # Check if the current item is a JSON file
+        if file_name.endswith('.json'):
+            file_path = os.path.join(folder_path, file_name)
+            runs.append(spilled_run(iter_file_rows(file_path, extract_row), key=itemgetter(0)))
+    return heapq.merge(*runs, key=itemgetter(0))
 
 def convert_json_to_csv(input_folder, output_folder):
 
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    # Specify the selected folders to process
-    selected_folders = ['chit-chat', 'chat-highlights', 'welcome-and-introductions', 'job-board', 'leadership',
-                        'career-development', 'customer-experience', 'customer-success', 'knowledge-management',
-                        'u-zendesk', 'support-operations', 'events', 'technology', 'about', 'vent',
-                        'zlocal-remote', 'metrics-data-kpis', 'good-news', 'quality', 'bulletin-board', 'onboarding',
-                        'product-management', 'outsourcing']
-
-    # Specify the field names to extract from the JSON file"
-    selected_fields = ["Thread Id","Date & Time","User's Name","Text Message","Thread Date & Time","Message Type","Total Reactions"]
+    # Resolve the extractors of the selected fields once
+    extract_row = compile_row_extractor(SELECTED_FIELDS)
 
     # Iterate over the selected folders
-    for folder_name in selected_folders:
+    for folder_name in SELECTED_FOLDERS:
         folder_path = os.path.join(input_folder, folder_name)
 
         # Check if the selected folder exists
@@ -208,94 +427,62 @@ def convert_json_to_csv(input_folder, output_folder):
             # Specify the path for the corresponding CSV file
             csv_file = os.path.join(output_folder, folder_name + '.csv')
 
-            # Iterate over the files within the subfolder
-            rows = []  # List to store rows before sorting
-            for file_name in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, file_name)
-
-                # Check if the current item is a JSON file
-                if file_name.endswith('.json'):
-                    # Open the JSON file and load the data
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-
-                        # Convert each JSON object to a CSV row
-                        for obj in data:
-                            selected_data = {}
-                            # Skip the entire row if subtype is channel join
-                            if obj.get('subtype') == 'channel_join':
-                                continue
-                            for field in selected_fields:
-                                if field == 'Date & Time':
-                                    if 'ts' in obj:
-                                        timestamp = float(obj['ts'])
-                                        utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                                        ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                                        selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                                elif field == "User's Name":
-                                    selected_data[field] = obj.get('user_profile', {}).get('real_name')
-                                elif field == 'Text Message':
-                                        selected_data[field] = obj.get('text')
-                                elif field == 'Thread Date & Time':
-                                    if 'thread_ts' in obj:
-                                        timestamp = float(obj['thread_ts'])
-                                        utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                                        ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                                        selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                                    else:
-                                        timestamp = float(obj['ts'])
-                                        utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                                        ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                                        selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                                elif field == 'Thread Id':
-                                    selected_data[field] = obj.get('ts')
-                                elif field == 'Message Type':
-                                    if 'parent_user_id' not in obj:
-                                        selected_data[field] = 'Primary Message'
-                                    else:
-                                        selected_data[field] = 'Reply'
-                                elif field == 'Total Reactions':
-                                    reactions = obj.get('reactions')
-                                    reaction_count = sum(reaction['count'] for reaction in reactions) if reactions else 0
-                                    selected_data[field] = reaction_count
-                                else:
-                                    selected_data[field] = None
-
-                            rows.append(selected_data)
-
-            # Sort the rows based on the "Thread Date & Time" column first, and then by "Date & Time"
-            rows.sort(key=lambda x: (datetime.strptime(x.get('Thread Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Thread Date & Time') else datetime.min,
-                                    datetime.strptime(x.get('Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Date & Time') else datetime.min))
+            # Merge the per-day runs on the numeric thread ts first, and then on the message ts,
+            # writing rows as they come out of the merge
+            keyed_rows = merge_folder_rows(folder_path, extract_row)
 
             # Open the CSV file and write headers using specified fields
+            thread_index = ThreadIndexBuilder()
             with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=selected_fields)
+                writer = csv.DictWriter(f, fieldnames=SELECTED_FIELDS)
                 writer.writeheader()
-                # Write the sorted rows to the CSV file
-                writer.writerows(rows)
+                # Write the sorted rows to the CSV file, indexing the threads in the same pass
+                for key, row in keyed_rows:
+                    writer.writerow(row)
+                    thread_index.add(key, row)
+
+            # Write the thread index next to the CSV file
+            with open(os.path.join(output_folder, folder_name + THREAD_INDEX_SUFFIX), 'w', encoding='utf-8') as f:
+                f.write(thread_index.dumps())
 
-def upload_dir_to_s3(local_dir, bucket_name, s3_client, s3_prefix):
+def convert_parquet_to_csv(source, output_folder, since_ts):
     """
-    Recursively uploads a local directory to an S3 bucket with a specified prefix.
-    :param local_dir: The local directory to upload.
-    :param bucket_name: The name of the S3 bucket.
-    :param s3_client: The Boto3 S3 client.
-    :param s3_prefix: The prefix to use as a virtual directory in the S3 bucket.
+    Writes the same per-channel CSVs and thread index sidecars as convert_json_to_csv from the
+    Parquet dataset, reading only the CSV columns of one channel and of messages newer than since_ts.
     """
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            s3_file_path = os.path.join(s3_prefix, os.path.relpath(local_file_path, local_dir))
-            try:
-                s3_client.upload_fileobj(open(local_file_path, 'rb'), bucket_name, s3_file_path)
-            except ClientError as e:
-                print(f"Error uploading file {local_file_path} to S3: {e}")
-
-
+    if ds is None:
+        raise RuntimeError('pyarrow is required to read PARQUET_SOURCE')
+    os.makedirs(output_folder, exist_ok=True)
+    # The dataset is listed once and filtered per channel
+    dataset = open_dataset(source)
+
+    for folder_name in SELECTED_FOLDERS:
+        keyed_rows = list(read_rows(dataset, columns=list(CSV_FIELDS),
+                                    filter=(ds.field('channel') == folder_name) & (ds.field('ts') >= since_ts),
+                                    sort_by=[('thread_ts', 'ascending'), ('ts', 'ascending')], with_keys=True))
+        if not keyed_rows:
+            continue
+
+        csv_file = os.path.join(output_folder, folder_name + '.csv')
+        thread_index = ThreadIndexBuilder()
+        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=SELECTED_FIELDS)
+            writer.writeheader()
+            for key, row in keyed_rows:
+                writer.writerow(row)
+                thread_index.add(key, row)
+
+        with open(os.path.join(output_folder, folder_name + THREAD_INDEX_SUFFIX), 'w', encoding='utf-8') as f:
+            f.write(thread_index.dumps())
 
 def lambda_handler(event, context):
-    # Calculate time and construct the file name
-    a_week_ago = datetime.now(pytz.timezone('UTC')) - timedelta(weeks=1)
+    # Calculate time and construct the file name; a continuation analyses the same week as the run it continues
+    continuation = event.get('continuation')
+    if continuation:
+        a_week_ago = datetime.fromisoformat(continuation['since'])
+        print(f"Continuing the analysis of the week since {a_week_ago.isoformat()}")
+    else:
+        a_week_ago = datetime.now(pytz.timezone('UTC')) - timedelta(weeks=1)
     formatted_date = a_week_ago.strftime('%Y-%m-%dT%H:%M:%S')
     ist_time = pytz.timezone('Asia/Kolkata')
     timestamp = a_week_ago.astimezone(ist_time).strftime('%Y-%m-%d-%H-%M-%S')
@@ -307,39 +494,88 @@ def lambda_handler(event, context):
     cookie = os.getenv('COOKIE')
     slack_token = os.getenv('SLACK_TOKEN')
     
-    command = ['./slackdump', '-cookie', cookie, '-t', slack_token, '-dump-from', formatted_date, '-export', export_dir, '@channels.txt']
-    result = subprocess.run(command, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    print(result.stdout)
-    print(result.stderr)
+    output_folder = f"/tmp/{export_filename}_extracted_csv"
+    # Set once the CSVs of this run are staged for its continuations
+    staged_prefix = continuation.get('staged_prefix') if continuation else None
+    if staged_prefix:
+        # The export and conversion of the run were done by its first invocation
+        summary = download_dir_from_s3(RUN_STAGING_BUCKET, staged_prefix, output_folder)
+        exported = summary['files'] > 0 and not summary['failed']
+        if not exported:
+            return {
+                'statusCode': 500,
+                'body': 'Error reading the staged CSV files of the run'
+            }
+    elif PARQUET_SOURCE:
+        # The converter already holds the week as Parquet, so no new export is needed
+        convert_parquet_to_csv(PARQUET_SOURCE, output_folder, a_week_ago.timestamp())
+        print('CSV files written from {}'.format(PARQUET_SOURCE))
+        exported = True
+    else:
+        command = ['./slackdump', '-cookie', cookie, '-t', slack_token, '-dump-from', formatted_date, '-export', export_dir, '@channels.txt']
+        result = subprocess.run(command, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        print(result.stdout)
+        print(result.stderr)
 
-    # Check if the export directory was created
-    if os.path.exists(export_dir):
-        print('Slack messages exported to {}'.format(export_dir))
+        # Check if the export directory was created
+        exported = os.path.exists(export_dir)
+        if exported:
+            print('Slack messages exported to {}'.format(export_dir))
 
-        try:
-            input_folder = export_dir
-            output_folder = f"/tmp/{export_filename}_extracted_csv"
-            convert_json_to_csv(input_folder, output_folder)
-            print(os.listdir(output_folder))
-            print('CSV files written successfully')
-        except ClientError as e:
-            print('Error writing CSV files')
+            try:
+                input_folder = export_dir
+                convert_json_to_csv(input_folder, output_folder)
+                print(os.listdir(output_folder))
+                print('CSV files written successfully')
+            except ClientError as e:
+                print('Error writing CSV files')
 
+    if exported:
         try:
             input_folder_path  = output_folder
             output_folder_path = f"/tmp/{export_filename}_channels_analyzed_csv"
-            process_individual_file(input_folder_path, output_folder_path)
+            # Reports are checkpointed per file, so a run that would outlast the timeout continues in a new invocation
+            checkpoint = Checkpoint.load(get_checkpoint_store(), export_filename)
+            completed = process_individual_file(input_folder_path, output_folder_path, Deadline(context), checkpoint)
+            maybe_evict()
+            print(f"LLM usage: {metrics.snapshot()}")
+            print(f"Reply parsing: {parse_stats.snapshot()}")
+            if not completed:
+                if staged_prefix is None:
+                    staged_prefix = f"{RUN_STAGING_PREFIX}{export_filename}/"
+                    if upload_dir_to_s3(output_folder, RUN_STAGING_BUCKET, get_s3_client(), staged_prefix)['failed']:
+                        return {
+                            'statusCode': 500,
+                            'body': 'Error staging the CSV files for the next invocation'
+                        }
+                if reinvoke(context, {'continuation': {'since': a_week_ago.isoformat(), 'staged_prefix': staged_prefix}}):
+                    return {
+                        'statusCode': 202,
+                        'body': 'Analysis continues in a new invocation'
+                    }
+                return {
+                    'statusCode': 500,
+                    'body': 'Error continuing the analysis of channels files'
+                }
             print('Channels files analyzed successfully')
         except ClientError as e:
             print('Error analysing channels files')
 
-        # Create an S3 client
-        s3 = boto3.client('s3')
+        # Reuse the pooled S3 client of this container
+        s3 = get_s3_client()
 
         # Upload the directory to S3
         try:
-            upload_dir_to_s3(output_folder_path, 'slackdumpchannelsanalysiscsv', s3, s3_prefix)
+            summary = upload_dir_to_s3(output_folder_path, 'slackdumpchannelsanalysiscsv', s3, s3_prefix)
+            if summary['failed']:
+                return {
+                    'statusCode': 500,
+                    'body': f"Error uploading {len(summary['failed'])} files to S3"
+                }
             print(f"Uploaded {output_folder_path} to S3 bucket 'slackdumpchannelsanalysiscsv' with prefix '{s3_prefix}'")
+            checkpoint.clear()
+            if staged_prefix:
+                delete_prefix_from_s3(RUN_STAGING_BUCKET, staged_prefix, s3)
         except ClientError as e:
             print(f"Error uploading directory to S3: {e}")
             return {
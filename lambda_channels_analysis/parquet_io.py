@@ -0,0 +1,134 @@
+import os
+import io
+from datetime import datetime
+import pytz
+
+# pyarrow is optional and usually provided as a Lambda layer; Parquet output is off without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = pq = ds = None
+
+EMIT_PARQUET = os.getenv('EMIT_PARQUET', 'false').lower() in ('1', 'true', 'yes')
+PARQUET_ROW_GROUP_SIZE = int(os.getenv('PARQUET_ROW_GROUP_SIZE', '50000'))
+
+IST = pytz.timezone('Asia/Kolkata')
+
+# Parquet column -> CSV field, in CSV order
+CSV_FIELDS = {
+    'thread_id': "Thread Id",
+    'ts': "Date & Time",
+    'user_name': "User's Name",
+    'text_message': "Text Message",
+    'thread_ts': "Thread Date & Time",
+    'message_type': "Message Type",
+    'total_reactions': "Total Reactions",
+}
+
+def get_schema():
+    return pa.schema([
+        ('thread_id', pa.string()),
+        ('ts', pa.float64()),
+        ('thread_ts', pa.float64()),
+        ('user_name', pa.dictionary(pa.int32(), pa.string())),
+        ('text_message', pa.string()),
+        ('message_type', pa.dictionary(pa.int8(), pa.string())),
+        ('total_reactions', pa.int32()),
+    ])
+
+def parquet_enabled():
+    if EMIT_PARQUET and pa is None:
+        print('EMIT_PARQUET is set but pyarrow is not installed, skipping Parquet output')
+    return EMIT_PARQUET and pa is not None
+
+def partition_key(json_key):
+    """
+    Maps an export key such as <prefix>/<channel>/<YYYY-MM-DD>.json to a Hive-style
+    channel=<channel>/date=<YYYY-MM-DD>/<prefix>.parquet key.
+    """
+    parts = json_key.split('/')
+    date = os.path.splitext(parts[-1])[0]
+    channel = parts[-2] if len(parts) >= 2 else 'unknown'
+    run = '_'.join(parts[:-2]) or 'export'
+    return f"channel={channel}/date={date}/{run}.parquet"
+
+class ParquetRowWriter:
+    """
+    Collects converted rows with their numeric (thread_ts, ts) sort key and writes them
+    as typed Parquet row groups into an in-memory buffer.
+    """
+    def __init__(self, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        self.schema = get_schema()
+        self.buffer = io.BytesIO()
+        self.writer = pq.ParquetWriter(self.buffer, self.schema, compression='zstd')
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name in self.schema.names}
+
+    def add(self, key, row):
+        thread_ts, ts = key
+        self.columns['thread_id'].append(row["Thread Id"])
+        self.columns['ts'].append(ts)
+        self.columns['thread_ts'].append(thread_ts)
+        self.columns['user_name'].append(row["User's Name"])
+        self.columns['text_message'].append(row["Text Message"])
+        self.columns['message_type'].append(row["Message Type"])
+        self.columns['total_reactions'].append(row["Total Reactions"])
+        if len(self.columns['ts']) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns['ts']:
+            return
+        table = pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        """
+        Finishes the file and returns the buffer positioned at its start.
+        """
+        self.flush()
+        self.writer.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts, IST).strftime('%Y-%m-%d %H:%M:%S') if ts is not None else None
+
+def open_dataset(source, filesystem=None):
+    """
+    Opens the channel=/date= partitioned dataset, listing its files once.
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is required to read Parquet datasets')
+    return ds.dataset(source, format='parquet', partitioning='hive', filesystem=filesystem)
+
+def read_rows(source, columns=None, filter=None, sort_by=None, filesystem=None, with_keys=False):
+    """
+    Reads converted messages back from a Parquet dataset as CSV-shaped rows.
+    :param source: A path or s3:// URI of the channel=/date= partitioned dataset, or a dataset
+                   from open_dataset when it is read several times.
+    :param columns: The Parquet columns to read; only these are fetched from storage.
+    :param filter: A pyarrow dataset expression, such as ds.field('channel') == 'events',
+                   pushed down to the partitions and row-group statistics.
+    :param sort_by: Optional (column, 'ascending'/'descending') pairs to order the rows by.
+    :param filesystem: An optional pyarrow filesystem.
+    :param with_keys: Whether to yield the numeric (thread_ts, ts) sort key with every row;
+                      columns must then include ts and thread_ts.
+    :return: An iterator of dicts keyed by the CSV field names, or of (key, row) pairs.
+    """
+    dataset = source if ds is not None and isinstance(source, ds.Dataset) else open_dataset(source, filesystem)
+    if sort_by:
+        batches = dataset.to_table(columns=columns, filter=filter).sort_by(sort_by).to_batches()
+    else:
+        batches = dataset.to_batches(columns=columns, filter=filter)
+    for batch in batches:
+        for record in batch.to_pylist():
+            row = {}
+            for name, value in record.items():
+                if name in ('ts', 'thread_ts'):
+                    value = format_ts(value)
+                row[CSV_FIELDS.get(name, name)] = value
+            yield ((record['thread_ts'], record['ts']), row) if with_keys else row
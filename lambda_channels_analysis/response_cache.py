@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import boto3
+from botocore.exceptions import ClientError, BotoCoreError
+
+# 's3' keeps responses in a bucket shared by all containers, 'sqlite' in a local file, 'off' disables the cache
+LLM_CACHE_BACKEND = os.getenv('LLM_CACHE_BACKEND', 's3')
+# The state bucket triggers no function, unlike the output buckets watched by the Sheets lambdas
+LLM_CACHE_BUCKET = os.getenv('LLM_CACHE_BUCKET', 'slackdumpanalysisstate')
+LLM_CACHE_PREFIX = os.getenv('LLM_CACHE_PREFIX', '_llm_cache/')
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', '/tmp/llm_response_cache.sqlite3')
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '50000'))
+# Eviction lists the whole cache, so a warm container runs it at most this often
+LLM_CACHE_EVICT_INTERVAL_SECONDS = int(os.getenv('LLM_CACHE_EVICT_INTERVAL_SECONDS', str(24 * 3600)))
+
+_cache = None
+_cache_lock = threading.Lock()
+_last_evict = 0.0
+
+def strip_cache_control(value):
+    if isinstance(value, dict):
+        return {k: strip_cache_control(v) for k, v in value.items() if k != 'cache_control'}
+    if isinstance(value, list):
+        return [strip_cache_control(v) for v in value]
+    return value
+
+def cache_key(request):
+    """
+    Hashes the Messages API parameters (model, system, messages, max_tokens and the rest).
+    Prompt caching markers are left out, so turning them on or off keeps the cached responses.
+    """
+    canonical = json.dumps(strip_cache_control(request), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+
+    def add(self, name, count=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'puts': self.puts, 'evictions': self.evictions}
+
+class SQLiteResponseCache:
+    """
+    Local SQLite stand-in for S3ResponseCache. Entries expire after ttl_seconds and the least
+    recently used ones are evicted beyond max_entries.
+    """
+    def __init__(self, path, ttl_seconds=LLM_CACHE_TTL_SECONDS, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, text TEXT, '
+                                    'created_at REAL, accessed_at REAL)')
+
+    def get(self, key):
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT text, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                row = None
+            if row is not None:
+                self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        self.stats.add('hits' if row is not None else 'misses')
+        return row[0] if row is not None else None
+
+    def put(self, key, text, model=None):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, model, text, now, now))
+        self.stats.add('puts')
+
+    def evict(self):
+        with self.lock, self.connection:
+            expired = self.connection.execute('DELETE FROM responses WHERE created_at < ?',
+                                              (time.time() - self.ttl_seconds,)).rowcount
+            overflow = self.connection.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)).rowcount
+        self.stats.add('evictions', expired + overflow)
+        return expired + overflow
+
+class S3ResponseCache:
+    """
+    Keeps one small JSON object per response under <prefix><key[:2]>/<key>.json. Entries expire
+    after ttl_seconds and the oldest ones are evicted beyond max_entries; an S3 lifecycle rule
+    on the prefix can take over the TTL part.
+    """
+    def __init__(self, bucket_name, prefix, s3_client=None, ttl_seconds=LLM_CACHE_TTL_SECONDS,
+                 max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client or boto3.client('s3')
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+
+    def object_key(self, key):
+        return f"{self.prefix}{key[:2]}/{key}.json"
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.object_key(key))
+            entry = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f"Error reading cached response {key}: {e}")
+            entry = None
+        except (BotoCoreError, ValueError) as e:
+            print(f"Error reading cached response {key}: {e}")
+            entry = None
+
+        if entry is not None and time.time() - entry['created_at'] > self.ttl_seconds:
+            entry = None
+        self.stats.add('hits' if entry is not None else 'misses')
+        return entry['text'] if entry is not None else None
+
+    def put(self, key, text, model=None):
+        body = json.dumps({'model': model, 'text': text, 'created_at': time.time()}, ensure_ascii=False)
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.object_key(key), Body=body.encode('utf-8'),
+                                      ContentType='application/json')
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error caching response {key}: {e}")
+            return
+        self.stats.add('puts')
+
+    def evict(self):
+        objects = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            objects.extend((obj['LastModified'].timestamp(), obj['Key']) for obj in page.get('Contents', []))
+        objects.sort(reverse=True)
+
+        cutoff = time.time() - self.ttl_seconds
+        stale = [key for i, (modified, key) in enumerate(objects) if modified < cutoff or i >= self.max_entries]
+        for i in range(0, len(stale), 1000):
+            self.s3_client.delete_objects(Bucket=self.bucket_name,
+                                          Delete={'Objects': [{'Key': key} for key in stale[i:i + 1000]], 'Quiet': True})
+        self.stats.add('evictions', len(stale))
+        return len(stale)
+
+def get_response_cache():
+    """
+    :return: The response cache of this container, or None when LLM_CACHE_BACKEND is 'off'.
+    """
+    global _cache
+    if LLM_CACHE_BACKEND == 'off':
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if LLM_CACHE_BACKEND == 'sqlite':
+                    _cache = SQLiteResponseCache(LLM_CACHE_PATH)
+                else:
+                    _cache = S3ResponseCache(LLM_CACHE_BUCKET, LLM_CACHE_PREFIX)
+    return _cache
+
+def set_response_cache(cache):
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+def maybe_evict():
+    """
+    Evicts expired and surplus entries at most once per LLM_CACHE_EVICT_INTERVAL_SECONDS.
+    """
+    global _last_evict
+    cache = get_response_cache()
+    if cache is None:
+        return 0
+    if _last_evict and time.monotonic() - _last_evict < LLM_CACHE_EVICT_INTERVAL_SECONDS:
+        return 0
+    _last_evict = time.monotonic()
+    try:
+        evicted = cache.evict()
+    except (ClientError, BotoCoreError, sqlite3.Error) as e:
+        print(f"Error evicting cached responses: {e}")
+        return 0
+    print(f"Evicted {evicted} cached responses")
+    return evicted
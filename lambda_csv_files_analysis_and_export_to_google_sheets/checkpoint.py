@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import boto3
+from botocore.exceptions import ClientError, BotoCoreError
+
+# 's3' keeps checkpoints in a bucket, 'local' in CHECKPOINT_DIR, 'off' only in memory
+CHECKPOINT_BACKEND = os.getenv('CHECKPOINT_BACKEND', 's3')
+# Not the output buckets, where every new object is exported to Sheets
+CHECKPOINT_BUCKET = os.getenv('CHECKPOINT_BUCKET', 'slackdumpanalysisstate')
+CHECKPOINT_PREFIX = os.getenv('CHECKPOINT_PREFIX', '_checkpoints/')
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', '/tmp/checkpoints')
+# Time kept free before the Lambda timeout to save the checkpoint and re-invoke
+DEADLINE_MARGIN_MS = int(os.getenv('DEADLINE_MARGIN_MS', '60000'))
+
+class Deadline:
+    """
+    Tells whether another step still fits before the Lambda timeout. Without a Lambda
+    context, as in local runs, it never expires.
+    """
+    def __init__(self, context, margin_ms=DEADLINE_MARGIN_MS):
+        self.context = context
+        self.margin_ms = margin_ms
+        self.longest_step_ms = 0
+        self.step_started = None
+
+    def remaining_ms(self):
+        if self.context is None or not hasattr(self.context, 'get_remaining_time_in_millis'):
+            return None
+        return self.context.get_remaining_time_in_millis()
+
+    def start_step(self):
+        self.step_started = time.monotonic()
+
+    def end_step(self):
+        if self.step_started is not None:
+            self.longest_step_ms = max(self.longest_step_ms, (time.monotonic() - self.step_started) * 1000)
+            self.step_started = None
+
+    def expired(self):
+        """
+        :return: Whether the longest step so far would run into the margin.
+        """
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining < self.margin_ms + self.longest_step_ms
+
+class S3CheckpointStore:
+    """
+    Keeps every checkpoint as one JSON object under <prefix><name>.json.
+    """
+    def __init__(self, bucket_name, prefix, s3_client=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client or boto3.client('s3')
+
+    def load(self, name):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=f"{self.prefix}{name}.json")
+            return json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f"Error reading checkpoint {name}: {e}")
+        except (BotoCoreError, ValueError) as e:
+            print(f"Error reading checkpoint {name}: {e}")
+        return None
+
+    def save(self, name, state):
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=f"{self.prefix}{name}.json",
+                                      Body=json.dumps(state, ensure_ascii=False).encode('utf-8'),
+                                      ContentType='application/json')
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error saving checkpoint {name}: {e}")
+
+    def delete(self, name):
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=f"{self.prefix}{name}.json")
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error deleting checkpoint {name}: {e}")
+
+class LocalCheckpointStore:
+    """
+    Local-directory stand-in for S3CheckpointStore with the same JSON layout.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def load(self, name):
+        if not os.path.exists(self.path(name)):
+            return None
+        with open(self.path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, name, state):
+        tmp_path = f"{self.path(name)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(name))
+
+    def delete(self, name):
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+def get_checkpoint_store():
+    """
+    :return: The configured store, or None when CHECKPOINT_BACKEND is 'off'.
+    """
+    if CHECKPOINT_BACKEND == 'off':
+        return None
+    if CHECKPOINT_BACKEND == 'local':
+        return LocalCheckpointStore(CHECKPOINT_DIR)
+    return S3CheckpointStore(CHECKPOINT_BUCKET, CHECKPOINT_PREFIX)
+
+def checkpoint_name(key):
+    return key.replace('/', '_')
+
+class Checkpoint:
+    """
+    The state of one run, saved to the store after every step. Without a store it only
+    lives for the invocation.
+    """
+    def __init__(self, store, name, state=None):
+        self.store = store
+        self.name = name
+        self.state = state if state is not None else {}
+
+    @classmethod
+    def load(cls, store, name):
+        state = store.load(name) if store is not None else None
+        if state:
+            print(f"Resuming from checkpoint {name}")
+        return cls(store, name, state)
+
+    def save(self):
+        if self.store is not None:
+            self.store.save(self.name, self.state)
+
+    def clear(self):
+        self.state = {}
+        if self.store is not None:
+            self.store.delete(self.name)
+
+    def mark_done(self, version):
+        """
+        Replaces the state with a marker of the finished run, so a retry of the event that
+        carried this version of the input skips it instead of running it again.
+        """
+        self.state = {'done': version}
+        self.save()
+
+    def is_done(self, version):
+        return version is not None and self.state.get('done') == version
+
+def reinvoke(context, event, lambda_client=None):
+    """
+    Invokes this function again asynchronously with a continuation event.
+    :return: Whether the invocation was accepted.
+    """
+    if context is None or not hasattr(context, 'invoked_function_arn'):
+        print("No Lambda context to re-invoke, the run continues from its checkpoint on the next invocation")
+        return False
+    try:
+        client = lambda_client or boto3.client('lambda')
+        client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                      Payload=json.dumps(event).encode('utf-8'))
+        print(f"Re-invoked {context.invoked_function_arn} to continue")
+        return True
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error re-invoking {context.invoked_function_arn}: {e}")
+        return False
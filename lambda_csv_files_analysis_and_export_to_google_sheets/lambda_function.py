@@ -12,13 +12,29 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
-import anthropic
+from llm_gateway import DEFAULT_MODEL, complete, map_concurrently, message_params, metrics, lookup_response, store_response
+from response_cache import maybe_evict
+from message_encoder import clean_text, encode_rows
+from llm_batch import get_batch_backend, get_batch_store
+from structured_output import (LLM_STRUCTURED_OUTPUT, correction_prompt, json_tool, parse_reply, parse_stats,
+                               required_keys, string_properties)
+from thread_state import get_thread_state_store, plan_thread, rows_hash, thread_state
+from checkpoint import Checkpoint, Deadline, checkpoint_name, get_checkpoint_store, reinvoke
+from near_duplicates import NEAR_DUP_BACKEND, get_near_duplicate_store, minhash
+from message_triage import ROUTE_LLM, ROUTE_PACK, ROUTE_SKIP, TRIAGE_PACK_SIZE, get_triage, skipped_classification
 
 s3_client = boto3.client('s3')
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 CREDENTIALS_FILE = 'client_secret.json'
 
+ANALYZED_BUCKET = 'slackdumpanalyzedfilescsv'
+SUMMARIZED_BUCKET = 'slackdumpthreadsummarizedfilescsv'
+
+# 'sync' calls the API while a file is processed, 'batch' submits the prompts of an invocation
+# as one Message Batch and writes the outputs once a later invocation finds it has ended
+LLM_MODE = os.getenv('LLM_MODE', 'sync')
+
 # Dictionary mapping month names to spreadsheet IDs
 SPREADSHEET_IDS = {
     'April': '1NiTmM6Ke1XrW9gDHJT4Cx5UF5epQp2Q8jNOP0VJkqaw',
@@ -52,7 +68,7 @@ def get_spreadsheet_id(sheet_name):
         print(f"No spreadsheet ID found for {month_name}.")
         return None
 
-def append_data_to_sheet(spreadsheet_id, csv_file, sheet_name):
+def append_data_to_sheet(spreadsheet_id, csv_file, sheet_name, data=None):
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
@@ -82,9 +98,11 @@ def append_data_to_sheet(spreadsheet_id, csv_file, sheet_name):
             else:
                 raise error
 
-        with open(csv_file, 'r') as file:
-            csv_reader = csv.reader(file)
-            data = list(csv_reader)
+        # The handler passes the rows it already parsed, header first
+        if data is None:
+            with open(csv_file, 'r') as file:
+                csv_reader = csv.reader(file)
+                data = list(csv_reader)
 
         # Check if the sheet is empty
         if not values:
@@ -112,15 +130,7 @@ def get_sheet_name_from_key(key):
     else:
         return os.path.splitext(os.path.basename(key))[0]
 
-def get_completion(prompt, model="claude-3-haiku-20240307"):
-
-    api_key = os.environ['CLAUDE_API_KEY']
-    claude_client = anthropic.Client(api_key=api_key)
-
-    response = claude_client.messages.create(
-        model=model,
-        max_tokens=1024,
-        system="""You are a Senior product manager having 10 years of experience and working with Atlas\
+SYSTEM_PROMPT = """You are a Senior product manager having 10 years of experience and working with Atlas\
 - a customer support tool offering a seamless experience for both agents and customers.You overlook Content, Product Growth, Sales and Marketing.\
 
 The information about Atlas is here:\
@@ -161,32 +171,41 @@ Atlas provides founders, CX leaders, and managers with the tools necessary to de
 
 Whether you're looking to streamline your support operations, improve customer engagement, or gain deeper insights into your customer service performance,\
 Atlas is equipped to meet those challenges. With Atlas, your support team can be empowered to provide a best-in-class customer experience that fosters\
-loyalty and drives business success.""",
-    messages=[
-        {"role": "user", "content": prompt}
-    ]
-)
+loyalty and drives business success."""
 
-    output = response.content[0].text.replace('\n', ' ')
-    return json.dumps({"response": output})
+# Shared by the synchronous calls and the batch requests
+COMPLETION_MAX_TOKENS = 1024
+
+def get_completion(prompt, model=DEFAULT_MODEL, instructions=None, max_tokens=COMPLETION_MAX_TOKENS, tool=None):
 
-def process_csv(input_file_path, output_file_path):
+    # The gateway reuses one pooled client per container and retries rate limits and overloads.
+    # The system prompt and the fixed instructions go first and are cached between calls.
+    # With a tool the reply is the JSON of a forced tool call following its schema.
+    output = complete(prompt, system=SYSTEM_PROMPT, prefix=instructions, model=model, max_tokens=max_tokens, tool=tool)
+    return wrap_completion(output)
 
-    parsed_data_list = []
+def wrap_completion(output):
+    output = output.replace('\n', ' ')
+    return json.dumps({"response": output})
 
-    if input_file_path.endswith('.csv'):
+def unwrap_completion(response):
+    return json.loads(response)["response"]
 
-        with open(input_file_path, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
+def completion_params(prompt, model=DEFAULT_MODEL, instructions=None, tool=None):
+    """
+    The Messages API parameters of a get_completion call, used for batch requests.
+    """
+    return message_params(prompt, system=SYSTEM_PROMPT, prefix=instructions, model=model, max_tokens=COMPLETION_MAX_TOKENS,
+                          tool=tool)
 
-            for row in reader:
-                if row['Message Type'] == 'Primary Message':
-                    date_time = row['Date & Time']
-                    user_message = row['Text Message']
-                    thread_date = row['Thread Date & Time']
-                    thread_id = row['Thread Id']
+def reasker(prompt, instructions=None, tool=None, max_tokens=COMPLETION_MAX_TOKENS):
+    """
+    Asks again for one item whose reply could not be used, quoting the reply and the problem.
+    """
+    return lambda reply, error: unwrap_completion(get_completion(correction_prompt(prompt, reply, error),
+                                                                 instructions=instructions, max_tokens=max_tokens, tool=tool))
 
-                    prompt = f"""Quick Overview: We've unofficially collected messages from the Support-Driven Slack community, a forum dedicated to customer support topics. This collection includes both original inquiries and their subsequent responses. Please note that some replies might be tagged as original messages, as members sometimes respond directly in the main channel rather than using the dedicated reply feature.\
+CLASSIFICATION_INSTRUCTIONS = """Quick Overview: We've unofficially collected messages from the Support-Driven Slack community, a forum dedicated to customer support topics. This collection includes both original inquiries and their subsequent responses. Please note that some replies might be tagged as original messages, as members sometimes respond directly in the main channel rather than using the dedicated reply feature.\
 
 Objective: Our aim is to leverage these conversations from the Support-Driven community to engage with its members. Through our participation, we hope to assist in solving important issues, build trust, and raise awareness about Atlas. Our discussion group will comprise founders (with expertise in customer experience and technology/development), product managers, CXOs, among others.\
 
@@ -225,7 +244,7 @@ Conclude by presenting your analysis in a JSON format, incorporating the followi
 Nature of Message, Suitable for Atlas, Reason, Suitable for Team Member, Suitable Member, Classification, Question About, Relevance Score, Summary, Suggested Response
 
 An example of response:\
-{{
+{
 "Nature of Message": "Primary message",
 "Suitable for Atlas": "No",
 "Reason": "This message is related to a violation of the community's Code of Conduct, which is not directly related to Atlas' products or services.",
@@ -236,69 +255,249 @@ An example of response:\
 "Relevance Score": 2,
 "Summary": "A message about a violation of the community's Code of Conduct and a request for the recipient to acknowledge and stop the violation within 48 hours.",
 "Suggested Response": "I understand this is a sensitive issue regarding a violation of the community's code of conduct. As an external party, I don't have the appropriate context to engage directly. However, I would suggest reaching out to the community moderators to resolve this matter in a constructive manner that aligns with the established policies. My role is to provide helpful information about our products, so I'll refrain from further involvement here. Please let me know if there are any other ways I can assist you."
-}}
+}
 
 Do not use coding syntax markers like <```json> around your response.\
 Do not add extra commentary except the JSON response.\
 Take utmost care in using double quotes in the response.\
 
-Message:
-<{user_message}>"""
-
-                    response = get_completion(prompt)
-                    print(response)
-
-                    try:
-                        parsed_data = json.loads(json.loads(response)["response"])
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON: {response}")
-                        continue
-                    
-                    field_mapping = {
-                        "Nature of Message": "Nature of Message",
-                        "Suitable for Atlas": "Should Atlas participate?",
-                        "Reason": "Why?",
-                        "Suitable for Team Member": "Suitable for Team Member?",
-                        "Suitable Member": "Who should Reply?",
-                        "Classification": "Message Classification",
-                        "Question About": "Question Type(If Applicable)",
-                        "Relevance Score": "Relevance Score",
-                        "Summary": "Summary",
-                        "Suggested Response": "Suggested Response",  
-                        }
-
-                    new_parsed_data = {field_mapping[key]: value for key, value in parsed_data.items() if key in field_mapping}
-
-                    new_parsed_data['Date & Time'] = date_time
-                    new_parsed_data['Thread Id'] = thread_id
-                    new_parsed_data['Message'] = user_message
-                    
-                    parsed_data_list.append(new_parsed_data)
+"""
+
+PACKED_CLASSIFICATION_INSTRUCTIONS = CLASSIFICATION_INSTRUCTIONS + """Several messages are sent at once, each inside its own <message id="..."> tag.\
+Analyse every message on its own as described above.\
+Respond with a JSON array holding one object per message, in the order the messages were given.\
+Every object has the keys above plus an "Id" key with the id of its message.\
+
+"""
+
+# Packs up to this many primary messages into one classification request; 1 sends one request per message
+CLASSIFY_PACK_SIZE = int(os.getenv('CLASSIFY_PACK_SIZE', '1'))
+# Estimated input tokens of the messages in one pack
+CLASSIFY_PACK_TOKEN_BUDGET = int(os.getenv('CLASSIFY_PACK_TOKEN_BUDGET', '3000'))
+# Output tokens reserved for every classification of a pack, within the model's output limit
+PACKED_OUTPUT_TOKENS_PER_ITEM = 400
+MAX_OUTPUT_TOKENS = 4096
+
+def build_classification_prompt(user_message):
+    # Only the message varies between calls; it follows the cached instructions
+    return f"""Message:
+<{clean_text(user_message)}>"""
+
+def build_packed_classification_prompt(rows):
+    messages = '\n'.join(f'<message id="{row["Thread Id"]}">\n{clean_text(row["Text Message"])}\n</message>' for row in rows)
+    return f"""Messages:
+{messages}"""
+
+def estimate_tokens(text):
+    # About four characters per token is close enough to size a pack
+    return len(text or '') // 4 + 1
+
+CLASSIFICATION_FIELD_MAPPING = {
+    "Nature of Message": "Nature of Message",
+    "Suitable for Atlas": "Should Atlas participate?",
+    "Reason": "Why?",
+    "Suitable for Team Member": "Suitable for Team Member?",
+    "Suitable Member": "Who should Reply?",
+    "Classification": "Message Classification",
+    "Question About": "Question Type(If Applicable)",
+    "Relevance Score": "Relevance Score",
+    "Summary": "Summary",
+    "Suggested Response": "Suggested Response",
+}
 
-    with open(output_file_path, 'w', newline='', encoding='utf-8') as csv_file:
-        fieldnames = [
-                "Thread Id",
-                "Date & Time",                
-                "Message",
-                "Nature of Message",
-                "Should Atlas participate?",
-                "Why?",
-                "Suitable for Team Member?",
-                "Who should Reply?",
-                "Message Classification",
-                "Question Type(If Applicable)",
-                "Relevance Score",
-                "Summary",
-                "Suggested Response"
-            ]
+CLASSIFICATION_PROPERTIES = dict(string_properties(CLASSIFICATION_FIELD_MAPPING), **{"Relevance Score": {"type": "integer"}})
+
+CLASSIFICATION_TOOL = json_tool(
+    "record_classification", "Records the analysis of the message.", CLASSIFICATION_PROPERTIES
+) if LLM_STRUCTURED_OUTPUT else None
+
+PACKED_CLASSIFICATION_TOOL = json_tool(
+    "record_classifications", "Records the analysis of every message, one item per message in the order given.",
+    {"items": {"type": "array", "items": {"type": "object", "required": ["Id"] + list(CLASSIFICATION_PROPERTIES),
+                                          "properties": dict(CLASSIFICATION_PROPERTIES, Id={"type": "string"})}}}
+) if LLM_STRUCTURED_OUTPUT else None
+
+CLASSIFICATION_FIELDNAMES = [
+    "Thread Id",
+    "Date & Time",
+    "Message",
+    "Nature of Message",
+    "Should Atlas participate?",
+    "Why?",
+    "Suitable for Team Member?",
+    "Who should Reply?",
+    "Message Classification",
+    "Question Type(If Applicable)",
+    "Relevance Score",
+    "Summary",
+    "Suggested Response"
+]
+
+CLASSIFICATION_ANALYSIS_FIELDS = list(CLASSIFICATION_FIELD_MAPPING.values())
+
+def read_csv(input_file_path):
+    """
+    Reads a converted CSV once, for the analysis and the Sheets export alike.
+    :return: (fieldnames, rows)
+    """
+    with open(input_file_path, 'r', newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        rows = list(reader)
+        return reader.fieldnames, rows
+
+def primary_messages(rows):
+    return [row for row in rows if row['Message Type'] == 'Primary Message']
+
+def classification_row(row, response, reask=None):
+    """
+    Joins a classification response back to its primary message row.
+    :param reask: Asks again for this message when the reply cannot be used after local repairs.
+    :return: The output row, or None when the response cannot be used.
+    """
+    parsed_data, error = parse_reply(unwrap_completion(response), required_keys(CLASSIFICATION_FIELD_MAPPING), reask)
+    if error is not None:
+        print(f"Error parsing JSON ({error}): {response}")
+        return None
+    return classification_fields(row, parsed_data)
 
+def classification_fields(row, parsed_data):
+    new_parsed_data = {CLASSIFICATION_FIELD_MAPPING[key]: value for key, value in parsed_data.items()
+                       if key in CLASSIFICATION_FIELD_MAPPING}
+
+    new_parsed_data['Date & Time'] = row['Date & Time']
+    new_parsed_data['Thread Id'] = row['Thread Id']
+    new_parsed_data['Message'] = row['Text Message']
+    return new_parsed_data
+
+def write_rows(rows, output_file_path, fieldnames):
+    with open(output_file_path, 'w', newline='', encoding='utf-8') as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
         writer.writeheader()
-        writer.writerows(parsed_data_list)
+        writer.writerows(rows)
+
+def pack_rows(rows, pack_size, token_budget):
+    """
+    Splits the rows into packs of at most pack_size rows whose messages stay within the
+    estimated token budget. A longer message goes alone, and Thread Ids are unique in a pack.
+    :return: Lists of row indexes.
+    """
+    packs = []
+    pack, tokens, thread_ids = [], 0, set()
+    for index, row in enumerate(rows):
+        cost = estimate_tokens(row['Text Message'])
+        if pack and (len(pack) >= pack_size or tokens + cost > token_budget or row['Thread Id'] in thread_ids):
+            packs.append(pack)
+            pack, tokens, thread_ids = [], 0, set()
+        pack.append(index)
+        tokens += cost
+        thread_ids.add(row['Thread Id'])
+    if pack:
+        packs.append(pack)
+    return packs
+
+def split_packed_response(rows, response):
+    """
+    Validates the JSON array of a packed classification and splits it back into rows by Id.
+    :return: The output row of every input row, with None where an item is missing or malformed.
+    """
+    items, error = parse_reply(unwrap_completion(response))
+    # The packed tool returns the array under "items"
+    if isinstance(items, dict):
+        items = items.get("items")
+    if not isinstance(items, list):
+        print(f"Error parsing packed JSON ({error or 'not an array'}): {response}")
+        return [None] * len(rows)
+
+    items_by_id = {}
+    for item in items:
+        if isinstance(item, dict) and 'Id' in item:
+            items_by_id.setdefault(str(item.pop('Id')), item)
+
+    results = []
+    for row in rows:
+        item = items_by_id.get(row['Thread Id'])
+        if item is None or not all(key in item for key in CLASSIFICATION_FIELD_MAPPING):
+            print(f"Missing or incomplete classification for {row['Thread Id']} in packed response")
+            results.append(None)
+        else:
+            results.append(classification_fields(row, item))
+    return results
+
+def classify_single(row):
+    prompt = build_classification_prompt(row['Text Message'])
+    response = get_completion(prompt, instructions=CLASSIFICATION_INSTRUCTIONS, tool=CLASSIFICATION_TOOL)
+    print(response)
+    return classification_row(row, response, reasker(prompt, CLASSIFICATION_INSTRUCTIONS, CLASSIFICATION_TOOL))
+
+def classify_packed(primary_rows, pack_size=CLASSIFY_PACK_SIZE, token_budget=CLASSIFY_PACK_TOKEN_BUDGET):
+    """
+    Classifies the rows in packs of several messages per request, then retries the items
+    missing from a packed response one by one.
+    :return: The output row of every input row, None where the response could not be parsed.
+    """
+    pack_size = min(pack_size, MAX_OUTPUT_TOKENS // PACKED_OUTPUT_TOKENS_PER_ITEM)
+    packs = pack_rows(primary_rows, pack_size, token_budget)
+
+    def classify_pack(pack):
+        rows = [primary_rows[index] for index in pack]
+        if len(rows) == 1:
+            return [classify_single(rows[0])]
+        response = get_completion(build_packed_classification_prompt(rows), instructions=PACKED_CLASSIFICATION_INSTRUCTIONS,
+                                  max_tokens=PACKED_OUTPUT_TOKENS_PER_ITEM * len(rows), tool=PACKED_CLASSIFICATION_TOOL)
+        print(response)
+        return split_packed_response(rows, response)
+
+    results = [None] * len(primary_rows)
+    retries = []
+    for pack, pack_results in zip(packs, map_concurrently(classify_pack, packs)):
+        for index, result in zip(pack, pack_results):
+            results[index] = result
+            if result is None and len(pack) > 1:
+                retries.append(index)
+
+    if retries:
+        print(f"Retrying {len(retries)} of {len(primary_rows)} messages individually")
+        for index, result in zip(retries, map_concurrently(lambda index: classify_single(primary_rows[index]), retries)):
+            results[index] = result
+
+    print(f"Classified {len(primary_rows)} messages with {len(packs) + len(retries)} requests")
+    return results
+
+def triage_routes(primary_rows):
+    triage = get_triage()
+    if triage is None:
+        return [(ROUTE_LLM, None)] * len(primary_rows)
+    return triage.route_rows(primary_rows)
+
+def classify_rows(primary_rows, routes=None):
+    """
+    Triages the rows before classifying them. Skipped rows get a "No" classification giving
+    the reason, down-routed rows are classified in packs of TRIAGE_PACK_SIZE and the rest as before.
+    :param routes: The triage routes of the rows, when they were already triaged.
+    :return: The output row of every input row, None where the response could not be parsed.
+    """
+    results = [None] * len(primary_rows)
+    indexes = {ROUTE_PACK: [], ROUTE_LLM: []}
+    for index, (route, reason) in enumerate(routes if routes is not None else triage_routes(primary_rows)):
+        if route == ROUTE_SKIP:
+            results[index] = classification_fields(primary_rows[index], skipped_classification(reason))
+        else:
+            indexes[route].append(index)
+
+    # The classifications run concurrently but come back in the order of the rows
+    rows = [primary_rows[index] for index in indexes[ROUTE_LLM]]
+    if CLASSIFY_PACK_SIZE > 1:
+        classified = classify_packed(rows)
+    else:
+        classified = map_concurrently(classify_single, rows)
+    if indexes[ROUTE_PACK]:
+        classified += classify_packed([primary_rows[index] for index in indexes[ROUTE_PACK]], pack_size=TRIAGE_PACK_SIZE)
+
+    for index, result in zip(indexes[ROUTE_LLM] + indexes[ROUTE_PACK], classified):
+        results[index] = result
+    return results
 
-def generate_summary(thread_messages):
-    thread_text = '\n'.join(message['Text Message'] for message in thread_messages)
-    prompt = f"""Quick Overview: We've informally compiled messages from the Support-Driven Slack community, a platform focusing on customer support. This dataset features inquiries and their replies. Note that due to direct replies in the main channel, some responses might be confused as initial inquiries.\
+SUMMARY_INSTRUCTIONS = """Quick Overview: We've informally compiled messages from the Support-Driven Slack community, a platform focusing on customer support. This dataset features inquiries and their replies. Note that due to direct replies in the main channel, some responses might be confused as initial inquiries.\
 
 Objective: We seek to immerse ourselves in the Support-Driven community discussions, providing solutions to pressing issues, fostering trust, and elevating Atlas' visibility. This initiative targets founders with customer experience and tech development expertise, product managers, and CXOs.\
 
@@ -340,7 +539,7 @@ Conclude by presenting your analysis in a JSON format, incorporating the followi
 ThreadSummary, QuestionResolved, SuggestionsSummary, TopicForDiscussion, ArticleOpportunity, ArticleHeading, SuitableParticipant, SuggestedReply
 
 An example of response:\
-{{
+{
 "ThreadSummary": "The initial message is a request from a user to change their email address associated with their Support-Driven Slack account. The thread includes a response from a community moderator explaining that the user can't change the email on the free plan, but they can deactivate the current account and send an invite to the new email. The user later confirms they were able to swap over the email address.",
 "QuestionResolved": "Yes",
 "SuggestionsSummary": "The moderator provided a solution to the user's request by explaining the process of deactivating the current account and sending an invite to the new email address. They also noted that the user should be able to change the email address themselves on the account settings page.",
@@ -349,89 +548,699 @@ An example of response:\
 "ArticleHeading": "N/A",
 "SuitableParticipant": "No one from Atlas needs to participate in this conversation, as it was a simple request that was successfully resolved.",
 "SuggestedReply": "N/A"
-}}
+}
 
 Do not use coding syntax markers like <```json> around your response.\
 Do not add extra commentary except the JSON response.\
 Take utmost care in using double quotes in the response.\
 
-Message:
-<{thread_text}>"""
-    response = get_completion(prompt)
-    return response
+"""
 
-def process_for_generating_summary(input_file_path, output_file_path):
-    with open(input_file_path, newline='', encoding='utf-8') as csvfile, \
-         open(output_file_path, mode='w', newline='', encoding='utf-8') as output_file:
+def build_summary_prompt(thread_messages):
+    # One line per message, with the replies indented under the primary message
+    thread_text = encode_rows(thread_messages, include_times=False, include_users=False)
+    # Only the message varies between calls; it follows the cached instructions
+    return f"""Message:
+<{thread_text}>"""
 
-        reader = csv.DictReader(csvfile)
-        output_fieldnames = [ "Thread Id", "Date & Time", "Thread Date & Time", "Primary Message", "ThreadSummary", "QuestionResolved", "SuggestionsSummary",
-                             "TopicForDiscussion", "ArticleOpportunity", "ArticleHeading", "SuitableParticipant", "SuggestedReply"]
-        writer = csv.DictWriter(output_file, fieldnames=output_fieldnames)
-        writer.writeheader()
+def build_incremental_summary_prompt(previous_summary, new_messages):
+    # A thread that grew is summarised from its previous analysis and the new replies only
+    replies_text = encode_rows(new_messages, include_times=False, include_users=False)
+    return f"""Previous analysis of this thread:
+<{json.dumps(previous_summary, ensure_ascii=False)}>
+New replies since then:
+<{replies_text}>
+Update the analysis so it covers the whole thread."""
+
+SUMMARY_FIELDNAMES = ["Thread Id", "Date & Time", "Thread Date & Time", "Primary Message", "ThreadSummary", "QuestionResolved",
+                      "SuggestionsSummary", "TopicForDiscussion", "ArticleOpportunity", "ArticleHeading", "SuitableParticipant",
+                      "SuggestedReply"]
+
+SUMMARY_KEYS = SUMMARY_FIELDNAMES[4:]
+
+# With near-duplicate detection, both outputs end with the representative a row was taken from;
+# without it they keep their earlier columns
+if NEAR_DUP_BACKEND != 'off':
+    CLASSIFICATION_FIELDNAMES.append("Duplicate Of")
+    SUMMARY_FIELDNAMES.append("Duplicate Of")
+
+SUMMARY_TOOL = json_tool(
+    "record_thread_summary", "Records the analysis of the thread.", string_properties(SUMMARY_KEYS)
+) if LLM_STRUCTURED_OUTPUT else None
+
+# Classifies the primary message and summarises its thread with one request where both are needed
+FUSED_ANALYSIS = os.getenv('FUSED_ANALYSIS', 'true').lower() in ('1', 'true', 'yes')
+
+ANALYSIS_INSTRUCTIONS = CLASSIFICATION_INSTRUCTIONS + SUMMARY_INSTRUCTIONS + """Both analyses are requested at once for a thread.\
+Analyse the first message of the thread as the message described in the first part, and the whole thread as described in the second part.\
+Respond with a JSON object with two keys: "MessageAnalysis", holding the keys of the first response format,\
+and "ThreadAnalysis", holding the keys of the second response format.\
+
+"""
+
+ANALYSIS_TOOL = json_tool("record_thread_analysis", "Records the analysis of the primary message and of its thread.", {
+    "MessageAnalysis": {"type": "object", "properties": CLASSIFICATION_PROPERTIES, "required": list(CLASSIFICATION_PROPERTIES)},
+    "ThreadAnalysis": {"type": "object", "properties": string_properties(SUMMARY_KEYS), "required": SUMMARY_KEYS},
+}) if LLM_STRUCTURED_OUTPUT else None
+
+ANALYSIS_MAX_TOKENS = 2 * COMPLETION_MAX_TOKENS
+
+def thread_key(source_key, thread_messages):
+    """
+    The thread state key: the channel of the source CSV and the digits of the thread time.
+    Source keys are <export run>/<channel>/<day>.csv, and every export run has its own prefix,
+    so only the channel segment is shared by the files of a channel across runs and days.
+    """
+    parts = source_key.split('/')
+    channel = parts[-2] if len(parts) >= 2 else os.path.splitext(parts[-1])[0]
+    thread_time = ''.join(char for char in thread_messages[0]['Thread Date & Time'] or '' if char.isdigit())
+    return f"{channel}/{thread_time}"
+
+def summary_prompt(thread_messages, state):
+    """
+    Compares the thread with its stored state.
+    :return: The prompt to send, or None when the thread has no new replies.
+    """
+    plan, rows = plan_thread(thread_messages, state)
+    if plan == 'skip':
+        return None
+    if plan == 'incremental':
+        print(f"Summarising {len(rows)} new replies of thread {thread_messages[0]['Thread Id']}")
+        return build_incremental_summary_prompt(state['summary'], rows)
+    return build_summary_prompt(thread_messages)
+
+def stored_summary_row(thread_messages, state):
+    """
+    The summary row of a thread without new replies, rebuilt from its stored state, so a file
+    processed again still writes the summaries of its unchanged threads.
+    """
+    summary = state.get('summary') if state else None
+    return summary_fields(thread_messages[0], summary) if summary is not None else None
+
+def stored_classification_row(primary_message_row, state):
+    """
+    The classification row of a primary message unchanged since its thread state was saved.
+    """
+    analysis = state.get('classification') if state else None
+    return dict(analysis, **classification_fields(primary_message_row, {})) if analysis is not None else None
+
+def load_thread_states(threads, source_key):
+    """
+    Fetches the stored state of every thread concurrently.
+    :return: (state keys, states), all None when there is no thread state store or source key.
+    """
+    store = get_thread_state_store() if source_key else None
+    if store is None:
+        return [None] * len(threads), [None] * len(threads)
+    keys = [thread_key(source_key, thread) for thread in threads]
+    return keys, map_concurrently(store.get, keys)
+
+def save_thread_state(key, thread_messages, output_row, classification=None):
+    store = get_thread_state_store()
+    if key is not None and store is not None and output_row is not None:
+        store.put(key, thread_state(thread_messages, analysis_fields(output_row, SUMMARY_KEYS),
+                                    analysis_fields(classification, CLASSIFICATION_ANALYSIS_FIELDS)))
+
+def summarize_thread(thread_messages, key=None, state=None):
+    """
+    Summarises a thread. A thread without new replies since its stored state is skipped and a
+    grown one is summarised from the previous summary plus the new replies; the caller saves
+    the new state.
+    :return: The summary row of the thread, from its stored state when it has no new replies,
+             or None when the response cannot be used.
+    """
+    prompt = summary_prompt(thread_messages, state)
+    if prompt is None:
+        print(f"Thread {key} has no new replies, reusing its stored summary")
+        return stored_summary_row(thread_messages, state)
+    response = get_completion(prompt, instructions=SUMMARY_INSTRUCTIONS, tool=SUMMARY_TOOL)
+    print(response)
+    return summary_row(thread_messages[0], response, reasker(prompt, SUMMARY_INSTRUCTIONS, SUMMARY_TOOL))
+
+def group_threads(rows):
+    """
+    Groups rows into threads in one pass, keyed on Thread Date & Time (the formatted thread_ts),
+    so a reply joins its thread wherever it sits in the file. A primary message sharing the
+    key of a thread that already has one starts a new thread, and replies join the latest.
+    :return: Threads ordered by thread time, each led by its primary message with the replies
+             in time order. Replies whose primary message is not in the file form their own thread.
+    """
+    threads = {}
+    for row in rows:
+        key = row['Thread Date & Time'] or ''
+        groups = threads.setdefault(key, [])
+        is_primary = row['Message Type'] == 'Primary Message'
+        if not groups or (is_primary and groups[-1]['primary'] is not None):
+            groups.append({'primary': None, 'replies': []})
+        if is_primary and groups[-1]['primary'] is None:
+            groups[-1]['primary'] = row
+        else:
+            groups[-1]['replies'].append(row)
+
+    # The sort is stable, so threads with the same time keep the order they appeared in
+    ordered = sorted((group for groups in threads.values() for group in groups),
+                     key=lambda group: (group['primary'] or group['replies'][0])['Thread Date & Time'] or '')
+    return [([group['primary']] if group['primary'] is not None else []) +
+            sorted(group['replies'], key=lambda row: row['Date & Time'] or '')
+            for group in ordered]
+
+def summary_row(primary_message_row, response, reask=None):
+    """
+    Joins a thread summary response back to the primary message of the thread.
+    :param reask: Asks again for this thread when the reply cannot be used after local repairs.
+    :return: The output row, or None when the response cannot be used.
+    """
+    summary_response_json, error = parse_reply(unwrap_completion(response), required_keys(SUMMARY_KEYS), reask)
+    if error is not None:
+        print(f"Error parsing JSON ({error}): {response}")
+        return None
+    return summary_fields(primary_message_row, summary_response_json)
+
+def summary_fields(primary_message_row, summary_response_json):
+    output_row = {
+        'Date & Time': primary_message_row['Date & Time'],
+        'Thread Date & Time': primary_message_row['Thread Date & Time'],
+        'Thread Id': primary_message_row['Thread Id'],
+        'Primary Message': primary_message_row['Text Message']
+    }
+    output_row.update(summary_response_json)
+    return output_row
+
+def build_analysis_prompt(thread_messages):
+    thread_text = encode_rows(thread_messages, include_times=False, include_users=False)
+    return f"""Thread, starting with its primary message:
+<{thread_text}>"""
 
-        current_thread = []
-
-        for row in reader:        
-            if row['Message Type'] == 'Primary Message':
-                if current_thread:
-                    response = generate_summary(current_thread)
-                    print(response)
-                    try:
-                        summary_response_json = json.loads(json.loads(response)["response"])
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON: {response}")
-                        continue
-                    primary_message_row = current_thread[0]
-
-                    output_row = {
-                        'Date & Time': primary_message_row['Date & Time'],
-                        'Thread Date & Time': primary_message_row['Thread Date & Time'],
-                        'Thread Id': primary_message_row['Thread Id'],
-                        'Primary Message': primary_message_row['Text Message']
-                    }
-                    output_row.update(summary_response_json)
-                    writer.writerow(output_row)
-
-                current_thread = [row]
+def validate_analysis(value):
+    error = required_keys(["MessageAnalysis", "ThreadAnalysis"])(value)
+    if error is None:
+        error = required_keys(CLASSIFICATION_FIELD_MAPPING)(value["MessageAnalysis"])
+    if error is None:
+        error = required_keys(SUMMARY_KEYS)(value["ThreadAnalysis"])
+    return error
+
+def analyze_thread(thread_messages):
+    """
+    Classifies the primary message of a thread and summarises the thread with one request,
+    so the message is sent once and the shared context is not repeated.
+    :return: (classification row, summary row), both None when the response cannot be used.
+    """
+    prompt = build_analysis_prompt(thread_messages)
+    response = get_completion(prompt, instructions=ANALYSIS_INSTRUCTIONS, max_tokens=ANALYSIS_MAX_TOKENS, tool=ANALYSIS_TOOL)
+    print(response)
+    analysis, error = parse_reply(unwrap_completion(response), validate_analysis,
+                                  reasker(prompt, ANALYSIS_INSTRUCTIONS, ANALYSIS_TOOL, ANALYSIS_MAX_TOKENS))
+    if error is not None:
+        print(f"Error parsing JSON ({error}): {response}")
+        return None, None
+
+    primary_message_row = thread_messages[0]
+    return (classification_fields(primary_message_row, analysis["MessageAnalysis"]),
+            summary_fields(primary_message_row, analysis["ThreadAnalysis"]))
+
+def find_duplicates(primary_rows, routes, source_key, index):
+    """
+    Looks every primary message not skipped by the triage up in the near-duplicate index. A
+    message without a near duplicate becomes a representative, referenced as <source key>#<Thread Id>.
+    :return: (reference of every representative, its signature, reference of the representative
+             of every duplicate), each None where it does not apply.
+    """
+    refs, signatures, duplicate_of = [None] * len(primary_rows), [None] * len(primary_rows), [None] * len(primary_rows)
+    if index is None:
+        return refs, signatures, duplicate_of
+    for position, (row, (route, _)) in enumerate(zip(primary_rows, routes)):
+        signature = minhash(row['Text Message']) if route != ROUTE_SKIP else None
+        if signature is None:
+            continue
+        ref = f"{source_key}#{row['Thread Id']}"
+        # A file processed again keeps its own messages as representatives
+        match = index.query(signature) if ref not in index.entries else None
+        if match is not None:
+            duplicate_of[position] = match
+            continue
+        refs[position], signatures[position] = ref, signature
+        if ref not in index.entries:
+            index.add(ref, signature)
+    print(f"{sum(ref is not None for ref in duplicate_of)} of {len(primary_rows)} primary messages are near duplicates")
+    return refs, signatures, duplicate_of
+
+def analysis_fields(output_row, fieldnames):
+    return {name: output_row.get(name) for name in fieldnames} if output_row is not None else None
+
+def fanned_out_classification(row, analysis, ref):
+    return dict(analysis, **classification_fields(row, {}), **{"Duplicate Of": ref})
+
+def fanned_out_summary(primary_message_row, analysis, ref):
+    return dict(summary_fields(primary_message_row, analysis), **{"Duplicate Of": ref})
+
+def analyze_threads(rows, source_key=None, duplicate_index=None):
+    """
+    Analyses the rows of whole threads. With FUSED_ANALYSIS, a thread whose primary message goes
+    to the LLM and which is summarised in full gets both analyses from analyze_thread; the other
+    messages and threads take the separate paths. A primary message whose thread only gained
+    replies or is unchanged since its stored state keeps its stored classification.
+    With a near-duplicate index, a cross-posted message reuses the classification of its
+    representative, and its thread summary too when it has no replies; the output records the
+    representative in "Duplicate Of". Duplicates whose representative has no analysis are
+    analysed themselves, so no row is lost.
+    :return: (classification of every primary message, summary of every thread), None where it failed.
+    """
+    primary_rows = primary_messages(rows)
+    routes = triage_routes(primary_rows)
+    refs, _, duplicate_of = find_duplicates(primary_rows, routes, source_key, duplicate_index)
+    threads = group_threads(rows)
+    keys, states = load_thread_states(threads, source_key)
+    plans = [plan_thread(thread, state)[0] for thread, state in zip(threads, states)]
+
+    # Rows are shared between the primary messages and the threads, so they are matched by identity
+    duplicates = {id(row): ref for row, ref in zip(primary_rows, duplicate_of) if ref is not None}
+    stored_rows = {id(thread[0]): stored_classification_row(thread[0], state)
+                   for thread, state, plan in zip(threads, states, plans) if plan != 'full' and id(thread[0]) not in duplicates}
+    stored_rows = {row_id: row for row_id, row in stored_rows.items() if row is not None}
+    llm_primaries = {id(row) for row, (route, _) in zip(primary_rows, routes)
+                     if route == ROUTE_LLM and id(row) not in duplicates and id(row) not in stored_rows}
+    lone_duplicates = [len(thread) == 1 and id(thread[0]) in duplicates for thread in threads]
+    fused = [FUSED_ANALYSIS and CLASSIFY_PACK_SIZE <= 1 and id(thread[0]) in llm_primaries and plan == 'full'
+             for thread, plan in zip(threads, plans)]
+
+    def analyze(index):
+        if lone_duplicates[index]:
+            return None, None
+        if fused[index]:
+            return analyze_thread(threads[index])
+        return None, summarize_thread(threads[index], keys[index], states[index])
+
+    thread_results = map_concurrently(analyze, range(len(threads)))
+    summaries = [summary for _, summary in thread_results]
+    known_rows = dict(stored_rows)
+    known_rows.update((id(thread[0]), classification) for thread, is_fused, (classification, _)
+                      in zip(threads, fused, thread_results) if is_fused)
+
+    remaining = [index for index, row in enumerate(primary_rows) if id(row) not in known_rows and id(row) not in duplicates]
+    classifications = [known_rows.get(id(row)) for row in primary_rows]
+    for index, result in zip(remaining, classify_rows([primary_rows[index] for index in remaining],
+                                                      [routes[index] for index in remaining])):
+        classifications[index] = result
+    print(f"Analysed {len(threads)} threads, {sum(fused)} of them with a single request, "
+          f"{len(stored_rows)} primary messages with their stored classification")
+
+    if duplicate_index is not None:
+        # Representatives share their classification, and the summary of their thread when it has no replies
+        for row, ref, classification in zip(primary_rows, refs, classifications):
+            duplicate_index.record(ref, classification=analysis_fields(classification, CLASSIFICATION_ANALYSIS_FIELDS))
+        rep_refs = {id(row): ref for row, ref in zip(primary_rows, refs) if ref is not None}
+        for thread, summary in zip(threads, summaries):
+            if len(thread) == 1 and id(thread[0]) in rep_refs:
+                duplicate_index.record(rep_refs[id(thread[0])], summary=analysis_fields(summary, SUMMARY_KEYS))
+    if duplicates:
+        fan_out_duplicates(primary_rows, routes, classifications, duplicate_of, threads, keys, states, summaries,
+                           lone_duplicates, duplicate_index)
+
+    save_thread_states(threads, keys, states, plans, summaries, lone_duplicates,
+                       {id(row): classification for row, classification in zip(primary_rows, classifications)})
+    return classifications, summaries
+
+def save_thread_states(threads, keys, states, plans, summaries, lone_duplicates, classifications):
+    """
+    Saves the state of every analysed thread with the classification of its primary message.
+    A thread that only gained replies keeps the stored classification of its primary message
+    when the message is not in this file, and an unchanged thread is only saved to add a
+    classification its stored state lacks.
+    :param classifications: The classification rows of the primary messages by row identity.
+    """
+    store = get_thread_state_store()
+
+    def save(index):
+        thread, key, state, plan = threads[index], keys[index], states[index], plans[index]
+        classification = classifications.get(id(thread[0]))
+        if plan == 'skip':
+            if classification is not None and state.get('classification') is None:
+                store.put(key, dict(state, classification=analysis_fields(classification, CLASSIFICATION_ANALYSIS_FIELDS)))
+            return
+        if classification is None and plan == 'incremental':
+            classification = stored_classification_row(thread[0], state)
+        save_thread_state(key, thread, summaries[index], classification)
+
+    if store is not None:
+        # Lone duplicates are saved when their summary is fanned out
+        map_concurrently(save, [index for index, key in enumerate(keys) if key is not None and not lone_duplicates[index]])
+
+# Threads analysed between two checkpoints
+CHECKPOINT_THREADS = int(os.getenv('CHECKPOINT_THREADS', '50'))
+
+def analyze_rows(rows, classification_output_path, summary_output_path, source_key=None, duplicate_index=None,
+                 deadline=None, checkpoint=None):
+    """
+    Writes both outputs of a CSV from its rows, read once. Threads are analysed
+    CHECKPOINT_THREADS at a time; after each step the output rows so far and the Thread Id of
+    the last analysed thread are saved to the checkpoint. When the deadline leaves no time for
+    another step, it stops without writing the outputs.
+    :param checkpoint: A Checkpoint resumed from when it holds the same rows.
+    :return: Whether the outputs were written.
+    """
+    threads = group_threads(rows)
+    # Classifications keep the order of the source file across steps
+    positions = {id(row): position for position, row in enumerate(rows)}
+    checkpoint = checkpoint if checkpoint is not None else Checkpoint(None, None)
+    content_hash = rows_hash(rows)
+    if checkpoint.state.get('content_hash') != content_hash:
+        checkpoint.state = {'content_hash': content_hash, 'cursor': None, 'classified': [], 'summarized': []}
+    state = checkpoint.state
+    thread_ids = [thread[0]['Thread Id'] for thread in threads]
+    start = thread_ids.index(state['cursor']) + 1 if state['cursor'] in thread_ids else 0
+    if start:
+        print(f"Resuming after thread {state['cursor']}, {len(threads) - start} of {len(threads)} threads left")
+
+    for begin in range(start, len(threads), CHECKPOINT_THREADS):
+        # Every invocation analyses at least one step, so a run always makes progress
+        if deadline is not None and begin > start and deadline.expired():
+            print(f"Stopping after thread {state['cursor']} before the deadline")
+            return False
+        if deadline is not None:
+            deadline.start_step()
+        step_rows = [row for thread in threads[begin:begin + CHECKPOINT_THREADS] for row in thread]
+        classifications, summaries = analyze_threads(step_rows, source_key, duplicate_index)
+        state['classified'] += [[positions[id(row)], classification] for row, classification
+                                in zip(primary_messages(step_rows), classifications) if classification is not None]
+        state['summarized'] += [summary for summary in summaries if summary is not None]
+        state['cursor'] = thread_ids[min(begin + CHECKPOINT_THREADS, len(threads)) - 1]
+        checkpoint.save()
+        if deadline is not None:
+            deadline.end_step()
+
+    write_rows([row for _, row in sorted(state['classified'], key=lambda item: item[0])],
+               classification_output_path, CLASSIFICATION_FIELDNAMES)
+    write_rows(state['summarized'], summary_output_path, SUMMARY_FIELDNAMES)
+    return True
+
+def fan_out_duplicates(primary_rows, routes, classifications, duplicate_of, threads, keys, states, summaries,
+                       lone_duplicates, duplicate_index):
+    """
+    Fills in the classifications and lone thread summaries of the duplicates from their
+    representatives, analysing the ones whose representative has no analysis to share.
+    """
+    fallback = []
+    for position, (row, ref) in enumerate(zip(primary_rows, duplicate_of)):
+        if ref is None:
+            continue
+        analysis = duplicate_index.entries[ref]['classification']
+        if analysis is not None:
+            classifications[position] = fanned_out_classification(row, analysis, ref)
+        else:
+            fallback.append(position)
+    for position, result in zip(fallback, classify_rows([primary_rows[position] for position in fallback],
+                                                        [routes[position] for position in fallback])):
+        classifications[position] = result
+
+    duplicate_refs = {id(row): ref for row, ref in zip(primary_rows, duplicate_of) if ref is not None}
+    fallback = []
+    for index, thread in enumerate(threads):
+        if not lone_duplicates[index]:
+            continue
+        ref = duplicate_refs[id(thread[0])]
+        if plan_thread(thread, states[index])[0] == 'skip':
+            # The stored summary of a lone duplicate is the one fanned out to it before
+            stored = states[index].get('summary')
+            summaries[index] = fanned_out_summary(thread[0], stored, ref) if stored is not None else None
+            continue
+        analysis = duplicate_index.entries[ref]['summary']
+        if analysis is not None:
+            summaries[index] = fanned_out_summary(thread[0], analysis, ref)
+            save_thread_state(keys[index], thread, summaries[index])
+        else:
+            fallback.append(index)
+    for index, summary in zip(fallback, map_concurrently(lambda index: summarize_thread(threads[index], keys[index], states[index]),
+                                                         fallback)):
+        summaries[index] = summary
+    map_concurrently(lambda index: save_thread_state(keys[index], threads[index], summaries[index]), fallback)
+    print(f"Fanned out the analysis of {len(duplicate_refs)} near duplicates")
+
+def output_paths(key):
+    newkey = key.replace('/', '').replace('.csv', '')
+    return ('/tmp/{}_primary_messages_analyzed.csv'.format(newkey),
+            '/tmp/{}_thread_summarized.csv'.format(newkey))
+
+def upload_outputs(key, pri_upload_path, sum_upload_path):
+    upload_key = key.replace('.csv', '')
+    s3_client.upload_file(pri_upload_path, ANALYZED_BUCKET, '{}_primary_messages_analyzed.csv'.format(upload_key))
+    s3_client.upload_file(sum_upload_path, SUMMARIZED_BUCKET, '{}_thread_summarized.csv'.format(upload_key))
+
+def submit_batch_job(files, store, backend, duplicate_index=None):
+    """
+    Serialises the classification and thread summary prompts of the downloaded CSV files
+    into one batch, submits it and saves the job needed to join the results back later.
+    Prompts already in the response cache are answered from it and not submitted, and messages
+    skipped by the triage get their classification without a request. Down-routed messages are
+    submitted one by one, since batched requests are already discounted.
+    Threads without new replies since their stored state are left out, and grown ones are sent
+    as incremental prompts; the primary messages of both keep their stored classification. Near duplicates of an already analysed representative take its
+    analysis; new representatives are recorded in the index when the job is collected.
+    :param files: (S3 key, rows) pairs.
+    :return: The job, or None when there was nothing to do.
+    """
+    job = {'job_id': uuid.uuid4().hex, 'created_at': datetime.now(pytz.utc).isoformat(), 'files': [], 'items': {},
+           'batch_id': None}
+    requests = []
+
+    def add(custom_id, file_index, kind, row, prompt, instructions, tool):
+        params = completion_params(prompt, instructions=instructions, tool=tool)
+        key, text = lookup_response(params)
+        # The prompt is kept to ask again for an item whose reply cannot be used
+        job['items'][custom_id] = {'file': file_index, 'kind': kind, 'row': row, 'cache_key': key, 'text': text,
+                                   'prompt': prompt}
+        if text is None:
+            requests.append({'custom_id': custom_id, 'params': params})
+
+    def analysis_of(ref, kind):
+        # Only representatives analysed by an earlier job have an analysis to share yet
+        return duplicate_index.entries[ref][kind] if ref is not None else None
+
+    for file_index, (key, rows) in enumerate(files):
+        job['files'].append(key)
+        primary_rows = primary_messages(rows)
+        routes = triage_routes(primary_rows)
+        refs, signatures, duplicate_of = find_duplicates(primary_rows, routes, key, duplicate_index)
+        near_dups = {id(row): {'ref': ref, 'signature': signature}
+                     for row, ref, signature in zip(primary_rows, refs, signatures) if ref is not None}
+        threads = group_threads(rows)
+        state_keys, states = load_thread_states(threads, key)
+        plans = [plan_thread(thread, state)[0] for thread, state in zip(threads, states)]
+        thread_states = {id(thread[0]): (state_key, state, plan) for thread, state_key, state, plan
+                         in zip(threads, state_keys, states, plans) if state_key is not None}
+        for i, (row, (route, reason), ref) in enumerate(zip(primary_rows, routes, duplicate_of)):
+            custom_id = f"c{file_index}-{i}"
+            analysis = analysis_of(ref, 'classification')
+            state_key, state, plan = thread_states.get(id(row), (None, None, 'full'))
+            stored_row = stored_classification_row(row, state) if plan != 'full' and ref is None else None
+            if route == ROUTE_SKIP:
+                job['items'][custom_id] = {'file': file_index, 'kind': 'classification', 'row': row,
+                                           'cache_key': None, 'text': json.dumps(skipped_classification(reason))}
+            elif analysis is not None:
+                job['items'][custom_id] = {'file': file_index, 'kind': 'classification', 'row': row,
+                                           'output': fanned_out_classification(row, analysis, ref)}
+            elif stored_row is not None:
+                job['items'][custom_id] = {'file': file_index, 'kind': 'classification', 'row': row, 'output': stored_row}
+            else:
+                add(custom_id, file_index, 'classification', row, build_classification_prompt(row['Text Message']),
+                    CLASSIFICATION_INSTRUCTIONS, CLASSIFICATION_TOOL)
+                if id(row) in near_dups:
+                    job['items'][custom_id]['near_dup'] = near_dups[id(row)]
+                if plan == 'skip' and state.get('classification') is None:
+                    # An unchanged thread is only saved again to add the classification its state lacks
+                    job['items'][custom_id]['state'] = dict(state, key=state_key)
+        duplicate_refs = {id(row): ref for row, ref in zip(primary_rows, duplicate_of) if ref is not None}
+        for i, (thread, state_key, state, plan) in enumerate(zip(threads, state_keys, states, plans)):
+            custom_id = f"s{file_index}-{i}"
+            prompt = summary_prompt(thread, state)
+            if prompt is None:
+                print(f"Thread {state_key} has no new replies, reusing its stored summary")
+                output_row = stored_summary_row(thread, state)
+                if output_row is not None:
+                    job['items'][custom_id] = {'file': file_index, 'kind': 'summary', 'row': thread[0], 'output': output_row}
+                continue
+            ref = duplicate_refs.get(id(thread[0])) if len(thread) == 1 else None
+            analysis = analysis_of(ref, 'summary')
+            if analysis is not None:
+                output_row = fanned_out_summary(thread[0], analysis, ref)
+                job['items'][custom_id] = {'file': file_index, 'kind': 'summary', 'row': thread[0], 'output': output_row}
+                save_thread_state(state_key, thread, output_row)
+                continue
+            add(custom_id, file_index, 'summary', thread[0], prompt, SUMMARY_INSTRUCTIONS, SUMMARY_TOOL)
+            if len(thread) == 1 and id(thread[0]) in near_dups:
+                job['items'][custom_id]['near_dup'] = near_dups[id(thread[0])]
+            if state_key is not None:
+                # Saved with the summary and the classification of the primary message when the job is collected
+                classification = state.get('classification') if plan == 'incremental' and state else None
+                job['items'][custom_id]['state'] = dict(thread_state(thread, None, classification), key=state_key)
+
+    if not job['items']:
+        return None
+    if requests:
+        job['batch_id'] = backend.submit(requests)
+    store.save(job, requests)
+    print(f"Submitted batch {job['batch_id']} with {len(requests)} requests for {len(files)} files as job {job['job_id']}, "
+          f"{len(job['items']) - len(requests)} answered without a request")
+    return job
+
+def collect_batch_jobs(store, backend, duplicate_index=None):
+    """
+    Writes and uploads the outputs of every pending job whose batch has ended and that this
+    invocation could claim. Rows keep the order of the source file and failed requests are
+    left out, as in sync mode. The analyses of new near-duplicate representatives are recorded in duplicate_index.
+    :return: The ids of the collected jobs.
+    """
+    collected = []
+    state_store = get_thread_state_store()
+    for job in store.list_pending():
+        if job['batch_id'] is not None and not backend.poll(job['batch_id']):
+            print(f"Batch {job['batch_id']} of job {job['job_id']} is still processing")
+            continue
+        # Concurrent invocations may list the same finished job; only the one holding its claim collects it
+        if not store.claim(job['job_id']):
+            print(f"Job {job['job_id']} is being collected by another invocation")
+            continue
+        responses = dict(backend.results(job['batch_id'])) if job['batch_id'] is not None else {}
+
+        outputs = [([], []) for _ in job['files']]
+        # Classification items come before the summary items of their file, so the thread state
+        # saved with a summary can hold the classification of its primary message
+        analyses = {}
+        for custom_id, item in job['items'].items():
+            classified, summarized = outputs[item['file']]
+            if item.get('output') is not None:
+                # Fanned out from a near-duplicate representative or stored with the thread when the job was submitted
+                (classified if item['kind'] == 'classification' else summarized).append(item['output'])
+                if item['kind'] == 'classification':
+                    analyses[(item['file'], item['row']['Thread Id'])] = analysis_fields(item['output'], CLASSIFICATION_ANALYSIS_FIELDS)
+                continue
+            text = item.get('text')
+            if text is None:
+                text = responses.get(custom_id)
+                if text is None:
+                    print(f"No result for {custom_id} of job {job['job_id']}")
+                    continue
+                store_response(item.get('cache_key'), text, DEFAULT_MODEL)
+            # A reply that cannot be used is asked again for this item alone, synchronously
+            prompt = item.get('prompt')
+            if item['kind'] == 'classification':
+                reask = reasker(prompt, CLASSIFICATION_INSTRUCTIONS, CLASSIFICATION_TOOL) if prompt else None
+                output_row = classification_row(item['row'], wrap_completion(text), reask)
+                rows = classified
+                analysis = analysis_fields(output_row, CLASSIFICATION_ANALYSIS_FIELDS)
+                analyses[(item['file'], item['row']['Thread Id'])] = analysis
+                if analysis is not None and state_store is not None and item.get('state'):
+                    state = dict(item['state'], classification=analysis)
+                    state_store.put(state.pop('key'), state)
             else:
-                current_thread.append(row)
-
-        if current_thread:
-            response = generate_summary(current_thread)
-            print(response)
-            try:
-                summary_response_json = json.loads(json.loads(response)["response"])
-            except json.JSONDecodeError:
-                print(f"Error parsing JSON: {response}")
-            primary_message_row = current_thread[0]
-
-            output_row = {
-                'Date & Time': primary_message_row['Date & Time'],
-                'Thread Date & Time': primary_message_row['Thread Date & Time'],
-                'Thread Id': primary_message_row['Thread Id'],
-                'Primary Message': primary_message_row['Text Message']
-            }
-            output_row.update(summary_response_json)
-            writer.writerow(output_row)
+                reask = reasker(prompt, SUMMARY_INSTRUCTIONS, SUMMARY_TOOL) if prompt else None
+                output_row = summary_row(item['row'], wrap_completion(text), reask)
+                rows = summarized
+                if output_row is not None and state_store is not None and item.get('state'):
+                    state = dict(item['state'], summary=analysis_fields(output_row, SUMMARY_KEYS))
+                    classification = analyses.get((item['file'], item['row']['Thread Id']))
+                    if classification is not None:
+                        state['classification'] = classification
+                    state_store.put(state.pop('key'), state)
+            if output_row is not None:
+                rows.append(output_row)
+            if output_row is not None and duplicate_index is not None and item.get('near_dup'):
+                near_dup = item['near_dup']
+                if near_dup['ref'] not in duplicate_index.entries:
+                    duplicate_index.add(near_dup['ref'], near_dup['signature'])
+                fieldnames = CLASSIFICATION_ANALYSIS_FIELDS if item['kind'] == 'classification' else SUMMARY_KEYS
+                duplicate_index.record(near_dup['ref'], **{item['kind']: analysis_fields(output_row, fieldnames)})
+
+        for key, (classified, summarized) in zip(job['files'], outputs):
+            pri_upload_path, sum_upload_path = output_paths(key)
+            write_rows(classified, pri_upload_path, CLASSIFICATION_FIELDNAMES)
+            write_rows(summarized, sum_upload_path, SUMMARY_FIELDNAMES)
+            upload_outputs(key, pri_upload_path, sum_upload_path)
+
+        store.delete(job['job_id'])
+        collected.append(job['job_id'])
+        print(f"Collected job {job['job_id']} for {len(job['files'])} files")
+    return collected
 
 def lambda_handler(event, context):
-    for record in event['Records']:
+    batch_mode = LLM_MODE == 'batch'
+    if batch_mode:
+        # Every invocation, including scheduled ones without records, collects finished batches
+        store = get_batch_store(s3_client)
+        backend = get_batch_backend()
+    duplicate_store = get_near_duplicate_store()
+    duplicate_index = duplicate_store.load() if duplicate_store is not None else None
+    if batch_mode:
+        collect_batch_jobs(store, backend, duplicate_index)
+        batch_files = []
+
+    # Sync runs stop before the Lambda timeout and continue with the remaining records in a new invocation
+    deadline = Deadline(context)
+    checkpoint_store = get_checkpoint_store()
+    records = event.get('Records', [])
+    if event.get('continuation'):
+        print(f"Continuing with {len(records)} records")
+    remaining_records = None
+    finished = []
+    for position, record in enumerate(records):
+        if not batch_mode and position and deadline.expired():
+            remaining_records = records[position:]
+            break
         bucket = record['s3']['bucket']['name']
         key = unquote_plus(record['s3']['object']['key'])
+
+        # Sidecars such as the thread index live next to the CSVs
+        if not key.endswith('.csv'):
+            print(f"Skipping {key}, not a CSV file.")
+            continue
+
+        # A retry of the event skips the files it already analysed and exported
+        version = record['s3']['object'].get('sequencer')
+        checkpoint = Checkpoint.load(checkpoint_store, checkpoint_name(key)) if not batch_mode else None
+        if checkpoint is not None and checkpoint.is_done(version):
+            print(f"Skipping {key}, already finished by an earlier attempt of this event.")
+            finished.append(checkpoint)
+            continue
+
         tmpkey = key.replace('/', '')
         csv_file_download_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-        newkey = tmpkey.replace('.csv', '')
-        pri_upload_path = '/tmp/{}_primary_messages_analyzed.csv'.format(newkey)
-        sum_upload_path = '/tmp/{}_thread_summarized.csv'.format(newkey)
         s3_client.download_file(bucket, key, csv_file_download_path)
-        process_csv(csv_file_download_path, pri_upload_path)
-        process_for_generating_summary(csv_file_download_path, sum_upload_path)
-        upload_key = key.replace('.csv', '')
-        s3_client.upload_file(pri_upload_path, 'slackdumpanalyzedfilescsv', '{}_primary_messages_analyzed.csv'.format(upload_key))
-        s3_client.upload_file(sum_upload_path, 'slackdumpthreadsummarizedfilescsv', '{}_thread_summarized.csv'.format(upload_key))
+        # The file is parsed once for both outputs and the Sheets export
+        fieldnames, rows = read_csv(csv_file_download_path)
+        if batch_mode:
+            batch_files.append((key, rows))
+        else:
+            pri_upload_path, sum_upload_path = output_paths(key)
+            if not analyze_rows(rows, pri_upload_path, sum_upload_path, key, duplicate_index, deadline, checkpoint):
+                # The Sheets export of this file waits until its analysis is complete
+                remaining_records = records[position:]
+                break
+            upload_outputs(key, pri_upload_path, sum_upload_path)
 
         sheet_name = get_sheet_name_from_key(key)
         spreadsheet_id = get_spreadsheet_id(sheet_name)
         if spreadsheet_id:
-            append_data_to_sheet(spreadsheet_id, csv_file_download_path, sheet_name)
\ No newline at end of file
+            append_data_to_sheet(spreadsheet_id, csv_file_download_path, sheet_name,
+                                 data=[fieldnames] + [[row[name] for name in fieldnames] for row in rows])
+        if checkpoint is not None:
+            checkpoint.mark_done(version)
+            finished.append(checkpoint)
+
+    if batch_mode and batch_files:
+        job = submit_batch_job(batch_files, store, backend, duplicate_index)
+        if job is not None and job['batch_id'] is None:
+            # Everything was answered from the response cache, so the outputs can be written now
+            collect_batch_jobs(store, backend, duplicate_index)
+    if duplicate_store is not None:
+        duplicate_store.save(duplicate_index)
+
+    maybe_evict()
+    print(f"LLM usage: {metrics.snapshot()}")
+    print(f"Reply parsing: {parse_stats.snapshot()}")
+
+    if remaining_records:
+        # Failing lets Lambda retry the event, which skips the finished files and resumes from the checkpoint
+        if not reinvoke(context, {'Records': remaining_records, 'continuation': True}):
+            raise RuntimeError(f"Could not continue with {len(remaining_records)} records")
+    # Nothing retries this event any more
+    for checkpoint in finished:
+        checkpoint.clear()
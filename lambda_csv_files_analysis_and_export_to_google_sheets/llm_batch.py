@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import uuid
+from botocore.exceptions import ClientError
+from llm_gateway import create_message, get_transport, response_text
+
+# Pending batch jobs are kept in the state bucket, which triggers no function
+BATCH_BUCKET = os.getenv('BATCH_BUCKET', 'slackdumpanalysisstate')
+BATCH_PREFIX = os.getenv('BATCH_PREFIX', '_batches/')
+# A claim older than this is taken to belong to an invocation that died while collecting
+BATCH_CLAIM_TTL_SECONDS = int(os.getenv('BATCH_CLAIM_TTL_SECONDS', '900'))
+# When set, jobs and batches are kept in this local directory and run by LocalBatchBackend
+BATCH_DIR = os.getenv('BATCH_DIR')
+
+JOB_FILE = 'job.json'
+REQUESTS_FILE = 'requests.jsonl'
+CLAIM_FILE = 'claim.json'
+
+def dumps_requests(requests):
+    return ''.join(json.dumps(request, ensure_ascii=False) + '\n' for request in requests)
+
+class AnthropicBatchBackend:
+    """
+    Submits requests through the Message Batches API of the pooled Anthropic client.
+    """
+    def __init__(self, client=None):
+        self.client = client or get_transport()
+
+    def submit(self, requests):
+        batch = self.client.messages.batches.create(requests=requests)
+        return batch.id
+
+    def poll(self, batch_id):
+        batch = self.client.messages.batches.retrieve(batch_id)
+        print(f"Batch {batch_id}: {batch.processing_status}, {batch.request_counts}")
+        return batch.processing_status == 'ended'
+
+    def results(self, batch_id):
+        """
+        :return: An iterator of (custom_id, reply text), with None as the text of failed requests.
+        """
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == 'succeeded':
+                yield entry.custom_id, response_text(entry.result.message)
+            else:
+                print(f"Batch request {entry.custom_id} {entry.result.type}")
+                yield entry.custom_id, None
+
+class LocalBatchBackend:
+    """
+    Local stand-in for the batch API. A batch is written to a directory on submit and run
+    through the gateway transport (e.g. a FakeTransport) the first time it is polled.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, batch_id, suffix):
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def submit(self, requests):
+        batch_id = f"localbatch_{uuid.uuid4().hex}"
+        with open(self.path(batch_id, 'requests.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(dumps_requests(requests))
+        return batch_id
+
+    def poll(self, batch_id):
+        results_path = self.path(batch_id, 'results.jsonl')
+        if os.path.exists(results_path):
+            return True
+
+        results = []
+        with open(self.path(batch_id, 'requests.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                request = json.loads(line)
+                params = dict(request['params'])
+                try:
+                    text = response_text(create_message(params.pop('messages'), **params))
+                except Exception as e:
+                    print(f"Batch request {request['custom_id']} errored: {e}")
+                    text = None
+                results.append({'custom_id': request['custom_id'], 'text': text})
+        with open(results_path, 'w', encoding='utf-8') as f:
+            f.write(dumps_requests(results))
+        return True
+
+    def results(self, batch_id):
+        with open(self.path(batch_id, 'results.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                result = json.loads(line)
+                yield result['custom_id'], result['text']
+
+class S3BatchJobStore:
+    """
+    Keeps every pending job as <prefix><job_id>/job.json next to the request file that was submitted.
+    """
+    def __init__(self, bucket_name, prefix, s3_client):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client
+
+    def save(self, job, requests):
+        job_prefix = f"{self.prefix}{job['job_id']}/"
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=job_prefix + REQUESTS_FILE,
+                                  Body=dumps_requests(requests).encode('utf-8'), ContentType='application/x-ndjson')
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=job_prefix + JOB_FILE,
+                                  Body=json.dumps(job).encode('utf-8'), ContentType='application/json')
+
+    def list_pending(self):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith('/' + JOB_FILE):
+                    continue
+                try:
+                    response = self.s3_client.get_object(Bucket=self.bucket_name, Key=obj['Key'])
+                except ClientError as e:
+                    print(f"Error reading batch job {obj['Key']}: {e}")
+                    continue
+                yield json.loads(response['Body'].read())
+
+    def claim(self, job_id):
+        """
+        Claims a job for collection with a conditional put of its claim object, so concurrent
+        invocations never collect the same job twice.
+        :return: Whether this invocation holds the claim.
+        """
+        claim_key = f"{self.prefix}{job_id}/{CLAIM_FILE}"
+        body = json.dumps({'claimed_at': time.time()}).encode('utf-8')
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=claim_key, Body=body, IfNoneMatch='*')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            if not self.take_over_stale_claim(claim_key, body):
+                return False
+        # The job may have been collected and deleted between listing it and claiming it
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=f"{self.prefix}{job_id}/{JOB_FILE}")
+        except ClientError:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=claim_key)
+            return False
+        return True
+
+    def take_over_stale_claim(self, claim_key, body):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=claim_key)
+            if time.time() - json.loads(response['Body'].read())['claimed_at'] < BATCH_CLAIM_TTL_SECONDS:
+                return False
+            # Only one invocation replaces the stale claim it read
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=claim_key, Body=body, IfMatch=response['ETag'])
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, job_id):
+        job_prefix = f"{self.prefix}{job_id}/"
+        # The claim goes last, so a job is never seen unclaimed after it was collected
+        for name in (JOB_FILE, REQUESTS_FILE, CLAIM_FILE):
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=job_prefix + name)
+
+class LocalBatchJobStore:
+    """
+    Local-directory stand-in for S3BatchJobStore with the same layout.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def save(self, job, requests):
+        job_dir = os.path.join(self.directory, job['job_id'])
+        os.makedirs(job_dir, exist_ok=True)
+        with open(os.path.join(job_dir, REQUESTS_FILE), 'w', encoding='utf-8') as f:
+            f.write(dumps_requests(requests))
+        with open(os.path.join(job_dir, JOB_FILE), 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+
+    def list_pending(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            job_path = os.path.join(self.directory, name, JOB_FILE)
+            if os.path.exists(job_path):
+                with open(job_path, 'r', encoding='utf-8') as f:
+                    yield json.load(f)
+
+    def claim(self, job_id):
+        job_dir = os.path.join(self.directory, job_id)
+        claim_path = os.path.join(job_dir, CLAIM_FILE)
+        if os.path.exists(claim_path) and time.time() - os.path.getmtime(claim_path) >= BATCH_CLAIM_TTL_SECONDS:
+            os.remove(claim_path)
+        try:
+            os.close(os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except (FileExistsError, FileNotFoundError):
+            return False
+        if not os.path.exists(os.path.join(job_dir, JOB_FILE)):
+            os.remove(claim_path)
+            return False
+        return True
+
+    def delete(self, job_id):
+        job_dir = os.path.join(self.directory, job_id)
+        for name in (JOB_FILE, REQUESTS_FILE, CLAIM_FILE):
+            path = os.path.join(job_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(job_dir) and not os.listdir(job_dir):
+            os.rmdir(job_dir)
+
+def get_batch_backend():
+    if BATCH_DIR:
+        return LocalBatchBackend(os.path.join(BATCH_DIR, 'backend'))
+    return AnthropicBatchBackend()
+
+def get_batch_store(s3_client):
+    if BATCH_DIR:
+        return LocalBatchJobStore(os.path.join(BATCH_DIR, 'jobs'))
+    return S3BatchJobStore(BATCH_BUCKET, BATCH_PREFIX, s3_client)
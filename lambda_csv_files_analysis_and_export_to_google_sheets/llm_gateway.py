@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import anthropic
+import httpx
+from response_cache import get_response_cache, cache_key
+
+DEFAULT_MODEL = "claude-3-haiku-20240307"
+
+# Tunables, overridable through the Lambda environment
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', '60'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '5'))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', '1'))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', '30'))
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '20'))
+# Upper bound of concurrent calls made by map_concurrently
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
+# Marks the system prompt and fixed instructions as cacheable prefixes
+LLM_PROMPT_CACHING = os.getenv('LLM_PROMPT_CACHING', 'true').lower() in ('1', 'true', 'yes')
+
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+# 429 is a rate limit and 529 an overloaded API; both clear up after backing off
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RATE_LIMIT_STATUS_CODES = {429, 529}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+class GatewayMetrics:
+    """
+    Thread-safe counters of the calls made through the gateway in this container.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.latency_seconds = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_creation_input_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.response_cache_hits = 0
+        self.response_cache_misses = 0
+
+    def record(self, latency, attempts, usage=None, failed=False):
+        with self.lock:
+            self.calls += 1
+            self.failures += 1 if failed else 0
+            self.retries += attempts - 1
+            self.latency_seconds += latency
+            if usage is not None:
+                self.input_tokens += getattr(usage, 'input_tokens', 0) or 0
+                self.output_tokens += getattr(usage, 'output_tokens', 0) or 0
+                self.cache_creation_input_tokens += getattr(usage, 'cache_creation_input_tokens', 0) or 0
+                self.cache_read_input_tokens += getattr(usage, 'cache_read_input_tokens', 0) or 0
+
+    def record_response_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.response_cache_hits += 1
+            else:
+                self.response_cache_misses += 1
+
+    def record_rate_limit(self):
+        with self.lock:
+            self.rate_limited += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'failures': self.failures,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'latency_seconds': round(self.latency_seconds, 3),
+                'input_tokens': self.input_tokens,
+                'output_tokens': self.output_tokens,
+                'cache_creation_input_tokens': self.cache_creation_input_tokens,
+                'cache_read_input_tokens': self.cache_read_input_tokens,
+                'response_cache_hits': self.response_cache_hits,
+                'response_cache_misses': self.response_cache_misses,
+            }
+
+metrics = GatewayMetrics()
+
+class TransportError(Exception):
+    """
+    An API error raised by FakeTransport, carrying the HTTP status code like anthropic.APIStatusError.
+    """
+    def __init__(self, status_code, message='', retry_after=None):
+        super().__init__(message or f"HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class FakeUsage:
+    def __init__(self, input_tokens, output_tokens, cache_creation_input_tokens=0, cache_read_input_tokens=0):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_creation_input_tokens = cache_creation_input_tokens
+        self.cache_read_input_tokens = cache_read_input_tokens
+
+class FakeContent:
+    def __init__(self, text):
+        self.type = 'text'
+        self.text = text
+
+class FakeToolUse:
+    def __init__(self, name, tool_input):
+        self.type = 'tool_use'
+        self.name = name
+        self.input = tool_input
+
+class FakeResponse:
+    def __init__(self, text, usage, tool_name=None):
+        self.content = [FakeContent(text)]
+        self.usage = usage
+        self.stop_reason = 'end_turn'
+        if tool_name is not None:
+            # A forced tool call comes back as the tool input when the reply is a JSON object
+            try:
+                tool_input = json.loads(text)
+            except ValueError:
+                tool_input = None
+            if isinstance(tool_input, dict):
+                self.content = [FakeToolUse(tool_name, tool_input)]
+                self.stop_reason = 'tool_use'
+
+class FakeTransport:
+    """
+    Offline stand-in for anthropic.Anthropic exposing messages.create. Tokens are estimated
+    at four characters each, and prefixes marked with cache_control are reported as cache
+    writes the first time and as cache reads afterwards.
+    :param responder: A callable receiving the request kwargs and returning the reply text, or a fixed reply.
+    :param errors: Exceptions (or None for success) consumed one per call before the responder is used.
+    """
+    def __init__(self, responder='{}', errors=None):
+        self.responder = responder
+        self.errors = list(errors or [])
+        self.requests = []
+        self.cached_prefixes = set()
+        self.lock = threading.Lock()
+        self.messages = self
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs)
+            error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        text = self.responder(kwargs) if callable(self.responder) else self.responder
+        tool_choice = kwargs.get('tool_choice') or {}
+        return FakeResponse(text, self.usage(kwargs, text), tool_choice.get('name'))
+
+    def usage(self, request, text):
+        blocks = text_blocks(request.get('system')) + [block for message in request.get('messages', [])
+                                                       for block in text_blocks(message['content'])]
+        digest = hashlib.sha256()
+        chars = read_chars = cached_chars = 0
+        with self.lock:
+            for block in blocks:
+                digest.update(block['text'].encode('utf-8'))
+                chars += len(block['text'])
+                if 'cache_control' in block:
+                    prefix = digest.hexdigest()
+                    if prefix in self.cached_prefixes:
+                        read_chars = chars
+                    self.cached_prefixes.add(prefix)
+                    cached_chars = chars
+        return FakeUsage((chars - cached_chars) // 4, len(text) // 4,
+                         cache_creation_input_tokens=(cached_chars - read_chars) // 4,
+                         cache_read_input_tokens=read_chars // 4)
+
+def text_blocks(content):
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{'type': 'text', 'text': content}]
+    return [block for block in content if block.get('type') == 'text']
+
+def cacheable(text):
+    """
+    A text block marked as the end of a cacheable prompt prefix.
+    """
+    block = {'type': 'text', 'text': text}
+    if LLM_PROMPT_CACHING:
+        block['cache_control'] = CACHE_CONTROL
+    return block
+
+def user_content(prompt, prefix=None):
+    """
+    Puts the fixed instructions before the per-call prompt, so calls that differ only in the
+    prompt share a cached prefix.
+    """
+    if not prefix:
+        return prompt
+    return [cacheable(prefix), {'type': 'text', 'text': prompt}]
+
+def message_params(prompt, system=None, prefix=None, model=DEFAULT_MODEL, max_tokens=1024, tool=None):
+    """
+    The Messages API parameters of a complete() call, e.g. for a batch request.
+    :param tool: A tool the model is made to call, so the reply follows its input schema.
+    """
+    params = {
+        'model': model,
+        'max_tokens': max_tokens,
+        'messages': [{"role": "user", "content": user_content(prompt, prefix)}]
+    }
+    if system is not None:
+        params['system'] = [cacheable(system)]
+    if tool is not None:
+        params['tools'] = [tool]
+        params['tool_choice'] = {'type': 'tool', 'name': tool['name']}
+    return params
+
+def get_transport():
+    """
+    Returns one pooled Anthropic client per warm container, so keep-alive connections and
+    TLS sessions are reused across calls. Retries are handled here rather than by the SDK.
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = anthropic.Anthropic(
+                    api_key=os.environ['CLAUDE_API_KEY'],
+                    max_retries=0,
+                    timeout=LLM_TIMEOUT_SECONDS,
+                    http_client=httpx.Client(limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                                                 max_keepalive_connections=LLM_MAX_CONNECTIONS))
+                )
+    return _transport
+
+def set_transport(transport):
+    """
+    Replaces the pooled client, e.g. with a FakeTransport for offline runs.
+    """
+    global _transport
+    with _transport_lock:
+        _transport = transport
+
+def is_retryable(error):
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES
+
+def retry_delay(error, attempt):
+    """
+    Full-jitter exponential backoff, never shorter than a retry-after hint from the API.
+    """
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    retry_after = getattr(error, 'retry_after', None)
+    response = getattr(error, 'response', None)
+    if retry_after is None and response is not None:
+        retry_after = response.headers.get('retry-after')
+    try:
+        return max(delay, float(retry_after)) if retry_after is not None else delay
+    except ValueError:
+        return delay
+
+def create_message(messages, system=None, model=DEFAULT_MODEL, max_tokens=1024, **params):
+    """
+    Sends one Messages API request through the pooled client, retrying rate limits,
+    overloads, server errors and timeouts with jittered exponential backoff.
+    A plain string system prompt is sent as a cacheable block.
+    :return: The API response.
+    """
+    transport = get_transport()
+    request = dict(model=model, max_tokens=max_tokens, messages=messages, **params)
+    if system is not None:
+        request['system'] = [cacheable(system)] if isinstance(system, str) else system
+
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            response = transport.messages.create(**request)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= LLM_MAX_RETRIES:
+                metrics.record(time.monotonic() - start, attempt + 1, failed=True)
+                raise
+            if getattr(e, 'status_code', None) in RATE_LIMIT_STATUS_CODES:
+                metrics.record_rate_limit()
+            delay = retry_delay(e, attempt)
+            attempt += 1
+            print(f"LLM call failed ({e}), retrying in {delay:.2f}s (attempt {attempt}/{LLM_MAX_RETRIES})")
+            time.sleep(delay)
+            continue
+
+        latency = time.monotonic() - start
+        metrics.record(latency, attempt + 1, response.usage)
+        usage = response.usage
+        print(f"LLM call: model={model} latency={latency:.2f}s attempts={attempt + 1} "
+              f"input_tokens={usage.input_tokens} output_tokens={usage.output_tokens} "
+              f"cache_read_tokens={getattr(usage, 'cache_read_input_tokens', 0) or 0} "
+              f"cache_write_tokens={getattr(usage, 'cache_creation_input_tokens', 0) or 0}")
+        return response
+
+def response_text(response):
+    """
+    The text of a reply. A tool call is returned as the JSON of its input, so structured
+    replies are cached and parsed like text ones.
+    """
+    for block in response.content:
+        if getattr(block, 'type', None) == 'tool_use':
+            return json.dumps(block.input, ensure_ascii=False)
+    return ''.join(block.text for block in response.content if getattr(block, 'type', 'text') == 'text')
+
+def lookup_response(request):
+    """
+    Looks a request up in the response cache.
+    :return: (cache key, cached reply text), with None as the key when the cache is off.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return None, None
+    key = cache_key(request)
+    text = cache.get(key)
+    metrics.record_response_cache(text is not None)
+    return key, text
+
+def store_response(key, text, model=None):
+    cache = get_response_cache()
+    if cache is not None and key is not None:
+        cache.put(key, text, model)
+
+def complete(prompt, system=None, prefix=None, model=DEFAULT_MODEL, max_tokens=1024, tool=None, **params):
+    """
+    Sends a single user prompt and returns the text of the reply. Replies are served from
+    the response cache when the same request was answered before.
+    :param prefix: Fixed instructions sent before the prompt as a cacheable block.
+    :param tool: A tool the model is made to call; the reply is then the JSON of its input.
+    """
+    request = message_params(prompt, system=system, prefix=prefix, model=model, max_tokens=max_tokens, tool=tool)
+    request.update(params)
+    key, text = lookup_response(request)
+    if text is not None:
+        return text
+
+    response = create_message(**request)
+    text = response_text(response)
+    # A reply cut off at max_tokens is not worth replaying
+    if response.stop_reason != 'max_tokens':
+        store_response(key, text, model)
+    return text
+
+class AdaptiveLimiter:
+    """
+    Async concurrency limit for LLM calls. The limit is halved once for every burst of
+    rate-limit or overload responses seen by the gateway, and grows back by one after
+    `recovery` calls complete without any.
+    """
+    def __init__(self, max_concurrency, min_concurrency=1, recovery=10):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = min(min_concurrency, self.max_concurrency)
+        self.limit = self.max_concurrency
+        self.recovery = recovery
+        self.active = 0
+        self.successes = 0
+        self.seen_rate_limits = metrics.rate_limited
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            rate_limited = metrics.rate_limited
+            if rate_limited > self.seen_rate_limits:
+                # Calls running at the same time see the same burst, so it only counts once
+                self.seen_rate_limits = rate_limited
+                self.successes = 0
+                if self.limit > self.min_concurrency:
+                    self.limit = max(self.min_concurrency, self.limit // 2)
+                    print(f"LLM rate limited, lowering concurrency to {self.limit}")
+            else:
+                self.successes += 1
+                if self.successes >= self.recovery and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+async def _map_concurrently(func, items, max_concurrency):
+    loop = asyncio.get_running_loop()
+    limiter = AdaptiveLimiter(max_concurrency)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        async def run(item):
+            await limiter.acquire()
+            try:
+                return await loop.run_in_executor(executor, func, item)
+            finally:
+                await limiter.release()
+
+        return await asyncio.gather(*(run(item) for item in items))
+
+def map_concurrently(func, items, max_concurrency=LLM_CONCURRENCY):
+    """
+    Calls a blocking LLM function such as get_completion on every item, keeping at most
+    max_concurrency calls in flight and backing off while the API is rate limiting.
+    :return: The results in the order of items.
+    """
+    items = list(items)
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    start = time.monotonic()
+    results = asyncio.run(_map_concurrently(func, items, max_concurrency))
+    print(f"Completed {len(items)} LLM calls with concurrency {max_concurrency} in {time.monotonic() - start:.2f}s")
+    return results
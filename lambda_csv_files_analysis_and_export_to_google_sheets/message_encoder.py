@@ -0,0 +1,86 @@
+import re
+import html
+from itertools import groupby
+from operator import itemgetter
+
+# Slack markup: <@U123|name>, <#C123|channel>, <!here>, <!subteam^S123|@team>, <https://url|label>
+USER_MENTION = re.compile(r'<@([A-Z0-9]+)(?:\|([^>]+))?>')
+CHANNEL_MENTION = re.compile(r'<#([A-Z0-9]+)(?:\|([^>]*))?>')
+SPECIAL_MENTION = re.compile(r'<!([a-z]+)(?:\^[^|>]*)?(?:\|([^>]+))?>')
+LINK = re.compile(r'<((?:https?|mailto):[^|>]+)(?:\|([^>]+))?>')
+WHITESPACE = re.compile(r'\s+')
+
+FORMAT_NOTE = ("One message per line as <date time> <user> [+reactions]: <text>. "
+               "Replies are indented under the message that started their thread.")
+
+def clean_text(text):
+    """
+    Renders Slack markup as plain text and puts the message on a single line.
+    """
+    if not text:
+        return ''
+    text = USER_MENTION.sub(lambda m: '@' + (m.group(2) or m.group(1)), text)
+    text = CHANNEL_MENTION.sub(lambda m: '#' + (m.group(2) or m.group(1)), text)
+    text = SPECIAL_MENTION.sub(lambda m: m.group(2) or '@' + m.group(1), text)
+    text = LINK.sub(lambda m: m.group(2) or m.group(1).split('://', 1)[-1], text)
+    return WHITESPACE.sub(' ', html.unescape(text)).strip()
+
+class UserAliases:
+    """
+    Short aliases (u1, u2, ...) given to user names in order of first appearance.
+    Sharing one instance keeps the aliases stable across the chunks of a channel.
+    """
+    def __init__(self):
+        self.aliases = {}
+
+    def alias(self, name):
+        name = name or 'Unknown'
+        if name not in self.aliases:
+            self.aliases[name] = f"u{len(self.aliases) + 1}"
+        return self.aliases[name]
+
+def reaction_count(row):
+    try:
+        return int(row.get('Total Reactions') or 0)
+    except ValueError:
+        return 0
+
+def encode_rows(rows, aliases=None, include_times=True, include_users=True):
+    """
+    Encodes converted CSV rows, ordered by thread, as compact lines for a prompt.
+    Thread ids, thread timestamps and message types are implied by the layout, reactions
+    are only shown when there are any, and replies repeat only the time of day.
+    :param aliases: A UserAliases to share between calls; a new one is used when None.
+    :return: The encoded text, starting with the format note and the user legend when
+             times or users are included.
+    """
+    aliases = aliases if aliases is not None else UserAliases()
+    users = {}
+    lines = []
+
+    for _, thread in groupby(rows, key=itemgetter('Thread Date & Time')):
+        thread_date = None
+        for position, row in enumerate(thread):
+            reply = position > 0
+            fields = []
+            if include_times:
+                date, _, clock = (row['Date & Time'] or '').partition(' ')
+                fields.append(clock[:5] if reply and date == thread_date else f"{date} {clock[:5]}")
+                if not reply:
+                    thread_date = date
+            if include_users:
+                alias = aliases.alias(row["User's Name"])
+                users[alias] = row["User's Name"] or 'Unknown'
+                reactions = reaction_count(row)
+                fields.append(f"{alias} +{reactions}" if reactions else alias)
+
+            text = clean_text(row['Text Message'])
+            line = f"{' '.join(fields)}: {text}" if fields else text
+            lines.append('  ' + line if reply else line)
+
+    header = []
+    if include_times or include_users:
+        header.append(FORMAT_NOTE)
+    if users:
+        header.append('Users: ' + ', '.join(f"{alias}={name}" for alias, name in users.items()))
+    return '\n'.join(header + lines)
@@ -0,0 +1,256 @@
+"""
+Cheap local triage of primary messages before they are classified by the LLM.
+
+Rules skip the obvious noise (known bot posts, emoji-only or very short messages, join notices,
+welcome posts and job ads) and down-route messages without a user name to packed classification.
+A hashing naive Bayes classifier, trained on earlier LLM output, scores the rest: messages that
+are very unlikely to be relevant are skipped, unlikely ones are down-routed to packed
+classification and the others are classified one by one as before.
+
+Train a model from *_primary_messages_analyzed.csv files with:
+    python message_triage.py train triage_model.json analyzed1.csv [analyzed2.csv ...]
+"""
+import os
+import re
+import sys
+import csv
+import json
+import math
+import zlib
+from message_encoder import clean_text
+
+TRIAGE_ENABLED = os.getenv('TRIAGE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Optional JSON file overriding DEFAULT_RULES
+TRIAGE_RULES_FILE = os.getenv('TRIAGE_RULES_FILE')
+# Classifier model shipped with the function; without it only the rules apply
+TRIAGE_MODEL_FILE = os.getenv('TRIAGE_MODEL_FILE', 'triage_model.json')
+# Probability of relevance below which a message is skipped or down-routed to packed classification
+TRIAGE_SKIP_BELOW = float(os.getenv('TRIAGE_SKIP_BELOW', '0.1'))
+TRIAGE_PACK_BELOW = float(os.getenv('TRIAGE_PACK_BELOW', '0.4'))
+# Messages per request for the down-routed ones
+TRIAGE_PACK_SIZE = int(os.getenv('TRIAGE_PACK_SIZE', '8'))
+# Relevance score from which an analysed message counts as relevant when training
+TRIAGE_RELEVANT_SCORE = int(os.getenv('TRIAGE_RELEVANT_SCORE', '5'))
+
+ROUTE_SKIP = 'skip'
+ROUTE_PACK = 'pack'
+ROUTE_LLM = 'llm'
+
+DEFAULT_RULES = {
+    'min_words': 3,
+    # A missing real name does not tell a bot from a person, so such messages are packed rather than skipped
+    'skip_empty_user': False,
+    'pack_empty_user': True,
+    'skip_users': ['Slackbot', 'Polly', 'Donut', 'Zapier', 'Giphy'],
+    'skip_patterns': {
+        'join notice': r'\bhas (joined|left) the channel\b',
+        'welcome post': r'^\W*(a (warm|big) )?welcome\b',
+        'job ad': r"\b(we('re| are) hiring|is hiring|job opening|open (role|position)s?|apply (here|now|today))\b",
+    },
+}
+
+EMOJI = re.compile(r':[a-z0-9_+\-]+:')
+WORD = re.compile(r"[a-z0-9']+")
+
+def load_rules(path=TRIAGE_RULES_FILE):
+    rules = dict(DEFAULT_RULES)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            rules.update(json.load(f))
+    rules['compiled_patterns'] = [(reason, re.compile(pattern, re.IGNORECASE))
+                                  for reason, pattern in rules['skip_patterns'].items()]
+    return rules
+
+def rule_reason(row, rules):
+    """
+    :return: Why the rules skip the message, or None when no rule applies.
+    """
+    user = row.get("User's Name") or ''
+    if rules['skip_empty_user'] and not user:
+        return 'no user name (bot or integration)'
+    if user in rules['skip_users']:
+        return f"bot user {user}"
+
+    text = clean_text(row.get('Text Message'))
+    if not WORD.search(EMOJI.sub(' ', text.lower())):
+        return 'emoji-only or empty'
+    for reason, pattern in rules['compiled_patterns']:
+        if pattern.search(text):
+            return reason
+    if len(text.split()) < rules['min_words']:
+        return f"fewer than {rules['min_words']} words"
+    return None
+
+def features(text, n_features):
+    """
+    Hashes the unigrams and bigrams of a message into n_features buckets. crc32 is used
+    because it is stable across processes, unlike hash().
+    """
+    words = WORD.findall(EMOJI.sub(' ', clean_text(text).lower()))
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return [zlib.crc32(gram.encode('utf-8')) % n_features for gram in grams]
+
+class HashingNaiveBayes:
+    """
+    Multinomial naive Bayes over hashed word features with Laplace smoothing.
+    Only the non-zero buckets are stored, so the model stays a small JSON file.
+    """
+    def __init__(self, n_features=2 ** 18, alpha=1.0):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.doc_counts = {'0': 0, '1': 0}
+        self.feature_counts = {'0': {}, '1': {}}
+        self.totals = {'0': 0, '1': 0}
+
+    def fit(self, texts, labels):
+        for text, label in zip(texts, labels):
+            label = '1' if label else '0'
+            self.doc_counts[label] += 1
+            counts = self.feature_counts[label]
+            for bucket in features(text, self.n_features):
+                counts[bucket] = counts.get(bucket, 0) + 1
+                self.totals[label] += 1
+        return self
+
+    def predict_proba(self, text):
+        """
+        :return: The probability that the message is relevant.
+        """
+        docs = self.doc_counts['0'] + self.doc_counts['1']
+        if not docs:
+            return 0.5
+        scores = {}
+        buckets = features(text, self.n_features)
+        for label in ('0', '1'):
+            score = math.log((self.doc_counts[label] + 1) / (docs + 2))
+            denominator = self.totals[label] + self.alpha * self.n_features
+            counts = self.feature_counts[label]
+            for bucket in buckets:
+                score += math.log((counts.get(bucket, 0) + self.alpha) / denominator)
+            scores[label] = score
+        return 1 / (1 + math.exp(max(-700.0, min(700.0, scores['0'] - scores['1']))))
+
+    def to_dict(self):
+        return {'n_features': self.n_features, 'alpha': self.alpha, 'doc_counts': self.doc_counts, 'totals': self.totals,
+                'feature_counts': {label: {str(k): v for k, v in counts.items()} for label, counts in self.feature_counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(data['n_features'], data['alpha'])
+        model.doc_counts = data['doc_counts']
+        model.totals = data['totals']
+        model.feature_counts = {label: {int(k): v for k, v in counts.items()} for label, counts in data['feature_counts'].items()}
+        return model
+
+def load_model(path=TRIAGE_MODEL_FILE):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return HashingNaiveBayes.from_dict(json.load(f))
+
+class Triage:
+    """
+    Routes primary message rows to ROUTE_SKIP, ROUTE_PACK or ROUTE_LLM.
+    """
+    def __init__(self, rules=None, model=None, skip_below=TRIAGE_SKIP_BELOW, pack_below=TRIAGE_PACK_BELOW):
+        self.rules = rules if rules is not None else load_rules()
+        self.model = model
+        self.skip_below = skip_below
+        self.pack_below = pack_below
+
+    def route(self, row):
+        """
+        :return: (route, reason)
+        """
+        reason = rule_reason(row, self.rules)
+        if reason is not None:
+            return ROUTE_SKIP, reason
+        if self.rules['pack_empty_user'] and not row.get("User's Name"):
+            return ROUTE_PACK, 'no user name'
+        if self.model is None:
+            return ROUTE_LLM, None
+
+        probability = self.model.predict_proba(row.get('Text Message'))
+        if probability < self.skip_below:
+            return ROUTE_SKIP, f"classifier relevance {probability:.2f}"
+        if probability < self.pack_below:
+            return ROUTE_PACK, f"classifier relevance {probability:.2f}"
+        return ROUTE_LLM, None
+
+    def route_rows(self, rows):
+        """
+        Routes every row and logs each skip with its reason.
+        """
+        routes = [self.route(row) for row in rows]
+        for row, (route, reason) in zip(rows, routes):
+            if route == ROUTE_SKIP:
+                print(f"Triage skipped {row.get('Thread Id')}: {reason}")
+        counts = {name: sum(1 for route, _ in routes if route == name) for name in (ROUTE_SKIP, ROUTE_PACK, ROUTE_LLM)}
+        print(f"Triage of {len(rows)} messages: {counts}")
+        return routes
+
+_triage = None
+
+def get_triage():
+    """
+    :return: The Triage of this container, or None when TRIAGE_ENABLED is off.
+    """
+    global _triage
+    if not TRIAGE_ENABLED:
+        return None
+    if _triage is None:
+        _triage = Triage(model=load_model())
+    return _triage
+
+def skipped_classification(reason):
+    """
+    The classification recorded for a skipped message, in the keys the LLM would have used.
+    """
+    return {
+        "Nature of Message": "Primary message",
+        "Suitable for Atlas": "No",
+        "Reason": f"Skipped by triage: {reason}",
+        "Suitable for Team Member": "No",
+        "Suitable Member": "No one",
+        "Classification": "None of these",
+        "Question About": "None",
+        "Relevance Score": 0,
+        "Summary": "",
+        "Suggested Response": "",
+    }
+
+def training_rows(paths):
+    for path in paths:
+        with open(path, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if str(row.get('Why?', '')).startswith('Skipped by triage'):
+                    continue
+                try:
+                    score = float(row.get('Relevance Score') or 0)
+                except ValueError:
+                    score = 0
+                relevant = row.get('Should Atlas participate?') == 'Yes' or score >= TRIAGE_RELEVANT_SCORE
+                yield row['Message'], relevant
+
+def train(model_path, paths):
+    """
+    Trains a model on analysed output CSVs, reporting the accuracy on the last fifth.
+    """
+    samples = list(training_rows(paths))
+    split = len(samples) * 4 // 5
+    model = HashingNaiveBayes().fit(*zip(*samples[:split])) if split else HashingNaiveBayes()
+    holdout = samples[split:]
+    if holdout:
+        correct = sum((model.predict_proba(text) >= 0.5) == relevant for text, relevant in holdout)
+        print(f"Hold-out accuracy {correct / len(holdout):.3f} on {len(holdout)} messages")
+
+    model = HashingNaiveBayes().fit(*zip(*samples)) if samples else model
+    with open(model_path, 'w', encoding='utf-8') as f:
+        json.dump(model.to_dict(), f, separators=(',', ':'))
+    print(f"Trained on {len(samples)} messages ({sum(relevant for _, relevant in samples)} relevant), saved to {model_path}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] != 'train':
+        print(__doc__)
+        sys.exit(1)
+    train(sys.argv[2], sys.argv[3:])
@@ -0,0 +1,184 @@
+"""
+Near-duplicate detection of primary messages cross-posted to several channels.
+
+Messages are normalised, split into word shingles and summarised by a MinHash signature.
+Locality-sensitive hashing over bands of the signature finds candidates, which count as
+duplicates when their estimated Jaccard similarity reaches NEAR_DUP_THRESHOLD. The index keeps
+the analysis of every representative for NEAR_DUP_WINDOW_DAYS, so a cross-post processed in a
+later invocation reuses it too.
+"""
+import os
+import re
+import json
+import time
+import struct
+import hashlib
+import boto3
+from botocore.exceptions import ClientError, BotoCoreError
+from message_encoder import clean_text
+
+# 's3' shares the index between invocations, 'local' keeps it in NEAR_DUP_PATH, 'off' disables detection
+NEAR_DUP_BACKEND = os.getenv('NEAR_DUP_BACKEND', 's3')
+# Kept out of the analysed-files bucket, whose uploads trigger the Sheets export
+NEAR_DUP_BUCKET = os.getenv('NEAR_DUP_BUCKET', 'slackdumpanalysisstate')
+NEAR_DUP_KEY = os.getenv('NEAR_DUP_KEY', '_near_duplicates/index.json')
+NEAR_DUP_PATH = os.getenv('NEAR_DUP_PATH', '/tmp/near_duplicates.json')
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0.8'))
+NEAR_DUP_WINDOW_DAYS = float(os.getenv('NEAR_DUP_WINDOW_DAYS', '7'))
+# Shorter messages are too generic to be told apart reliably
+NEAR_DUP_MIN_WORDS = int(os.getenv('NEAR_DUP_MIN_WORDS', '6'))
+
+# 16 bands of 4 rows: pairs from about 0.5 Jaccard similarity up become candidates
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# Fixed seeds, so signatures stay comparable across containers and invocations
+_PERMUTATIONS = [(int.from_bytes(hashlib.sha256(b'a%d' % i).digest()[:8], 'big') % (MERSENNE_PRIME - 1) + 1,
+                  int.from_bytes(hashlib.sha256(b'b%d' % i).digest()[:8], 'big') % MERSENNE_PRIME)
+                 for i in range(NUM_PERM)]
+
+URL = re.compile(r'https?://\S+|www\.\S+')
+MENTION = re.compile(r'[@#]\S+')
+WORD = re.compile(r"[a-z0-9']+")
+
+def normalise(text):
+    """
+    Lowercases the plain text of a message and drops links, mentions and punctuation, which
+    usually differ between cross-posts.
+    """
+    text = clean_text(text).lower()
+    text = MENTION.sub(' ', URL.sub(' ', text))
+    return WORD.findall(text)
+
+def minhash(text):
+    """
+    :return: The MinHash signature of the message, or None when it is too short to compare.
+    """
+    words = normalise(text)
+    if len(words) < NEAR_DUP_MIN_WORDS:
+        return None
+    shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = [struct.unpack('<I', hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest())[0]
+              for shingle in shingles]
+    return [min(((a * value + b) % MERSENNE_PRIME) & MAX_HASH for value in hashes) for a, b in _PERMUTATIONS]
+
+def similarity(signature, other):
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_PERM
+
+def band_keys(signature):
+    return [f"{band}:{hash(tuple(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]))}" for band in range(BANDS)]
+
+class NearDuplicateIndex:
+    """
+    LSH index of representative messages, keyed by a reference such as "<source key>#<Thread Id>".
+    Every entry keeps its signature and, once analysed, its classification and thread summary.
+    """
+    def __init__(self, entries=None, threshold=NEAR_DUP_THRESHOLD, window_days=NEAR_DUP_WINDOW_DAYS):
+        self.threshold = threshold
+        self.window_seconds = window_days * 24 * 3600
+        self.entries = {}
+        self.buckets = {}
+        for ref, entry in (entries or {}).items():
+            if self.is_fresh(entry):
+                self.insert(ref, entry)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['created_at'] <= self.window_seconds
+
+    def insert(self, ref, entry):
+        self.entries[ref] = entry
+        for key in band_keys(entry['signature']):
+            self.buckets.setdefault(key, []).append(ref)
+
+    def query(self, signature):
+        """
+        :return: The reference of the most similar representative at or above the threshold, or None.
+        """
+        candidates = {ref for key in band_keys(signature) for ref in self.buckets.get(key, ())}
+        best, best_similarity = None, 0.0
+        for ref in sorted(candidates):
+            score = similarity(signature, self.entries[ref]['signature'])
+            if score >= self.threshold and score > best_similarity:
+                best, best_similarity = ref, score
+        return best
+
+    def add(self, ref, signature):
+        self.insert(ref, {'signature': signature, 'created_at': time.time(), 'classification': None, 'summary': None})
+
+    def record(self, ref, classification=None, summary=None):
+        entry = self.entries.get(ref)
+        if entry is None:
+            return
+        if classification is not None:
+            entry['classification'] = classification
+        if summary is not None:
+            entry['summary'] = summary
+
+    def to_dict(self):
+        """
+        The entries within the window that have an analysis to share.
+        """
+        return {ref: entry for ref, entry in self.entries.items()
+                if self.is_fresh(entry) and (entry['classification'] is not None or entry['summary'] is not None)}
+
+class S3NearDuplicateStore:
+    """
+    Keeps the index as one JSON object in S3. Concurrent invocations may overwrite each other's
+    additions, which only costs some missed duplicates.
+    """
+    def __init__(self, bucket_name, key, s3_client=None):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.s3_client = s3_client or boto3.client('s3')
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+            return NearDuplicateIndex(json.loads(response['Body'].read()).get('entries', {}))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f"Error reading near-duplicate index: {e}")
+        except (BotoCoreError, ValueError) as e:
+            print(f"Error reading near-duplicate index: {e}")
+        return NearDuplicateIndex()
+
+    def save(self, index):
+        body = json.dumps({'entries': index.to_dict()}, ensure_ascii=False, separators=(',', ':'))
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=body.encode('utf-8'),
+                                      ContentType='application/json')
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error saving near-duplicate index: {e}")
+
+class LocalNearDuplicateStore:
+    """
+    Local-file stand-in for S3NearDuplicateStore with the same JSON layout.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return NearDuplicateIndex()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return NearDuplicateIndex(json.load(f).get('entries', {}))
+
+    def save(self, index):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': index.to_dict()}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+def get_near_duplicate_store():
+    """
+    :return: The configured store, or None when NEAR_DUP_BACKEND is 'off'.
+    """
+    if NEAR_DUP_BACKEND == 'off':
+        return None
+    if NEAR_DUP_BACKEND == 'local':
+        return LocalNearDuplicateStore(NEAR_DUP_PATH)
+    return S3NearDuplicateStore(NEAR_DUP_BUCKET, NEAR_DUP_KEY)
@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import threading
+
+# Replies are requested as a forced tool call whose input schema lists the expected keys
+LLM_STRUCTURED_OUTPUT = os.getenv('LLM_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+# Correction requests sent for a reply that still cannot be used after the local repairs
+LLM_REASK_ATTEMPTS = int(os.getenv('LLM_REASK_ATTEMPTS', '1'))
+# Characters of the failed reply quoted back in a correction request
+REASK_REPLY_CHARS = 4000
+
+# Control characters such as raw newlines are accepted inside strings
+DECODER = json.JSONDecoder(strict=False)
+CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+PYTHON_LITERALS = re.compile(r'(?<=[:\[,\s])(True|False|None)(?=\s*[,}\]])')
+JSON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+class ParseStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parsed = 0
+        self.repaired = 0
+        self.failed = 0
+        self.reasked = 0
+        self.recovered = 0
+
+    def add(self, name, count=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self):
+        with self.lock:
+            attempts = self.parsed + self.failed
+            return {'parsed': self.parsed, 'repaired': self.repaired, 'failed': self.failed, 'reasked': self.reasked,
+                    'recovered': self.recovered, 'failure_rate': round(self.failed / attempts, 4) if attempts else 0.0}
+
+parse_stats = ParseStats()
+
+def close_truncated(text):
+    """
+    Closes the string, arrays and objects left open by a reply cut off at max_tokens.
+    """
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+    text = text + '"' if in_string else text.rstrip().rstrip(',')
+    return text + ''.join(reversed(stack))
+
+# Applied one after the other until the reply decodes
+REPAIRS = [
+    ('code fence', lambda text: CODE_FENCE.search(text).group(1) if CODE_FENCE.search(text) else text),
+    ('trailing comma', lambda text: TRAILING_COMMA.sub(r'\1', text)),
+    ('smart quotes', lambda text: text.translate(SMART_QUOTES)),
+    ('python literals', lambda text: PYTHON_LITERALS.sub(lambda m: JSON_LITERALS[m.group(1)], text)),
+    ('truncation', close_truncated),
+]
+
+def decode_first(text):
+    """
+    Decodes the first JSON object or array in the text, ignoring any prose around it.
+    """
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        raise ValueError('no JSON object or array in the reply')
+    value, _ = DECODER.raw_decode(text, min(starts))
+    return value
+
+def loads_lenient(text):
+    """
+    Decodes a reply, repairing code fences, surrounding prose, trailing commas, smart quotes,
+    Python literals and truncation locally when it is not valid JSON as it is.
+    :return: (value, names of the repairs applied)
+    :raises ValueError: When the reply cannot be repaired.
+    """
+    try:
+        return decode_first(text), []
+    except ValueError as e:
+        error = e
+    applied = []
+    for name, repair in REPAIRS:
+        repaired = repair(text)
+        if repaired == text:
+            continue
+        text = repaired
+        applied.append(name)
+        try:
+            return decode_first(text), applied
+        except ValueError as e:
+            error = e
+    raise ValueError(f"invalid JSON: {error}")
+
+def required_keys(keys):
+    """
+    A validator accepting JSON objects that have all the given keys.
+    """
+    def validate(value):
+        if not isinstance(value, dict):
+            return f"expected a JSON object, got {type(value).__name__}"
+        missing = [key for key in keys if key not in value]
+        return f"missing keys: {', '.join(missing)}" if missing else None
+    return validate
+
+def check_reply(text, validate=None):
+    """
+    :return: (value, error), with None as the error when the reply is usable.
+    """
+    try:
+        value, repairs = loads_lenient(text or '')
+    except ValueError as e:
+        return None, str(e)
+    if repairs:
+        parse_stats.add('repaired')
+        print(f"Repaired reply JSON: {', '.join(repairs)}")
+    error = validate(value) if validate is not None else None
+    return (None, error) if error is not None else (value, None)
+
+def correction_prompt(prompt, reply, error):
+    """
+    Repeats the original prompt with the reply that could not be used and why.
+    """
+    return f"""{prompt}
+
+Your previous reply could not be used ({error}):
+<{(reply or '')[:REASK_REPLY_CHARS]}>
+Reply again with the complete, corrected JSON only."""
+
+def parse_reply(text, validate=None, reask=None):
+    """
+    Parses a JSON reply, repairing it locally first. When it still cannot be used and reask is
+    given, only this item is asked again, up to LLM_REASK_ATTEMPTS times.
+    :param validate: A callable returning an error message for an unusable value, or None.
+    :param reask: A callable receiving (reply, error) and returning a new reply text.
+    :return: (value, error), with None as the error when the reply is usable.
+    """
+    value, error = check_reply(text, validate)
+    attempts = 0
+    while error is not None and reask is not None and attempts < LLM_REASK_ATTEMPTS:
+        attempts += 1
+        parse_stats.add('reasked')
+        print(f"Asking again for a reply that could not be used ({error})")
+        text = reask(text, error)
+        value, error = check_reply(text, validate)
+        if error is None:
+            parse_stats.add('recovered')
+
+    parse_stats.add('failed' if error is not None else 'parsed')
+    return value, error
+
+def json_tool(name, description, properties, required=None):
+    """
+    A tool definition whose input schema is the expected reply. The gateway forces the model
+    to call it, so the reply comes back as schema-shaped JSON rather than free text.
+    """
+    return {
+        'name': name,
+        'description': description,
+        'input_schema': {'type': 'object', 'properties': properties,
+                         'required': list(required if required is not None else properties)},
+    }
+
+def string_properties(keys):
+    return {key: {'type': 'string'} for key in keys}
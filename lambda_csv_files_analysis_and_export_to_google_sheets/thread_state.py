@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import boto3
+from botocore.exceptions import ClientError, BotoCoreError
+
+# 's3' keeps thread state in a bucket shared by all containers, 'sqlite' in a local file, 'off' disables it
+THREAD_STATE_BACKEND = os.getenv('THREAD_STATE_BACKEND', 's3')
+# The state bucket triggers no function, unlike the output buckets watched by the Sheets lambdas
+THREAD_STATE_BUCKET = os.getenv('THREAD_STATE_BUCKET', 'slackdumpanalysisstate')
+THREAD_STATE_PREFIX = os.getenv('THREAD_STATE_PREFIX', '_thread_state/')
+THREAD_STATE_PATH = os.getenv('THREAD_STATE_PATH', '/tmp/thread_state.sqlite3')
+
+_store = None
+_store_lock = threading.Lock()
+
+def rows_hash(rows):
+    """
+    Hashes the ids and texts of thread rows, so an edited or deleted message changes the hash.
+    """
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(f"{row['Thread Id']}\x1f{row['Text Message'] or ''}\x1e".encode('utf-8'))
+    return digest.hexdigest()
+
+def message_ts(row):
+    try:
+        return float(row['Thread Id'])
+    except (TypeError, ValueError):
+        return 0.0
+
+def plan_thread(thread, state):
+    """
+    Compares a thread with its stored state. Rows up to the last processed ts must hash as
+    before; a later day's file holding none of them only adds the newer replies.
+    :return: ('full', rows), ('incremental', new rows) or ('skip', []).
+    """
+    if not state:
+        return 'full', thread
+    processed = [row for row in thread if message_ts(row) <= state['last_ts']]
+    new = [row for row in thread if message_ts(row) > state['last_ts']]
+    if processed and rows_hash(processed) != state['content_hash']:
+        return 'full', thread
+    if not new:
+        return 'skip', []
+    return 'incremental', new
+
+def thread_state(thread, summary, classification=None):
+    """
+    The state stored after a thread was summarised.
+    :param classification: The analysis of the primary message, reused while the message is unchanged.
+    """
+    return {'content_hash': rows_hash(thread), 'last_ts': max(message_ts(row) for row in thread),
+            'summary': summary, 'classification': classification, 'updated_at': time.time()}
+
+class SQLiteThreadStateStore:
+    """
+    Local SQLite stand-in for S3ThreadStateStore.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS thread_state (key TEXT PRIMARY KEY, state TEXT)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT state FROM thread_state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key, state):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO thread_state VALUES (?, ?)', (key, json.dumps(state)))
+
+class S3ThreadStateStore:
+    """
+    Keeps the state of every thread as one small JSON object under <prefix><key>.json:
+    the hash of its rows, the last processed reply ts, the last summary and the classification
+    of its primary message.
+    """
+    def __init__(self, bucket_name, prefix, s3_client=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client or boto3.client('s3')
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=f"{self.prefix}{key}.json")
+            return json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f"Error reading thread state {key}: {e}")
+        except (BotoCoreError, ValueError) as e:
+            print(f"Error reading thread state {key}: {e}")
+        return None
+
+    def put(self, key, state):
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=f"{self.prefix}{key}.json",
+                                      Body=json.dumps(state, ensure_ascii=False).encode('utf-8'),
+                                      ContentType='application/json')
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error saving thread state {key}: {e}")
+
+def get_thread_state_store():
+    """
+    :return: The thread state store of this container, or None when THREAD_STATE_BACKEND is 'off'.
+    """
+    global _store
+    if THREAD_STATE_BACKEND == 'off':
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if THREAD_STATE_BACKEND == 'sqlite':
+                    _store = SQLiteThreadStateStore(THREAD_STATE_PATH)
+                else:
+                    _store = S3ThreadStateStore(THREAD_STATE_BUCKET, THREAD_STATE_PREFIX)
+    return _store
+
+def set_thread_state_store(store):
+    global _store
+    with _store_lock:
+        _store = store
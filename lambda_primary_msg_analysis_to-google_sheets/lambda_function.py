@@ -115,6 +115,10 @@ def lambda_handler(event, context):
     for record in event['Records']:
         bucket = record['s3']['bucket']['name']
         key = unquote_plus(record['s3']['object']['key'])
+        # Only the analysed CSVs are exported; state objects such as _llm_cache/ entries are not
+        if not key.endswith('.csv') or key.startswith('_'):
+            print(f"Skipping {key}, not an analysed CSV file.")
+            continue
         tmpkey = key.replace('/', '')
         csv_file_download_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
         s3_client.download_file(bucket, key, csv_file_download_path)
@@ -1,89 +1,176 @@
 import boto3
+from botocore.config import Config
 import os
+import io
 import sys
-import uuid
 from urllib.parse import unquote_plus
 import json
 import csv
-import pytz
-from datetime import datetime
-
-s3_client = boto3.client('s3')
-
-def convert_to_csv(input_file_path, output_file_path):
-
-    selected_fields = ["Thread Id","Date & Time","User's Name","Text Message","Thread Date & Time","Message Type","Total Reactions"]
-
-    rows = []
-
-    if input_file_path.endswith('.json'):
-        with open(input_file_path, 'r', encoding='utf-8') as json_file:
-            data = json.load(json_file)
-            for obj in data:
-                selected_data = {}
-                if obj.get('subtype') == 'channel_join':
-                    continue
-                for field in selected_fields:
-                    if field == 'Date & Time':
-                        if 'ts' in obj:
-                            timestamp = float(obj['ts'])
-                            utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                            ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                            selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                    elif field == "User's Name":
-                        selected_data[field] = obj.get('user_profile', {}).get('real_name')
-                    elif field == 'Text Message':
-                            selected_data[field] = obj.get('text')
-                    elif field == 'Thread Date & Time':
-                        if 'thread_ts' in obj:
-                            timestamp = float(obj['thread_ts'])
-                            utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                            ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                            selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                        else:
-                            timestamp = float(obj['ts'])
-                            utc_date = datetime.fromtimestamp(timestamp, pytz.utc)
-                            ist_date = utc_date.astimezone(pytz.timezone('Asia/Kolkata'))
-                            selected_data[field] = ist_date.strftime('%Y-%m-%d %H:%M:%S')
-                    elif field == 'Thread Id':
-                        selected_data[field] = obj.get('ts')
-                    elif field == 'Message Type':
-                        if 'parent_user_id' not in obj:
-                            selected_data[field] = 'Primary Message'
-                        else:
-                            selected_data[field] = 'Reply'
-                    elif field == 'Total Reactions':
-                        reactions = obj.get('reactions')
-                        reaction_count = sum(reaction['count'] for reaction in reactions) if reactions else 0
-                        selected_data[field] = reaction_count
-                    else:
-                        selected_data[field] = None
-
-                rows.append(selected_data)
-
-    rows.sort(key=lambda x: (datetime.strptime(x.get('Thread Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Thread Date & Time') else datetime.min,
-                             datetime.strptime(x.get('Date & Time', ''), '%Y-%m-%d %H:%M:%S') if x.get('Date & Time') else datetime.min))
-
-    with open(output_file_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=selected_fields)
-        writer.writeheader()
-        writer.writerows(rows)
+import gzip
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from json_stream import iter_json_array, external_sort
+from row_extractor import SELECTED_FIELDS, compile_row_extractor, iter_keyed_rows
+from parquet_io import ParquetRowWriter, parquet_enabled, partition_key
+from thread_index import ThreadIndexBuilder, THREAD_INDEX_SUFFIX
 
-def lambda_handler(event, context):
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = unquote_plus(record['s3']['object']['key'])
-        tmpkey = key.replace('/', '')
-        download_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-        newkey = tmpkey.replace('.json', '')
-        upload_path = '/tmp/{}.csv'.format(newkey)
-
-        # Check if the file is one of the excluded files
-        if os.path.basename(key) in ['dms.json', 'mpims.json', 'channels.json', 'groups.json', 'users.json']:
-            print(f"Skipping {os.path.basename(key)} file.")
+# Records of one event converted at the same time
+CONVERT_MAX_WORKERS = int(os.getenv('CONVERT_MAX_WORKERS', '16'))
+
+s3_client = boto3.client('s3', config=Config(max_pool_connections=CONVERT_MAX_WORKERS * 2))
+
+extract_row = compile_row_extractor(SELECTED_FIELDS)
+
+EXCLUDED_FILES = ['dms.json', 'mpims.json', 'channels.json', 'groups.json', 'users.json']
+
+# Bundles written by the export lambda; they are converted through their manifest
+BUNDLE_SUFFIX = '.jsonl.gz'
+
+def write_csv(data, csv_file, parquet_writer=None, thread_index=None, tell=None):
+
+    # Rows are built as messages arrive and sorted on the numeric thread ts and ts within a bounded amount of memory
+    keyed_rows = external_sort(iter_keyed_rows(data, extract_row), key=itemgetter(0))
+
+    writer = csv.DictWriter(csv_file, fieldnames=SELECTED_FIELDS)
+    writer.writeheader()
+    for key, row in keyed_rows:
+        offset = tell() if tell else None
+        writer.writerow(row)
+        # The typed Parquet copy and the thread index are filled from the same pass
+        if parquet_writer:
+            parquet_writer.add(key, row)
+        if thread_index:
+            thread_index.add(key, row, offset, tell() if tell else None)
+
+def upload_csv(data, bucket, key):
+    """
+    Converts the messages of one export key to CSV in memory and uploads it to the
+    <bucket>csv bucket, without going through /tmp, together with its thread index sidecar.
+    When Parquet output is enabled, a typed copy partitioned by channel and date goes
+    to the <bucket>parquet bucket.
+    """
+    parquet_writer = ParquetRowWriter() if parquet_enabled() else None
+    thread_index = ThreadIndexBuilder()
+
+    buffer = io.BytesIO()
+    csv_file = io.TextIOWrapper(buffer, encoding='utf-8', newline='', write_through=True)
+    write_csv(data, csv_file, parquet_writer, thread_index, tell=buffer.tell)
+    csv_file.detach()
+    buffer.seek(0)
+    upload_key = key.replace('.json', '')
+    s3_client.upload_fileobj(buffer, '{}csv'.format(bucket), '{}.csv'.format(upload_key))
+    s3_client.put_object(Bucket='{}csv'.format(bucket), Key='{}{}'.format(upload_key, THREAD_INDEX_SUFFIX),
+                         Body=thread_index.dumps().encode('utf-8'), ContentType='application/json')
+
+    if parquet_writer:
+        s3_client.upload_fileobj(parquet_writer.close(), '{}parquet'.format(bucket), partition_key(key))
+
+def read_bundle_channel(bucket, bundle_key, entry):
+    """
+    Fetches one channel of a slackdump bundle with a range read.
+    :param bucket: The bucket holding the bundle.
+    :param bundle_key: The key of the .jsonl.gz bundle.
+    :param entry: The manifest entry of the channel, with its byte offset and length.
+    :return: An iterator of (day, messages) pairs in day order; each messages iterator
+             must be consumed before the next pair is requested.
+    """
+    byte_range = 'bytes={}-{}'.format(entry['offset'], entry['offset'] + entry['length'] - 1)
+    body = s3_client.get_object(Bucket=bucket, Key=bundle_key, Range=byte_range)['Body']
+    with gzip.GzipFile(fileobj=body, mode='rb') as gz:
+        lines = (json.loads(line) for line in gz if line.strip())
+        for day, items in groupby(lines, key=lambda item: item['day']):
+            yield day, (item['message'] for item in items)
+
+def process_bundle(bucket, manifest_key):
+    """
+    Converts every channel-day of a slackdump bundle into the same per-day CSV keys
+    that the per-file mode produces.
+    """
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+    prefix = manifest_key[:manifest_key.rindex('/') + 1] if '/' in manifest_key else ''
+    bundle_key = prefix + manifest['bundle']
+
+    for channel, entry in manifest['channels'].items():
+        if not entry['days']:
             continue
-        
-        s3_client.download_file(bucket, key, download_path)
-        convert_to_csv(download_path, upload_path)
-        upload_key = key.replace('.json', '')
-        s3_client.upload_file(upload_path, '{}csv'.format(bucket), '{}.csv'.format(upload_key))
+        for day, messages in read_bundle_channel(bucket, bundle_key, entry):
+            upload_csv(messages, bucket, '{}{}/{}.json'.format(prefix, channel, day))
+        print(f"Converted {len(entry['days'])} days of {channel} from {bundle_key}")
+
+def process_record(record):
+    """
+    Converts the S3 object of one event record, streaming the JSON body straight into the converter.
+    :return: A dict with the key, the status ('converted', 'skipped' or 'failed') and any error.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+
+    # Check if the file is one of the excluded files
+    if os.path.basename(key) in EXCLUDED_FILES:
+        print(f"Skipping {os.path.basename(key)} file.")
+        return {'key': key, 'status': 'skipped', 'error': None}
+
+    # Skip exporter state such as the channel watermarks
+    if key.startswith('_state/'):
+        print(f"Skipping state file {key}.")
+        return {'key': key, 'status': 'skipped', 'error': None}
+
+    # The bundle body is read by range through its manifest, so its own event is ignored
+    if key.endswith(BUNDLE_SUFFIX):
+        print(f"Skipping bundle {key}, converted through its manifest.")
+        return {'key': key, 'status': 'skipped', 'error': None}
+
+    try:
+        # A bundle manifest converts the whole bundled export in one invocation
+        if key.endswith('.manifest.json'):
+            process_bundle(bucket, key)
+        else:
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+            data = iter_json_array(body) if key.endswith('.json') else []
+            upload_csv(data, bucket, key)
+    except Exception as e:
+        print(f"Error converting {key}: {e}")
+        return {'key': key, 'status': 'failed', 'error': str(e)}
+    return {'key': key, 'status': 'converted', 'error': None}
+
+def iter_s3_records(event):
+    """
+    Yields (message id, S3 record) pairs from a direct S3 event or from an SQS batch of S3 events.
+    """
+    for record in event['Records']:
+        if 's3' in record:
+            yield None, record
+        elif 'body' in record:
+            for s3_record in json.loads(record['body']).get('Records', []):
+                yield record['messageId'], s3_record
+
+def lambda_handler(event, context):
+    items = list(iter_s3_records(event))
+    if not items:
+        return {'results': [], 'batchItemFailures': []}
+
+    # Convert the records concurrently; one failed record does not stop the others
+    with ThreadPoolExecutor(max_workers=min(CONVERT_MAX_WORKERS, len(items))) as executor:
+        results = list(executor.map(process_record, (record for message_id, record in items)))
+
+    failed_message_ids = []
+    for (message_id, record), result in zip(items, results):
+        if result['status'] == 'failed' and message_id and message_id not in failed_message_ids:
+            failed_message_ids.append(message_id)
+
+    converted = sum(1 for result in results if result['status'] == 'converted')
+    failed = [result for result in results if result['status'] == 'failed']
+    print(f"Converted {converted} of {len(results)} records, {len(failed)} failed")
+
+    # Direct S3 events have no partial batch response, so a failure has to fail the invocation for Lambda to retry it
+    direct_failures = [result['key'] for (message_id, record), result in zip(items, results)
+                       if result['status'] == 'failed' and message_id is None]
+    if direct_failures:
+        raise RuntimeError(f"Failed to convert {', '.join(direct_failures)}")
+
+    # SQS retries only the messages listed in batchItemFailures
+    return {
+        'results': results,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
@@ -0,0 +1,83 @@
+from datetime import datetime
+from functools import lru_cache
+import pytz
+
+SELECTED_FIELDS = ["Thread Id","Date & Time","User's Name","Text Message","Thread Date & Time","Message Type","Total Reactions"]
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+IST = pytz.timezone('Asia/Kolkata')
+
+@lru_cache(maxsize=8192)
+def _format_second(second):
+    return datetime.fromtimestamp(second, IST).strftime(DATE_FORMAT)
+
+def format_ts(ts):
+    """
+    Formats a Slack ts as the IST date and time used in the CSVs. Replies share the
+    formatted thread time of their parent, so formatted seconds are cached.
+    """
+    return _format_second(int(float(ts)))
+
+def _thread_id(obj):
+    return obj.get('ts')
+
+def _date_time(obj):
+    return format_ts(obj['ts']) if 'ts' in obj else None
+
+def _user_name(obj):
+    return obj.get('user_profile', {}).get('real_name')
+
+def _text_message(obj):
+    return obj.get('text')
+
+def _thread_date_time(obj):
+    return format_ts(obj['thread_ts'] if 'thread_ts' in obj else obj['ts'])
+
+def _message_type(obj):
+    return 'Primary Message' if 'parent_user_id' not in obj else 'Reply'
+
+def _total_reactions(obj):
+    reactions = obj.get('reactions')
+    return sum(reaction['count'] for reaction in reactions) if reactions else 0
+
+def _none(obj):
+    return None
+
+FIELD_EXTRACTORS = {
+    "Thread Id": _thread_id,
+    "Date & Time": _date_time,
+    "User's Name": _user_name,
+    "Text Message": _text_message,
+    "Thread Date & Time": _thread_date_time,
+    "Message Type": _message_type,
+    "Total Reactions": _total_reactions,
+}
+
+def compile_row_extractor(fields=SELECTED_FIELDS):
+    """
+    Resolves the extractor of every field once and returns a function that turns
+    a Slack message into a CSV row in a single pass.
+    """
+    extractors = tuple((field, FIELD_EXTRACTORS.get(field, _none)) for field in fields)
+
+    def extract_row(obj):
+        return {field: extractor(obj) for field, extractor in extractors}
+
+    return extract_row
+
+def message_sort_key(obj):
+    """
+    Orders messages by the numeric thread ts first and then by their own ts,
+    so replies follow their parent without reparsing formatted dates.
+    """
+    ts = float(obj.get('ts', 0))
+    return (float(obj['thread_ts']) if 'thread_ts' in obj else ts, ts)
+
+def iter_keyed_rows(messages, extract_row):
+    """
+    Yields (sort key, row) pairs for every message, skipping channel joins.
+    """
+    for obj in messages:
+        if obj.get('subtype') == 'channel_join':
+            continue
+        yield message_sort_key(obj), extract_row(obj)
@@ -0,0 +1,53 @@
+import json
+
+THREAD_INDEX_SUFFIX = '.threads.json'
+
+class ThreadIndexBuilder:
+    """
+    Builds the thread index of a converted CSV in the same pass that writes the rows.
+    Rows arrive ordered by (thread_ts, ts), so the rows of a thread are contiguous and
+    every thread is described by its first row and row count, plus its byte range when known.
+    """
+    def __init__(self):
+        self.threads = {}
+        self.row_number = 0
+
+    def add(self, key, row, byte_offset=None, byte_end=None):
+        """
+        :param key: The numeric (thread_ts, ts) sort key of the row.
+        :param row: The CSV row.
+        :param byte_offset: The byte offset of the row in the CSV, if known.
+        :param byte_end: The byte offset just past the row, if known.
+        """
+        thread_ts = '%.6f' % key[0]
+        thread = self.threads.get(thread_ts)
+        if thread is None:
+            thread = self.threads[thread_ts] = {
+                'parent_ts': None,
+                'reply_count': 0,
+                'total_reactions': 0,
+                'participants': [],
+                'first_row': self.row_number,
+                'row_count': 0,
+                'byte_offset': byte_offset,
+                'byte_length': None,
+            }
+
+        if row["Message Type"] == 'Primary Message' and thread['parent_ts'] is None:
+            thread['parent_ts'] = row["Thread Id"]
+        else:
+            thread['reply_count'] += 1
+        thread['total_reactions'] += row["Total Reactions"] or 0
+        user_name = row["User's Name"]
+        if user_name and user_name not in thread['participants']:
+            thread['participants'].append(user_name)
+        thread['row_count'] += 1
+        if byte_offset is not None and byte_end is not None:
+            thread['byte_length'] = byte_end - thread['byte_offset']
+        self.row_number += 1
+
+    def to_dict(self):
+        return {'version': 1, 'rows': self.row_number, 'threads': self.threads}
+
+    def dumps(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,84 @@
+import os
+import json
+import gzip
+import time
+from botocore.exceptions import ClientError, BotoCoreError
+from s3_uploader import upload_file_with_retry, get_transfer_config
+
+# 'files' uploads the export tree as it is, 'bundle' uploads one compressed bundle and its manifest
+EXPORT_MODE = os.getenv('EXPORT_MODE', 'files')
+
+BUNDLE_SUFFIX = '.jsonl.gz'
+MANIFEST_SUFFIX = '.manifest.json'
+
+def write_bundle(export_dir, bundle_path):
+    """
+    Streams a slackdump export directory into one newline-delimited JSON bundle.
+    Every channel is written as its own gzip member so it can be fetched with a range read,
+    and every line holds one message along with the day file it came from.
+    :param export_dir: The slackdump export directory.
+    :param bundle_path: The path of the .jsonl.gz bundle to write.
+    :return: The manifest dict with the byte offset and length of every channel.
+    """
+    manifest = {'bundle': os.path.basename(bundle_path), 'format': 'jsonl+gzip', 'channels': {}}
+
+    with open(bundle_path, 'wb') as bundle_file:
+        for channel in sorted(os.listdir(export_dir)):
+            channel_dir = os.path.join(export_dir, channel)
+            if not os.path.isdir(channel_dir):
+                continue
+
+            offset = bundle_file.tell()
+            days = {}
+            with gzip.GzipFile(fileobj=bundle_file, mode='wb', mtime=0) as gz:
+                for file_name in sorted(os.listdir(channel_dir)):
+                    if not file_name.endswith('.json'):
+                        continue
+                    day = file_name[:-len('.json')]
+                    with open(os.path.join(channel_dir, file_name), 'r', encoding='utf-8') as f:
+                        messages = json.load(f)
+                    for message in messages:
+                        line = json.dumps({'day': day, 'message': message}, ensure_ascii=False, separators=(',', ':'))
+                        gz.write(line.encode('utf-8') + b'\n')
+                    days[day] = len(messages)
+
+            manifest['channels'][channel] = {
+                'offset': offset,
+                'length': bundle_file.tell() - offset,
+                'days': days
+            }
+
+    return manifest
+
+def write_manifest(manifest, manifest_path):
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+def upload_bundle(export_dir, bucket_name, s3_client, s3_prefix):
+    """
+    Bundles an export directory and uploads the bundle followed by its manifest.
+    The manifest goes last, so a manifest in the bucket always points at a complete bundle.
+    :return: A summary dict in the same shape as upload_dir_to_s3.
+    """
+    start = time.monotonic()
+    bundle_path = f"{export_dir}{BUNDLE_SUFFIX}"
+    manifest_path = f"{export_dir}{MANIFEST_SUFFIX}"
+    manifest = write_bundle(export_dir, bundle_path)
+    write_manifest(manifest, manifest_path)
+
+    summary = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failed': []}
+    transfer_config = get_transfer_config()
+    for local_file_path in (bundle_path, manifest_path):
+        s3_file_path = os.path.join(s3_prefix, os.path.basename(local_file_path))
+        try:
+            summary['bytes'] += upload_file_with_retry(s3_client, local_file_path, bucket_name, s3_file_path, transfer_config)
+            summary['files'] += 1
+        except (ClientError, BotoCoreError, OSError) as e:
+            print(f"Error uploading file {local_file_path} to S3: {e}")
+            summary['failed'].append(local_file_path)
+            break
+
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    print(f"Uploaded bundle of {len(manifest['channels'])} channels ({summary['bytes']} bytes) "
+          f"to s3://{bucket_name}/{s3_prefix} in {summary['seconds']}s")
+    return summary
@@ -1,65 +1,97 @@
-import subprocess
 import os
 from datetime import datetime, timedelta
 import pytz
-import boto3
 from botocore.exceptions import ClientError
+from s3_uploader import upload_dir_to_s3, get_s3_client
+from watermark_store import get_watermark_store, group_channels_by_watermark
+from slackdump_runner import run_sharded_slackdump
+from export_bundle import EXPORT_MODE, upload_bundle
 
-def upload_dir_to_s3(local_dir, bucket_name, s3_client, s3_prefix):
-    """
-    Recursively uploads a local directory to an S3 bucket with a specified prefix.
-    :param local_dir: The local directory to upload.
-    :param bucket_name: The name of the S3 bucket.
-    :param s3_client: The Boto3 S3 client.
-    :param s3_prefix: The prefix to use as a virtual directory in the S3 bucket.
-    """
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            s3_file_path = os.path.join(s3_prefix, os.path.relpath(local_file_path, local_dir))
-            try:
-                s3_client.upload_fileobj(open(local_file_path, 'rb'), bucket_name, s3_file_path)
-            except ClientError as e:
-                print(f"Error uploading file {local_file_path} to S3: {e}")
+# Channels without a watermark start DEFAULT_WINDOW_HOURS back, none backfill more than MAX_BACKFILL_HOURS
+MAX_BACKFILL_HOURS = int(os.getenv('MAX_BACKFILL_HOURS', '168'))
+DEFAULT_WINDOW_HOURS = int(os.getenv('DEFAULT_WINDOW_HOURS', '2'))
+
+def read_channels(channels_file):
+    with open(channels_file, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
 
 def lambda_handler(event, context):
-    # Calculate time and construct the file name
-    two_hours_ago = datetime.now(pytz.timezone('UTC')) - timedelta(hours=2)
-    formatted_date = two_hours_ago.strftime('%Y-%m-%dT%H:%M:%S')
+    utc = pytz.timezone('UTC')
+    dump_to = datetime.now(utc)
+    default_from = dump_to - timedelta(hours=DEFAULT_WINDOW_HOURS)
+    min_from = dump_to - timedelta(hours=MAX_BACKFILL_HOURS)
+
+    # Every channel resumes from its own watermark, channels sharing one are dumped together
+    watermark_store = get_watermark_store()
+    watermarks = watermark_store.load()
+    groups = group_channels_by_watermark(read_channels('channels.txt'), watermarks,
+                                         default_from.timestamp(), min_from.timestamp())
+    if not groups:
+        print('Error: No channels to export')
+        return {
+            'statusCode': 200,
+            'body': 'No channels to export'
+        }
+
+    # Construct the file name from the earliest start of this run
+    earliest_from = datetime.fromtimestamp(min(groups), utc)
     ist_time = pytz.timezone('Asia/Kolkata')
-    timestamp = two_hours_ago.astimezone(ist_time).strftime('%Y-%m-%d-%H-%M-%S')
-    
+    timestamp = earliest_from.astimezone(ist_time).strftime('%Y-%m-%d-%H-%M-%S')
+
     export_filename = f"support_driven_{timestamp}"  # Ensure the extension matches expected output
     export_dir = f"/tmp/{export_filename}"
     s3_prefix = f"support_driven_{timestamp}/"
 
     cookie = os.getenv('COOKIE')
     slack_token = os.getenv('SLACK_TOKEN')
-    
-    command = ['./slackdump', '-cookie', cookie, '-t', slack_token, '-dump-from', formatted_date, '-export', export_dir, '@channels.txt']
-    result = subprocess.run(command, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    print(result.stdout)
-    print(result.stderr)
 
-    # Check if the export directory was created
-    if os.path.exists(export_dir):
-        print('Slack messages exported to {}'.format(export_dir))
+    # Reuse the pooled S3 client of this container
+    s3 = get_s3_client()
 
-        # Create an S3 client
-        s3 = boto3.client('s3')
+    failed_channels = []
+    for index, (from_ts, channels) in enumerate(sorted(groups.items())):
+        group_dir = export_dir if len(groups) == 1 else f"{export_dir}_{index}"
+        dump_from = datetime.fromtimestamp(from_ts, utc)
+        print(f"Exporting {len(channels)} channels from {dump_from.isoformat()} to {dump_to.isoformat()}")
+        shard_reports = run_sharded_slackdump(channels, dump_from, dump_to, group_dir, cookie, slack_token)
 
-        # Upload the directory to S3
+        # Only the channels of shards that exported successfully are uploaded and advanced
+        exported_channels = []
+        for report in shard_reports:
+            if report['error']:
+                print(f"Error: Slack messages were not exported for {report['channels']}: {report['error']}")
+                failed_channels.extend(report['channels'])
+            else:
+                exported_channels.extend(report['channels'])
+        if not exported_channels:
+            continue
+        print('Slack messages exported to {}'.format(group_dir))
+
+        # Upload the directory to S3, or a single bundle and its manifest in bundle mode
         try:
-            upload_dir_to_s3(export_dir, 'slackdumpfiles', s3, s3_prefix)
-            print(f"Uploaded {export_dir} to S3 bucket 'slackdumpfiles' with prefix '{s3_prefix}'")
+            if EXPORT_MODE == 'bundle':
+                summary = upload_bundle(group_dir, 'slackdumpfiles', s3, s3_prefix)
+            else:
+                summary = upload_dir_to_s3(group_dir, 'slackdumpfiles', s3, s3_prefix)
         except ClientError as e:
             print(f"Error uploading directory to S3: {e}")
-            return {
-                'statusCode': 500,
-                'body': 'Error uploading directory to S3'
-            }
-    else:
-        print('Error: Slack messages were not exported')
+            failed_channels.extend(exported_channels)
+            continue
+        if summary['failed']:
+            failed_channels.extend(exported_channels)
+            continue
+        print(f"Uploaded {group_dir} to S3 bucket 'slackdumpfiles' with prefix '{s3_prefix}'")
+
+        # The upload committed, so the next run starts where this one stopped
+        for channel in exported_channels:
+            watermarks[channel] = f"{dump_to.timestamp():.6f}"
+        watermark_store.save(watermarks)
+
+    if failed_channels:
+        return {
+            'statusCode': 500,
+            'body': f"Error exporting or uploading channels: {', '.join(failed_channels)}"
+        }
 
     return {
         'statusCode': 200,
@@ -0,0 +1,103 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+# Tunables, overridable through the Lambda environment
+UPLOAD_MAX_WORKERS = int(os.getenv('UPLOAD_MAX_WORKERS', '32'))
+UPLOAD_MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', '3'))
+MULTIPART_THRESHOLD_MB = int(os.getenv('MULTIPART_THRESHOLD_MB', '8'))
+MULTIPART_CHUNKSIZE_MB = int(os.getenv('MULTIPART_CHUNKSIZE_MB', '8'))
+MULTIPART_CONCURRENCY = int(os.getenv('MULTIPART_CONCURRENCY', '4'))
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_s3_client():
+    """
+    Returns one S3 client per warm container, with a connection pool large
+    enough for every upload worker to keep its own keep-alive connection.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.client('s3', config=Config(
+                    max_pool_connections=UPLOAD_MAX_WORKERS * MULTIPART_CONCURRENCY
+                ))
+    return _client
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD_MB * 1024 * 1024,
+        multipart_chunksize=MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+        max_concurrency=MULTIPART_CONCURRENCY,
+        use_threads=MULTIPART_CONCURRENCY > 1
+    )
+
+def upload_file_with_retry(s3_client, local_file_path, bucket_name, s3_file_path, transfer_config, max_retries=UPLOAD_MAX_RETRIES):
+    """
+    Uploads a single file, retrying with jittered exponential backoff.
+    Returns the number of bytes uploaded.
+    """
+    attempt = 0
+    while True:
+        try:
+            with open(local_file_path, 'rb') as f:
+                s3_client.upload_fileobj(f, bucket_name, s3_file_path, Config=transfer_config)
+            return os.path.getsize(local_file_path)
+        except (ClientError, BotoCoreError) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = min(0.2 * (2 ** attempt), 5) * random.uniform(0.5, 1.5)
+            print(f"Retrying upload of {local_file_path} in {delay:.2f}s (attempt {attempt}/{max_retries}): {e}")
+            time.sleep(delay)
+
+def upload_dir_to_s3(local_dir, bucket_name, s3_client=None, s3_prefix='', max_workers=UPLOAD_MAX_WORKERS):
+    """
+    Recursively uploads a local directory to an S3 bucket with a specified prefix,
+    using a bounded thread pool that shares one client and connection pool.
+    :param local_dir: The local directory to upload.
+    :param bucket_name: The name of the S3 bucket.
+    :param s3_client: The Boto3 S3 client. Defaults to the pooled client.
+    :param s3_prefix: The prefix to use as a virtual directory in the S3 bucket.
+    :param max_workers: The maximum number of files uploaded at once.
+    :return: A summary dict with the files, bytes and seconds taken, and the failed files.
+    """
+    s3_client = s3_client or get_s3_client()
+    transfer_config = get_transfer_config()
+    start = time.monotonic()
+
+    uploads = []
+    for root, dirs, files in os.walk(local_dir):
+        for file in files:
+            local_file_path = os.path.join(root, file)
+            s3_file_path = os.path.join(s3_prefix, os.path.relpath(local_file_path, local_dir))
+            uploads.append((local_file_path, s3_file_path))
+
+    summary = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failed': []}
+    if uploads:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as executor:
+            futures = {
+                executor.submit(upload_file_with_retry, s3_client, local_file_path, bucket_name, s3_file_path, transfer_config): local_file_path
+                for local_file_path, s3_file_path in uploads
+            }
+            for future in as_completed(futures):
+                local_file_path = futures[future]
+                try:
+                    summary['bytes'] += future.result()
+                    summary['files'] += 1
+                except (ClientError, BotoCoreError, OSError) as e:
+                    print(f"Error uploading file {local_file_path} to S3: {e}")
+                    summary['failed'].append(local_file_path)
+
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    print(f"Uploaded {summary['files']} files ({summary['bytes']} bytes) to s3://{bucket_name}/{s3_prefix} "
+          f"in {summary['seconds']}s, {len(summary['failed'])} failed")
+    return summary
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of concurrent slackdump processes a channel list is split across
+SLACKDUMP_SHARDS = int(os.getenv('SLACKDUMP_SHARDS', '4'))
+
+def run_slackdump(channels, dump_from, dump_to, export_dir, cookie, slack_token):
+    """
+    Exports the given channels between dump_from and dump_to into export_dir.
+    :return: The slackdump exit code.
+    """
+    channels_file = f"{export_dir}_channels.txt"
+    with open(channels_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(channels) + '\n')
+
+    command = ['./slackdump', '-cookie', cookie, '-t', slack_token,
+               '-dump-from', dump_from.strftime('%Y-%m-%dT%H:%M:%S'),
+               '-dump-to', dump_to.strftime('%Y-%m-%dT%H:%M:%S'),
+               '-export', export_dir, f'@{channels_file}']
+    result = subprocess.run(command, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    print(result.stdout)
+    print(result.stderr)
+    return result.returncode
+
+def split_into_shards(channels, shard_count):
+    """
+    Deals the channels round-robin into at most shard_count non-empty shards.
+    """
+    shard_count = max(1, min(shard_count, len(channels)))
+    return [channels[i::shard_count] for i in range(shard_count)]
+
+def merge_json_lists(source_path, target_path):
+    """
+    Merges a top-level export file such as channels.json or users.json, keeping one entry per id.
+    """
+    with open(source_path, 'r', encoding='utf-8') as f:
+        source = json.load(f)
+    if not os.path.exists(target_path):
+        target = []
+    else:
+        with open(target_path, 'r', encoding='utf-8') as f:
+            target = json.load(f)
+
+    if not isinstance(source, list) or not isinstance(target, list):
+        shutil.copyfile(source_path, target_path)
+        return
+
+    seen = {item.get('id') for item in target if isinstance(item, dict)}
+    for item in source:
+        if isinstance(item, dict) and item.get('id') in seen:
+            continue
+        target.append(item)
+        if isinstance(item, dict):
+            seen.add(item.get('id'))
+    with open(target_path, 'w', encoding='utf-8') as f:
+        json.dump(target, f)
+
+def merge_export_dirs(shard_dirs, export_dir):
+    """
+    Merges the export directories of several shards into one export directory.
+    Channel folders are moved as they are, top-level JSON lists are merged by id.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    for shard_dir in shard_dirs:
+        for name in os.listdir(shard_dir):
+            source_path = os.path.join(shard_dir, name)
+            target_path = os.path.join(export_dir, name)
+            if os.path.isdir(source_path):
+                if not os.path.exists(target_path):
+                    shutil.move(source_path, target_path)
+                    continue
+                for file_name in os.listdir(source_path):
+                    shutil.move(os.path.join(source_path, file_name), os.path.join(target_path, file_name))
+            elif name.endswith('.json'):
+                merge_json_lists(source_path, target_path)
+            elif not os.path.exists(target_path):
+                shutil.move(source_path, target_path)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def run_sharded_slackdump(channels, dump_from, dump_to, export_dir, cookie, slack_token, shard_count=SLACKDUMP_SHARDS):
+    """
+    Splits the channels into shards, exports the shards with concurrent slackdump processes
+    and merges the successful shard exports into export_dir.
+    :return: A list with the channels, exit code, seconds and error of every shard.
+    """
+    shards = split_into_shards(channels, shard_count)
+
+    def run_shard(index, shard_channels):
+        shard_dir = f"{export_dir}_shard{index}"
+        start = time.monotonic()
+        report = {'shard': index, 'channels': shard_channels, 'export_dir': shard_dir,
+                  'returncode': None, 'seconds': 0.0, 'error': None}
+        try:
+            report['returncode'] = run_slackdump(shard_channels, dump_from, dump_to, shard_dir, cookie, slack_token)
+            if report['returncode'] != 0:
+                report['error'] = f"slackdump exited with code {report['returncode']}"
+            elif not os.path.exists(shard_dir):
+                report['error'] = 'export directory was not created'
+        except OSError as e:
+            report['error'] = str(e)
+        report['seconds'] = round(time.monotonic() - start, 3)
+        return report
+
+    if not shards:
+        return []
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        reports = list(executor.map(run_shard, range(len(shards)), shards))
+
+    for report in reports:
+        status = 'failed: ' + report['error'] if report['error'] else 'ok'
+        print(f"Shard {report['shard']}: {len(report['channels'])} channels in {report['seconds']}s, {status}")
+
+    merge_export_dirs([report['export_dir'] for report in reports if not report['error']], export_dir)
+    return reports
@@ -0,0 +1,73 @@
+import os
+import json
+from botocore.exceptions import ClientError
+from s3_uploader import get_s3_client
+
+# Saved in the state bucket, since every object written to the export bucket starts a conversion
+WATERMARK_BUCKET = os.getenv('WATERMARK_BUCKET', 'slackdumpanalysisstate')
+WATERMARK_KEY = os.getenv('WATERMARK_KEY', '_state/watermarks.json')
+# When set, watermarks are kept in this local file instead of S3 (tests and local runs)
+WATERMARK_FILE = os.getenv('WATERMARK_FILE')
+
+class S3WatermarkStore:
+    """
+    Keeps the last exported Slack ts of every channel as one small JSON object in S3.
+    """
+    def __init__(self, bucket_name, key, s3_client=None):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.s3_client = s3_client or get_s3_client()
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return {}
+            raise
+        return json.loads(response['Body'].read()).get('channels', {})
+
+    def save(self, watermarks):
+        body = json.dumps({'channels': watermarks}, indent=2, sort_keys=True)
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=body.encode('utf-8'),
+                                  ContentType='application/json')
+
+class LocalWatermarkStore:
+    """
+    Local-file stand-in for S3WatermarkStore with the same JSON layout.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('channels', {})
+
+    def save(self, watermarks):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'channels': watermarks}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def get_watermark_store():
+    if WATERMARK_FILE:
+        return LocalWatermarkStore(WATERMARK_FILE)
+    return S3WatermarkStore(WATERMARK_BUCKET, WATERMARK_KEY)
+
+def group_channels_by_watermark(channels, watermarks, default_from_ts, min_from_ts):
+    """
+    Groups channels that share the same export start so each group needs a single slackdump run.
+    :param channels: The channel ids to export.
+    :param watermarks: Mapping of channel id to the last exported ts.
+    :param default_from_ts: The start ts for channels without a watermark.
+    :param min_from_ts: The earliest start ts allowed, which caps the backfill after long outages.
+    :return: A dict mapping start ts to the list of channel ids.
+    """
+    groups = {}
+    for channel in channels:
+        from_ts = float(watermarks.get(channel, default_from_ts))
+        from_ts = max(from_ts, min_from_ts)
+        groups.setdefault(from_ts, []).append(channel)
+    return groups